@@ -21,12 +21,14 @@ def quick_login(request):
 
 urlpatterns = [
     path('enhance', views.enhance_view, name='enhance'),
+    path('enhance/stream', views.enhance_stream_view, name='enhance-stream'),
     path('detect-intent', views.detect_intent_view, name='detect-intent'),
     path('quality-heatmap', views.quality_heatmap_view, name='quality-heatmap'),
     path('ab-test', views.ab_test_view, name='ab-test'),
     path('analyze-url', views.analyze_url_view, name='analyze-url'),
     path('web-search', views.web_search_view, name='web-search'),
     path('ideas', views.ideas_view, name='ideas'),
+    path('stats', views.stats_view, name='stats'),
     path('quick-login/', quick_login, name='quick-login'),
     
     # Auth endpoints
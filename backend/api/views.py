@@ -3,14 +3,25 @@ PromptX API Views
 Django equivalents of all Flask endpoints from app.py.
 """
 
+import hmac
 import json
+import time
+import asyncio
 import logging
 import re
+from collections import Counter
+from functools import wraps
 
-from django.http import JsonResponse
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
+from django_ratelimit import ALL
+from django_ratelimit.core import is_ratelimited
 from django_ratelimit.decorators import ratelimit
+from django_ratelimit.exceptions import Ratelimited
 
 from .utils import sanitize_input, classify_prompt, score_prompt, MASTER_PROMPT, WELCOME_SYSTEM_PROMPT, DEEP_RESEARCH_PROMPT
 # Import from parent backend directory
@@ -18,16 +29,26 @@ import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from caches import anear_duplicate_lookup, anear_duplicate_store
+from providers import (
+    QuotaExceededError, Deadline, DeadlineExceededError, GENERATION_RESERVE, trim_to_tokens,
+    agenerate_with_fallback, astream_with_fallback, register_prefix,
+    run_on_worker_loop, arun_on_worker_loop,
+)
+from crawler import SiteIndex, SITE_INDEX_BUDGET, ascrape_website_deep, asite_index, aweb_search, aweb_search_many
 from services import (
     detect_intent, apply_smart_template,
     analyze_quality_heatmap,
-    generate_ab_variations, compare_variations,
-    generate_with_fallback,
-    scrape_url, scrape_website_deep, web_search,
+    compare_variations, provider_stats,
+    agenerate_ab_variations, asummarise_pages,
 )
 
 logger = logging.getLogger(__name__)
 
+# Static instruction blocks that lead every enhancement / deep-research prompt
+register_prefix('master', MASTER_PROMPT)
+register_prefix('deep_research', DEEP_RESEARCH_PROMPT)
+
 
 def _get_client_ip(request):
     """Extract client IP for logging"""
@@ -37,6 +58,55 @@ def _get_client_ip(request):
     return request.META.get('REMOTE_ADDR', 'unknown')
 
 
+def _quota_response(e):
+    """429 with Retry-After when every usable provider is out of quota."""
+    response = JsonResponse({'error': str(e), 'success': False, 'retry_after': e.retry_after}, status=429)
+    if e.retry_after is not None:
+        response['Retry-After'] = str(int(e.retry_after) + 1)
+    return response
+
+
+def _deadline_response(e, deadline):
+    """504 with the budget report when the request ran out of time."""
+    return JsonResponse({'error': str(e), 'success': False, 'budget': deadline.report()}, status=504)
+
+
+def _gathering_budget(deadline):
+    """Sub-deadline for crawling / searching that leaves GENERATION_RESERVE for the model call."""
+    return deadline.within(deadline.remaining() - GENERATION_RESERVE)
+
+
+def async_ratelimit(key, rate):
+    """@ratelimit for async views; django-ratelimit's own decorator only wraps sync functions."""
+    def decorator(fn):
+        @wraps(fn)
+        async def _wrapped(request, *args, **kw):
+            limited = await sync_to_async(is_ratelimited)(
+                request=request, group=None, fn=fn, key=key, rate=rate, method=ALL, increment=True,
+            )
+            request.limited = limited or getattr(request, 'limited', False)
+            if limited:
+                raise Ratelimited()
+            return await fn(request, *args, **kw)
+        return _wrapped
+    return decorator
+
+
+def on_worker_loop(view):
+    """
+    Run an async view on the worker's long-lived loop under WSGI. Django
+    would otherwise give each request a fresh loop (async_to_sync), and
+    with it fresh provider / scraping clients; under ASGI the server's
+    loop already is that loop.
+    """
+    @wraps(view)
+    async def _wrapped(request, *args, **kw):
+        if isinstance(request, ASGIRequest):
+            return await view(request, *args, **kw)
+        return await arun_on_worker_loop(view(request, *args, **kw))
+    return _wrapped
+
+
 def _parse_json(request):
     """Parse JSON body from request, returns (data, error_response)"""
     try:
@@ -52,11 +122,33 @@ def _parse_json(request):
 
 @require_http_methods(["GET"])
 def health_view(request):
+    """Liveness only: public and polled often, so no store scans and no internals."""
     return JsonResponse({
         'status': 'healthy',
         'version': '2.0.0',
         'framework': 'django',
-        'model': 'gemini-pro'
+        'model': 'gemini-pro',
+    })
+
+
+def _stats_authorised(request):
+    """Staff session, or the PROMPTX_STATS_TOKEN bearer token when one is configured."""
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    token = settings.STATS_TOKEN
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    return bool(token) and hmac.compare_digest(header.encode(), f'Bearer {token}'.encode())
+
+
+@require_http_methods(["GET"])
+def stats_view(request):
+    """Worker memory, circuits, quota ledger and cache counters, for operators only."""
+    if not _stats_authorised(request):
+        return JsonResponse({'error': 'Forbidden'}, status=403)
+    from promptx_project.preload import memory_report
+    return JsonResponse({
+        'worker': memory_report(),
+        'providers': provider_stats(),
     })
 
 
@@ -143,7 +235,19 @@ def _extract_urls(text: str) -> list:
 
 def build_website_analysis_prompt(user_question, site_name, url,
                                    pages_scraped, total_chars,
-                                   pages_summary, scraped_content, search_context):
+                                   pages_summary, index, search_context, content_tokens,
+                                   page_summaries=None):
+    """
+    The analysis prompt, with the crawl's content cut down to the chunks of
+    its SiteIndex that rank best for the question, up to content_tokens.
+    With page_summaries (map-reduce synthesis) those stand in for the pages.
+    """
+    if page_summaries is not None:
+        scraped_content = trim_to_tokens('\n\n'.join(
+            f"=== PAGE SUMMARY: {s['title']} ===\nURL: {s['url']}\n\n{s['summary']}" for s in page_summaries
+        ), content_tokens)
+    else:
+        scraped_content = SiteIndex(index).pack(user_question, content_tokens)
     return f"""You are a world-class senior software architect, product analyst, reverse-engineer, and technical writer.
 
 You have scraped {pages_scraped} pages ({total_chars:,} chars) from "{site_name}" ({url}) and gathered web search intelligence.
@@ -281,123 +385,180 @@ FORMATTING RULES:
 - Do NOT say "I cannot determine" — infer and label as inferred"""
 
 
-@csrf_exempt
-@require_http_methods(["POST"])
-@ratelimit(key='ip', rate='20/m', block=True)
-def enhance_view(request):
-    """Enhance a prompt using AI — with deep research mode for complex requests"""
-    try:
-        data, err = _parse_json(request)
-        if err:
-            return err
+def _parse_enhance_request(request):
+    """Validate an /enhance payload. Returns ((prompt, model_arg, api_key, force_refresh, follow_up), error_response)."""
+    data, err = _parse_json(request)
+    if err:
+        return None, err
 
-        if 'prompt' not in data:
-            return JsonResponse({'error': 'Prompt is missing from payload'}, status=400)
+    if 'prompt' not in data:
+        return None, JsonResponse({'error': 'Prompt is missing from payload'}, status=400)
 
-        prompt = sanitize_input(data['prompt'])
-        if not prompt:
-            logger.warning(f"Prompt failed sanitization from {_get_client_ip(request)}")
-            return JsonResponse({'error': 'Prompt is empty or invalid'}, status=400)
-        if len(prompt) > 100000:
-            return JsonResponse({'error': f'Prompt too long: {len(prompt)} chars'}, status=400)
+    prompt = sanitize_input(data['prompt'])
+    if not prompt:
+        logger.warning(f"Prompt failed sanitization from {_get_client_ip(request)}")
+        return None, JsonResponse({'error': 'Prompt is empty or invalid'}, status=400)
+    if len(prompt) > 100000:
+        return None, JsonResponse({'error': f'Prompt too long: {len(prompt)} chars'}, status=400)
 
-        preferred_model = data.get('model')
-        model_arg = preferred_model if preferred_model in ('gemini_flash', 'gemini_flash_8b', 'gemini_pro', 'nvidia_minimax', 'groq') else None
-        
-        # User-provided API Key from headers
-        api_key = request.headers.get('X-API-Key')
+    preferred_model = data.get('model')
+    model_arg = preferred_model if preferred_model in ('gemini_flash', 'gemini_flash_8b', 'gemini_pro', 'nvidia_minimax', 'groq') else None
+    
+    # User-provided API Key from headers
+    api_key = request.headers.get('X-API-Key')
+    # Re-crawl a URL in the prompt even if a fresh site snapshot is cached
+    force_refresh = bool(data.get('force_refresh'))
+    # The client asks a further question about a site it has just had analysed
+    follow_up = bool(data.get('follow_up'))
+    return (prompt, model_arg, api_key, force_refresh, follow_up), None
 
-        # ── 1. Greeting → welcome response ───────────────────────────────────
-        if _is_greeting(prompt):
-            welcome_prompt = (
-                f"{WELCOME_SYSTEM_PROMPT}\n\n"
-                f"The user just said: \"{prompt}\"\n\n"
-                f"Respond with a warm, helpful welcome message."
-            )
-            result = generate_with_fallback(welcome_prompt, max_tokens=600, preferred_model=model_arg, api_key=api_key)
-            return JsonResponse({
+
+async def _near_duplicate_response(route, prompt, model_arg, api_key):
+    """A stored response for a near-identical earlier prompt on route, marked as such, or None."""
+    hit = await anear_duplicate_lookup(route, prompt, preferred_model=model_arg, api_key=api_key)
+    if hit is None:
+        return None
+    payload, similarity = hit
+    logger.info(f"Near-duplicate {route} hit (similarity {similarity:.2f})")
+    return {**payload, 'original': prompt, 'cache': 'near_hit', 'similarity': round(similarity, 3)}
+
+
+async def _remember_response(plan, prompt, model_arg, api_key, payload):
+    """Index a successful generated response for near-duplicate reuse on its route."""
+    if plan.get('route') and payload.get('success') and payload.get('enhanced'):
+        await anear_duplicate_store(plan['route'], prompt, payload, preferred_model=model_arg, api_key=api_key)
+
+
+async def _plan_enhancement(prompt, model_arg, api_key, client_ip='unknown', deadline=None, force_refresh=False,
+                            follow_up=False):
+    """
+    Everything /enhance does before the final model call.
+
+    Yields ('status', {'step', 'message'}) as slow work starts, then one
+    ('plan', plan). A plan either carries a finished 'response', or the
+    'prompt' and 'max_tokens' for the final generation plus a 'respond'
+    callable that turns its result ({'text', 'model', ...}) into the
+    response payload. The JSON and streaming endpoints share this so their
+    payloads can't drift apart. Plans with a 'route' are answered from the
+    near-duplicate cache when a near-identical prompt was answered before.
+    Crawling, searching and the deep-research analysis pass spend the
+    request deadline, always leaving GENERATION_RESERVE for the final call.
+    """
+    deadline = deadline or Deadline.for_route('enhance')
+    # ── 1. Greeting → welcome response ───────────────────────────────────
+    if _is_greeting(prompt):
+        near = await _near_duplicate_response('greeting', prompt, model_arg, api_key)
+        if near:
+            yield 'plan', {'response': near}
+            return
+
+        welcome_prompt = (
+            f"{WELCOME_SYSTEM_PROMPT}\n\n"
+            f"The user just said: \"{prompt}\"\n\n"
+            f"Respond with a warm, helpful welcome message."
+        )
+
+        def respond(result):
+            return {
                 'success': True,
                 'type': 'welcome',
                 'enhanced': result['text'],
                 'model': result['model'],
+                'hedge': result.get('hedge'),
                 'original': prompt,
                 'original_score': {'total': 0, 'percentage': 0, 'quality': 'N/A'},
                 'enhanced_score': {'total': 0, 'percentage': 0, 'quality': 'N/A'},
                 'improvement': 0,
                 'classification': {'category': 'greeting', 'confidence': 1.0},
-            })
+            }
 
-        # ── 1.5. Idea generation request → generate ideas ───────────────────
-        if _needs_ideas(prompt):
-            logger.info(f"Idea generation triggered for: {prompt[:80]}...")
-            from enhancer.core.idea_generator import IdeaGenerator
-            generator = IdeaGenerator()
-            result = generator.generate(prompt, quantity=5)
-            
-            # Build a comprehensive response with AI enhancement
-            ideas_text = "\n\n".join([
-                f"## {i+1}. {idea.get('title', 'Untitled')}\n"
-                f"**Description:** {idea.get('description', 'N/A')}\n"
-                + (f"**Market Size:** {idea.get('market_size', '')}\n" if idea.get('market_size') else "")
-                + (f"**Revenue Potential:** {idea.get('revenue_potential', idea.get('income_potential', ''))}\n" if idea.get('revenue_potential') or idea.get('income_potential') else "")
-                + (f"**Startup Cost:** {idea.get('startup_cost', '')}\n" if idea.get('startup_cost') else "")
-                + (f"**Time to Revenue:** {idea.get('time_to_revenue', '')}\n" if idea.get('time_to_revenue') else "")
-                + (f"**Difficulty:** {idea.get('difficulty', '')}\n" if idea.get('difficulty') else "")
-                + (f"**Skills Needed:** {', '.join(idea.get('skills_needed', []))}\n" if idea.get('skills_needed') else "")
-                + (f"**Tech Stack:** {', '.join(idea.get('tech_stack', []))}\n" if idea.get('tech_stack') else "")
-                + (f"**Features:** {', '.join(idea.get('features', []))}\n" if idea.get('features') else "")
-                + (f"**Use Cases:** {', '.join(idea.get('use_cases', []))}\n" if idea.get('use_cases') else "")
-                + (f"**Tools Needed:** {idea.get('tools_needed', '')}\n" if idea.get('tools_needed') else "")
-                + (f"**Time Investment:** {idea.get('time_investment', '')}\n" if idea.get('time_investment') else "")
-                for i, idea in enumerate(result.ideas)
-            ])
-            
-            enhanced = f"# 💡 Business & Project Ideas\n\n{ideas_text}\n\n---\n*Generated by PromptX Idea Generator*"
-            
-            return JsonResponse({
-                'success': True,
-                'type': 'ideas',
-                'original': prompt,
-                'enhanced': enhanced,
-                'category': result.category,
-                'total_ideas': result.total_ideas,
-                'ideas': result.ideas,
-                'model': 'local_generator',
-                'classification': {'category': 'idea', 'confidence': 1.0},
-                'original_score': score_prompt(prompt),
-                'enhanced_score': score_prompt(enhanced),
-                'improvement': 0,
-            })
+        yield 'plan', {'prompt': welcome_prompt, 'max_tokens': 600, 'respond': respond, 'route': 'greeting'}
+        return
 
-        # ── 2. URL in prompt → deep multi-page scrape + web search ──────────
-        urls_in_prompt = _extract_urls(prompt)
-        if urls_in_prompt:
-            url = urls_in_prompt[0]
-            logger.info(f"URL detected in prompt, deep crawling: {url}")
-
-            from urllib.parse import urlparse
-            domain = urlparse(url).netloc.replace('www.', '')
-            site_name = domain.split('.')[0].capitalize()
-
-            crawl = scrape_website_deep(url, max_pages=6, chars_per_page=4000)
-
-            # Also run web searches for tech stack info
-            search_results = web_search(f"{site_name} {domain} tech stack API features", max_results=4)
-            search_text = '\n'.join(
-                f"[{r['title']}] {r['url']}\n{r['snippet']}"
-                for r in search_results
-            ) if search_results else '(no additional search results)'
-
-            if crawl['success']:
-                pages_list = '\n'.join(f"  • {p['title']} — {p['url']}" for p in crawl['pages'])
-                url_analysis_prompt = build_website_analysis_prompt(
-                    prompt, site_name, url,
-                    crawl['pages_scraped'], crawl['total_chars'],
-                    pages_list, crawl['combined_text'][:28000], search_text
-                )
-                result = generate_with_fallback(url_analysis_prompt, max_tokens=8000, preferred_model=model_arg, api_key=api_key)
-                classification = classify_prompt(prompt)
-                return JsonResponse({
+    # ── 1.5. Idea generation request → generate ideas ───────────────────
+    if _needs_ideas(prompt):
+        logger.info(f"Idea generation triggered for: {prompt[:80]}...")
+        from enhancer.core.idea_generator import IdeaGenerator
+        generator = IdeaGenerator()
+        result = generator.generate(prompt, quantity=5)
+        
+        # Build a comprehensive response with AI enhancement
+        ideas_text = "\n\n".join([
+            f"## {i+1}. {idea.get('title', 'Untitled')}\n"
+            f"**Description:** {idea.get('description', 'N/A')}\n"
+            + (f"**Market Size:** {idea.get('market_size', '')}\n" if idea.get('market_size') else "")
+            + (f"**Revenue Potential:** {idea.get('revenue_potential', idea.get('income_potential', ''))}\n" if idea.get('revenue_potential') or idea.get('income_potential') else "")
+            + (f"**Startup Cost:** {idea.get('startup_cost', '')}\n" if idea.get('startup_cost') else "")
+            + (f"**Time to Revenue:** {idea.get('time_to_revenue', '')}\n" if idea.get('time_to_revenue') else "")
+            + (f"**Difficulty:** {idea.get('difficulty', '')}\n" if idea.get('difficulty') else "")
+            + (f"**Skills Needed:** {', '.join(idea.get('skills_needed', []))}\n" if idea.get('skills_needed') else "")
+            + (f"**Tech Stack:** {', '.join(idea.get('tech_stack', []))}\n" if idea.get('tech_stack') else "")
+            + (f"**Features:** {', '.join(idea.get('features', []))}\n" if idea.get('features') else "")
+            + (f"**Use Cases:** {', '.join(idea.get('use_cases', []))}\n" if idea.get('use_cases') else "")
+            + (f"**Tools Needed:** {idea.get('tools_needed', '')}\n" if idea.get('tools_needed') else "")
+            + (f"**Time Investment:** {idea.get('time_investment', '')}\n" if idea.get('time_investment') else "")
+            for i, idea in enumerate(result.ideas)
+        ])
+        
+        enhanced = f"# 💡 Business & Project Ideas\n\n{ideas_text}\n\n---\n*Generated by PromptX Idea Generator*"
+        
+        yield 'plan', {'response': {
+            'success': True,
+            'type': 'ideas',
+            'original': prompt,
+            'enhanced': enhanced,
+            'category': result.category,
+            'total_ideas': result.total_ideas,
+            'ideas': result.ideas,
+            'model': 'local_generator',
+            'classification': {'category': 'idea', 'confidence': 1.0},
+            'original_score': score_prompt(prompt),
+            'enhanced_score': score_prompt(enhanced),
+            'improvement': 0,
+        }}
+        return
+
+    # ── 2. URL in prompt → deep multi-page scrape + web search ──────────
+    urls_in_prompt = _extract_urls(prompt)
+    if urls_in_prompt:
+        url = urls_in_prompt[0]
+        logger.info(f"URL detected in prompt, deep crawling: {url}")
+
+        from urllib.parse import urlparse
+        domain = urlparse(url).netloc.replace('www.', '')
+        site_name = domain.split('.')[0].capitalize()
+
+        yield 'status', {'step': 0, 'message': f"Connecting to {domain}"}
+        gathering = _gathering_budget(deadline)
+        # Also run web searches for tech stack info, overlapping the crawl
+        search_task = asyncio.ensure_future(aweb_search(f"{site_name} {domain} tech stack API features", max_results=4, deadline=gathering))
+        # A follow-up question about a recently crawled site is answered from its index
+        crawl = await asite_index(url) if follow_up and not force_refresh else None
+        follow_up = crawl is not None
+        if follow_up:
+            yield 'status', {'step': 1, 'message': "Using the indexed pages"}
+        else:
+            yield 'status', {'step': 1, 'message': "Crawling pages"}
+            crawl = await ascrape_website_deep(url, max_pages=6, chars_per_page=4000, deadline=gathering, force_refresh=force_refresh)
+
+        yield 'status', {'step': 2, 'message': "Searching the web"}
+        search_results = await search_task
+        search_text = '\n'.join(
+            f"[{r['title']}] {r['url']}\n{r['snippet']}"
+            for r in search_results
+        ) if search_results else '(no additional search results)'
+
+        yield 'status', {'step': 3, 'message': "Synthesising analysis"}
+        if crawl['success']:
+            pages_list = '\n'.join(f"  • {p['title']} — {p['url']}" for p in crawl['pages'])
+            url_analysis_prompt = build_website_analysis_prompt(
+                prompt, site_name, url,
+                crawl['pages_scraped'], crawl['total_chars'],
+                pages_list, crawl['index'], search_text, SITE_INDEX_BUDGET if follow_up else 7000,
+            )
+
+            def respond(result):
+                return {
                     'success': True,
                     'type': 'url_analysis',
                     'original': prompt,
@@ -407,65 +568,82 @@ def enhance_view(request):
                     'pages_scraped': crawl['pages_scraped'],
                     'total_chars': crawl['total_chars'],
                     'pages': [{'url': p['url'], 'title': p['title']} for p in crawl['pages']],
+                    'crawl_cache': crawl['cache'],
+                    'dedup': crawl['dedup'],
                     'model': result['model'],
-                    'classification': classification,
-                    'original_score': score_prompt(prompt),
-                    'enhanced_score': score_prompt(result['text']),
-                    'improvement': 0,
-                })
-            else:
-                # Crawl failed — use AI knowledge about the URL
-                logger.warning(f"Crawl failed for {url}: {crawl['error']}")
-                fallback_prompt = (
-                    f"The user wants to analyze: {url}\n"
-                    f"Scraping the live content failed ({crawl['error']}) because the site blocks scrapers.\n\n"
-                    f"Web search results:\n{search_text}\n\n"
-                    f"User's message: {prompt}\n\n"
-                    f"Based on the URL, the search results, and your deep internal knowledge about this established platform, provide a COMPLETE expert analysis and technical breakdown.\n"
-                    f"FORMATTING RULE: You MUST use Markdown headers (##) for sections and bullet points for all lists.\n\n"
-                    f"Include exactly these sections:\n\n"
-                    f"## 🌐 1. PLATFORM OVERVIEW\n"
-                    f"- What this product is, core value proposition, and business model\n\n"
-                    f"## ✨ 2. DEEP FEATURE BREAKDOWN\n"
-                    f"List exhaustive features with bullet points. specifically detail:\n"
-                    f"- Core e-commerce/platform features (e.g., Cart, Checkout, Search)\n"
-                    f"- Admin Panel & Dashboard capabilities\n"
-                    f"- Multi-vendor / Seller panel features\n"
-                    f"- User account management & tracking\n\n"
-                    f"## 🏗️ 3. TECHNICAL ARCHITECTURE\n"
-                    f"Break down the tech stack using bullet points:\n"
-                    f"- **Backend:** Tech name (e.g., Node.js, Java, Go) and framework\n"
-                    f"- **Frontend:** (e.g., React, Next.js)\n"
-                    f"- **Databases & Caching:** (e.g., PostgreSQL, Redis)\n"
-                    f"- **Infrastructure & APIs:**\n\n"
-                    f"## 🚀 HOW TO BUILD THIS\n"
-                    f"Provide a step-by-step development phase guide to building a clone of this."
-                )
-                result = generate_with_fallback(fallback_prompt, max_tokens=3000, preferred_model=model_arg, api_key=api_key)
-                return JsonResponse({
-                    'success': True,
-                    'type': 'url_analysis',
-                    'original': prompt,
-                    'enhanced': result['text'],
-                    'url': url,
-                    'page_title': url,
-                    'pages_scraped': 0,
-                    'total_chars': 0,
-                    'pages': [],
-                    'scrape_error': crawl['error'],
-                    'model': result['model'],
+                    'hedge': result.get('hedge'),
                     'classification': classify_prompt(prompt),
                     'original_score': score_prompt(prompt),
                     'enhanced_score': score_prompt(result['text']),
                     'improvement': 0,
-                })
-
-        # ── 3. Complex build/research request → deep research mode ───────────
-        if _needs_deep_research(prompt):
-            logger.info(f"Deep research mode triggered for: {prompt[:80]}...")
+                }
+
+            yield 'plan', {'prompt': url_analysis_prompt, 'max_tokens': 8000, 'respond': respond}
+            return
+
+        # Crawl failed — use AI knowledge about the URL
+        logger.warning(f"Crawl failed for {url}: {crawl['error']}")
+        fallback_prompt = (
+            f"The user wants to analyze: {url}\n"
+            f"Scraping the live content failed ({crawl['error']}) because the site blocks scrapers.\n\n"
+            f"Web search results:\n{search_text}\n\n"
+            f"User's message: {prompt}\n\n"
+            f"Based on the URL, the search results, and your deep internal knowledge about this established platform, provide a COMPLETE expert analysis and technical breakdown.\n"
+            f"FORMATTING RULE: You MUST use Markdown headers (##) for sections and bullet points for all lists.\n\n"
+            f"Include exactly these sections:\n\n"
+            f"## 🌐 1. PLATFORM OVERVIEW\n"
+            f"- What this product is, core value proposition, and business model\n\n"
+            f"## ✨ 2. DEEP FEATURE BREAKDOWN\n"
+            f"List exhaustive features with bullet points. specifically detail:\n"
+            f"- Core e-commerce/platform features (e.g., Cart, Checkout, Search)\n"
+            f"- Admin Panel & Dashboard capabilities\n"
+            f"- Multi-vendor / Seller panel features\n"
+            f"- User account management & tracking\n\n"
+            f"## 🏗️ 3. TECHNICAL ARCHITECTURE\n"
+            f"Break down the tech stack using bullet points:\n"
+            f"- **Backend:** Tech name (e.g., Node.js, Java, Go) and framework\n"
+            f"- **Frontend:** (e.g., React, Next.js)\n"
+            f"- **Databases & Caching:** (e.g., PostgreSQL, Redis)\n"
+            f"- **Infrastructure & APIs:**\n\n"
+            f"## 🚀 HOW TO BUILD THIS\n"
+            f"Provide a step-by-step development phase guide to building a clone of this."
+        )
 
-            # Pass 1: Analyze the request and extract structured requirements
-            analysis_prompt = f"""You are a senior technical analyst. Analyze this request and extract:
+        def respond(result):
+            return {
+                'success': True,
+                'type': 'url_analysis',
+                'original': prompt,
+                'enhanced': result['text'],
+                'url': url,
+                'page_title': url,
+                'pages_scraped': 0,
+                'total_chars': 0,
+                'pages': [],
+                'scrape_error': crawl['error'],
+                'model': result['model'],
+                'hedge': result.get('hedge'),
+                'classification': classify_prompt(prompt),
+                'original_score': score_prompt(prompt),
+                'enhanced_score': score_prompt(result['text']),
+                'improvement': 0,
+            }
+
+        yield 'plan', {'prompt': fallback_prompt, 'max_tokens': 3000, 'respond': respond}
+        return
+
+    # ── 3. Complex build/research request → deep research mode ───────────
+    if _needs_deep_research(prompt):
+        logger.info(f"Deep research mode triggered for: {prompt[:80]}...")
+        near = await _near_duplicate_response('deep_research', prompt, model_arg, api_key)
+        if near:
+            yield 'plan', {'response': near}
+            return
+
+        # Pass 1: Analyze the request and extract structured requirements
+        # (optional: skipped when it would eat into the final call's reserve)
+        yield 'status', {'step': 0, 'message': "Analysing the request"}
+        analysis_prompt = f"""You are a senior technical analyst. Analyze this request and extract:
 1. The core product/system being requested
 2. Key features mentioned (explicit and implied)
 3. Target users
@@ -476,21 +654,29 @@ Request: "{prompt}"
 
 Respond in 3-5 sentences, very concisely. This is an internal analysis step."""
 
-            analysis_result = generate_with_fallback(analysis_prompt, max_tokens=400, preferred_model=model_arg, api_key=api_key)
-            analysis_text = analysis_result['text']
-
-            # Pass 2: Generate the full deep-dive answer using the analysis
-            deep_prompt = (
-                f"{DEEP_RESEARCH_PROMPT}\n\n"
-                f"═══════════════════════════════════════\n"
-                f"USER REQUEST:\n{prompt}\n\n"
-                f"INTERNAL ANALYSIS:\n{analysis_text}\n"
-                f"═══════════════════════════════════════\n\n"
-                f"Now provide the complete, exhaustive expert answer covering ALL 12 sections above. "
-                f"Be extremely detailed. Do not skip any section. Minimum 2000 words."
-            )
+        analysis_text = '(skipped: not enough time left)'
+        if deadline.allows(2 * GENERATION_RESERVE):
+            try:
+                analysis_result = await agenerate_with_fallback(analysis_prompt, max_tokens=400, preferred_model=model_arg, api_key=api_key, deadline=_gathering_budget(deadline))
+                analysis_text = analysis_result['text']
+            except DeadlineExceededError:
+                deadline.skip('analysis', 'analysis pass ran out of time')
+        else:
+            deadline.skip('analysis', 'not enough time left')
+
+        # Pass 2: Generate the full deep-dive answer using the analysis
+        yield 'status', {'step': 1, 'message': "Writing the deep-dive answer"}
+        deep_prompt = (
+            f"{DEEP_RESEARCH_PROMPT}\n\n"
+            f"═══════════════════════════════════════\n"
+            f"USER REQUEST:\n{prompt}\n\n"
+            f"INTERNAL ANALYSIS:\n{analysis_text}\n"
+            f"═══════════════════════════════════════\n\n"
+            f"Now provide the complete, exhaustive expert answer covering ALL 12 sections above. "
+            f"Be extremely detailed. Do not skip any section. Minimum 2000 words."
+        )
 
-            result = generate_with_fallback(deep_prompt, max_tokens=8000, preferred_model=model_arg, api_key=api_key)
+        def respond(result):
             enhanced = result['text']
             model_used = result['model']
 
@@ -499,7 +685,7 @@ Respond in 3-5 sentences, very concisely. This is an internal analysis step."""
             classification = classify_prompt(prompt)
 
             logger.info(f"Deep research completed for [{classification['category']}] via {model_used}")
-            return JsonResponse({
+            return {
                 'success': True,
                 'type': 'url_analysis',  # We send this as url_analysis to reuse the same gorgeous UI template
                 'original': prompt,
@@ -516,38 +702,47 @@ Respond in 3-5 sentences, very concisely. This is an internal analysis step."""
                 'enhanced_score': enhanced_score,
                 'improvement': round(enhanced_score['total'] - original_score['total'], 2),
                 'model': model_used,
-            })
-
-        # ── 4. Normal prompt enhancement ─────────────────────────────────────
-        classification = classify_prompt(prompt)
-        original_score = score_prompt(prompt)
-
-        category_hints = {
-            'code':      "Pay special attention to: language/framework specification, input/output types, error handling, edge cases, and code style requirements.",
-            'blog':      "Pay special attention to: target audience, SEO keywords, tone of voice, word count, structure (intro/body/conclusion), and call-to-action.",
-            'business':  "Pay special attention to: stakeholder audience, business objective, key metrics, timeline, and professional tone.",
-            'academic':  "Pay special attention to: research question, methodology, citation style, academic tone, and argument structure.",
-            'creative':  "Pay special attention to: genre, narrative voice, character depth, world-building details, and emotional tone.",
-            'data':      "Pay special attention to: data format, analysis method, visualization type, statistical requirements, and output format.",
-            'assistant': "Pay special attention to: clarity of the question, expected depth of answer, format of response, and audience expertise level.",
-        }
-        category = classification.get('category', 'general')
-        hint = category_hints.get(category, "Pay special attention to clarity, specificity, and actionable detail.")
-
-        full_prompt = (
-            f"{MASTER_PROMPT}\n\n"
-            f"Category detected: {category.upper()}\n"
-            f"Category-specific guidance: {hint}\n\n"
-            f"User prompt to enhance:\n{prompt}"
-        )
+                'hedge': result.get('hedge'),
+            }
+
+        yield 'plan', {'prompt': deep_prompt, 'max_tokens': 8000, 'respond': respond, 'route': 'deep_research'}
+        return
+
+    # ── 4. Normal prompt enhancement ─────────────────────────────────────
+    near = await _near_duplicate_response('enhancement', prompt, model_arg, api_key)
+    if near:
+        yield 'plan', {'response': near}
+        return
+
+    classification = classify_prompt(prompt)
+    original_score = score_prompt(prompt)
+
+    category_hints = {
+        'code':      "Pay special attention to: language/framework specification, input/output types, error handling, edge cases, and code style requirements.",
+        'blog':      "Pay special attention to: target audience, SEO keywords, tone of voice, word count, structure (intro/body/conclusion), and call-to-action.",
+        'business':  "Pay special attention to: stakeholder audience, business objective, key metrics, timeline, and professional tone.",
+        'academic':  "Pay special attention to: research question, methodology, citation style, academic tone, and argument structure.",
+        'creative':  "Pay special attention to: genre, narrative voice, character depth, world-building details, and emotional tone.",
+        'data':      "Pay special attention to: data format, analysis method, visualization type, statistical requirements, and output format.",
+        'assistant': "Pay special attention to: clarity of the question, expected depth of answer, format of response, and audience expertise level.",
+    }
+    category = classification.get('category', 'general')
+    hint = category_hints.get(category, "Pay special attention to clarity, specificity, and actionable detail.")
+
+    full_prompt = (
+        f"{MASTER_PROMPT}\n\n"
+        f"Category detected: {category.upper()}\n"
+        f"Category-specific guidance: {hint}\n\n"
+        f"User prompt to enhance:\n{prompt}"
+    )
 
-        result = generate_with_fallback(full_prompt, max_tokens=2000, preferred_model=model_arg, api_key=api_key)
+    def respond(result):
         enhanced = result['text']
         model_used = result['model']
         enhanced_score = score_prompt(enhanced)
 
-        logger.info(f"Enhanced [{category}] prompt from {_get_client_ip(request)} via {model_used}")
-        return JsonResponse({
+        logger.info(f"Enhanced [{category}] prompt from {client_ip} via {model_used}")
+        return {
             'success': True,
             'type': 'enhancement',
             'original': prompt,
@@ -557,8 +752,49 @@ Respond in 3-5 sentences, very concisely. This is an internal analysis step."""
             'enhanced_score': enhanced_score,
             'improvement': round(enhanced_score['total'] - original_score['total'], 2),
             'model': model_used,
-        })
+            'hedge': result.get('hedge'),
+        }
 
+    yield 'plan', {'prompt': full_prompt, 'max_tokens': 2000, 'respond': respond, 'route': 'enhancement'}
+
+
+async def _run_plan(prompt, model_arg, api_key, client_ip='unknown', deadline=None, force_refresh=False, follow_up=False):
+    """Drive _plan_enhancement to completion, ignoring progress events."""
+    plan = None
+    async for kind, value in _plan_enhancement(prompt, model_arg, api_key, client_ip, deadline, force_refresh, follow_up):
+        if kind == 'plan':
+            plan = value
+    return plan
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@async_ratelimit(key='ip', rate='20/m')
+@on_worker_loop
+async def enhance_view(request):
+    """Enhance a prompt using AI — with deep research mode for complex requests"""
+    try:
+        parsed, err = _parse_enhance_request(request)
+        if err:
+            return err
+        prompt, model_arg, api_key, force_refresh, follow_up = parsed
+        deadline = Deadline.for_route('enhance')
+
+        plan = await _run_plan(prompt, model_arg, api_key, _get_client_ip(request), deadline, force_refresh, follow_up)
+        if 'response' in plan:
+            return JsonResponse({**plan['response'], 'budget': deadline.report()})
+
+        result = await agenerate_with_fallback(plan['prompt'], max_tokens=plan['max_tokens'], preferred_model=model_arg, api_key=api_key, deadline=deadline)
+        payload = plan['respond'](result)
+        await _remember_response(plan, prompt, model_arg, api_key, payload)
+        return JsonResponse({**payload, 'budget': deadline.report()})
+
+    except QuotaExceededError as e:
+        logger.warning(f"Enhance quota exceeded: {str(e)}")
+        return _quota_response(e)
+    except DeadlineExceededError as e:
+        logger.warning(f"Enhance ran out of time: {str(e)}")
+        return _deadline_response(e, deadline)
     except Exception as e:
         import traceback
         logger.error(f"Error in enhance endpoint: {str(e)}\n{traceback.format_exc()}")
@@ -568,6 +804,118 @@ Respond in 3-5 sentences, very concisely. This is an internal analysis step."""
         )
 
 
+# ============================================================================
+# STREAMING ENHANCE ENDPOINT (Server-Sent Events)
+# ============================================================================
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _iterate_sync(agen):
+    """
+    Drive an async generator from sync code on the worker loop.
+    WSGI servers can only consume sync iterators, and Django would buffer
+    an async one in full, which defeats streaming.
+    """
+    async def step():
+        return await agen.__anext__()
+
+    async def close():
+        await agen.aclose()
+
+    try:
+        while True:
+            try:
+                yield run_on_worker_loop(step())
+            except StopAsyncIteration:
+                return
+    finally:
+        run_on_worker_loop(close())
+
+
+async def _enhance_events(prompt, model_arg, api_key, client_ip, force_refresh=False, follow_up=False):
+    """
+    SSE body for /enhance/stream:
+
+      status  {step, message}      slow pre-generation work (crawl, search, analysis pass)
+      model   {model}              the provider that started answering
+      token   {text}               completion chunks as they arrive
+      done    {...}                the same payload /enhance returns, plus 'stream' timings
+      error   {error, status}      failure; status mirrors the JSON endpoint's HTTP code
+    """
+    started = time.perf_counter()
+    deadline = Deadline.for_route('enhance')
+    # A comment line first so proxies and the browser see the stream open immediately
+    yield ": stream open\n\n"
+    try:
+        plan = None
+        async for kind, value in _plan_enhancement(prompt, model_arg, api_key, client_ip, deadline, force_refresh, follow_up):
+            if kind == 'status':
+                yield _sse('status', value)
+            else:
+                plan = value
+
+        if 'response' in plan:
+            yield _sse('done', {**plan['response'], 'budget': deadline.report()})
+            return
+
+        chunks = []
+        model_used = None
+        first_token_at = None
+        generation_started = time.perf_counter()
+        async for kind, value in astream_with_fallback(plan['prompt'], max_tokens=plan['max_tokens'], preferred_model=model_arg, api_key=api_key, deadline=deadline):
+            if kind == 'model':
+                model_used = value
+                yield _sse('model', {'model': value})
+            else:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                chunks.append(value)
+                yield _sse('token', {'text': value})
+
+        payload = plan['respond']({'text': ''.join(chunks).strip(), 'model': model_used})
+        await _remember_response(plan, prompt, model_arg, api_key, payload)
+        payload['stream'] = {
+            'ttft_ms': round((first_token_at - generation_started) * 1000) if first_token_at else None,
+            'total_ms': round((time.perf_counter() - started) * 1000),
+            'chunks': len(chunks),
+        }
+        payload['budget'] = deadline.report()
+        yield _sse('done', payload)
+
+    except QuotaExceededError as e:
+        logger.warning(f"Enhance stream quota exceeded: {str(e)}")
+        yield _sse('error', {'error': str(e), 'status': 429, 'retry_after': e.retry_after, 'success': False})
+    except DeadlineExceededError as e:
+        logger.warning(f"Enhance stream ran out of time: {str(e)}")
+        yield _sse('error', {'error': str(e), 'status': 504, 'budget': deadline.report(), 'success': False})
+    except Exception as e:
+        import traceback
+        logger.error(f"Error in enhance stream: {str(e)}\n{traceback.format_exc()}")
+        yield _sse('error', {'error': f'An internal server error occurred: {str(e)}', 'status': 500, 'success': False})
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@async_ratelimit(key='ip', rate='20/m')
+@on_worker_loop
+async def enhance_stream_view(request):
+    """Streaming /enhance: progress and tokens as Server-Sent Events, scores in the final event."""
+    parsed, err = _parse_enhance_request(request)
+    if err:
+        return err
+    prompt, model_arg, api_key, force_refresh, follow_up = parsed
+
+    events = _enhance_events(prompt, model_arg, api_key, _get_client_ip(request), force_refresh, follow_up)
+    if not isinstance(request, ASGIRequest):
+        events = _iterate_sync(events)
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx: don't buffer the stream
+    return response
+
+
 # ============================================================================
 # DETECT INTENT ENDPOINT
 # ============================================================================
@@ -590,7 +938,8 @@ def detect_intent_view(request):
             logger.warning(f"Intent detection prompt empty or invalid from {_get_client_ip(request)}")
             return JsonResponse({'error': 'Prompt is empty or invalid'}, status=400)
         
-        intent_data = detect_intent(prompt)
+        # detect_intent results are cached and frozen; copy before adding keys
+        intent_data = dict(detect_intent(prompt))
         
         # Optionally apply template
         if data.get('apply_template', False):
@@ -648,8 +997,9 @@ def quality_heatmap_view(request):
 
 @csrf_exempt
 @require_http_methods(["POST"])
-@ratelimit(key='ip', rate='5/m', block=True)
-def ab_test_view(request):
+@async_ratelimit(key='ip', rate='5/m')
+@on_worker_loop
+async def ab_test_view(request):
     """Generate 3 A/B test variations"""
     try:
         data, err = _parse_json(request)
@@ -668,20 +1018,23 @@ def ab_test_view(request):
         preferred_model = data.get('model')
         model_arg = preferred_model if preferred_model in ('gemini_flash', 'gemini_flash_8b', 'gemini_pro', 'nvidia_minimax', 'groq') else None
 
-        variations = generate_ab_variations(prompt, preferred_model=model_arg, api_key=api_key)
+        deadline = Deadline.for_route('ab_test')
+        variations = await agenerate_ab_variations(prompt, preferred_model=model_arg, api_key=api_key, deadline=deadline)
         
         # Optionally include comparison
         if data.get('include_comparison', True):
             comparison = compare_variations(prompt, variations)
             return JsonResponse({
                 'success': True,
-                'data': comparison
+                'data': comparison,
+                'budget': deadline.report(),
             })
         
         logger.info(f"A/B variations generated for {_get_client_ip(request)}")
         return JsonResponse({
             'success': True,
-            'data': {'variations': variations}
+            'data': {'variations': variations},
+            'budget': deadline.report(),
         })
     
     except Exception as e:
@@ -695,14 +1048,24 @@ def ab_test_view(request):
 
 @csrf_exempt
 @require_http_methods(["POST"])
-@ratelimit(key='ip', rate='5/m', block=True)
-def analyze_url_view(request):
+@async_ratelimit(key='ip', rate='5/m')
+@on_worker_loop
+async def analyze_url_view(request):
     """
     Deep website analysis:
     1. Crawls homepage + up to 8 sub-pages (features, pricing, docs, api, etc.)
     2. Runs 3 parallel web searches for tech stack, docs, and APIs used
     3. Synthesises everything into an exhaustive expert report
-    Body: { url, question?, model? }
+    Body: { url, question?, model?, force_refresh?, follow_up?, mode? }
+    A crawl of the same site within the snapshot TTL is served from the
+    crawl cache unless force_refresh; 'crawl_cache' reports which. A
+    question the client marks follow_up, within the site index TTL, skips
+    the crawl: only the page chunks that rank best for it go into a
+    smaller prompt ('crawl_cache': {'snapshot': 'index'}).
+    mode 'map_reduce' summarises every page concurrently with the fastest
+    model (summaries cached by page content) and synthesises over the
+    summaries instead of the page text; 'auto' does so only when the text
+    is over the prompt's content budget. The default is 'single'.
     """
     try:
         data, err = _parse_json(request)
@@ -718,6 +1081,7 @@ def analyze_url_view(request):
         question = sanitize_input(data.get('question', '').strip()) or \
                    'Give a complete deep analysis of this website.'
         model_arg = data.get('model') if data.get('model') in ('gemini_flash', 'gemini_flash_8b', 'gemini_pro', 'nvidia_minimax', 'groq') else None
+        mode = data.get('mode') if data.get('mode') in ('single', 'map_reduce', 'auto') else 'single'
         api_key = request.headers.get('X-API-Key')
 
         from urllib.parse import urlparse
@@ -725,15 +1089,31 @@ def analyze_url_view(request):
         site_name = domain.split('.')[0].capitalize()
 
         logger.info(f"Deep website analysis started: {url}")
+        deadline = Deadline.for_route('analyze_url')
 
-        # ── Step 1: Multi-page crawl ──────────────────────────────────────
-        crawl = scrape_website_deep(url, max_pages=8, chars_per_page=5000)
+        # ── Step 1: Multi-page crawl (or the site's index), with the web searches alongside ──
+        search_queries = [
+            f"{site_name} {domain} tech stack technology used",
+            f"{site_name} {domain} API documentation developers",
+            f"{site_name} {domain} backend architecture how it works",
+        ]
+        gathering = _gathering_budget(deadline)
+        searches = asyncio.ensure_future(aweb_search_many(search_queries, max_results=4, deadline=gathering))
+        force_refresh = bool(data.get('force_refresh'))
+        crawl = await asite_index(url) if data.get('follow_up') and not force_refresh else None
+        follow_up = crawl is not None
+        if not follow_up:
+            crawl = await ascrape_website_deep(
+                url, max_pages=8, chars_per_page=5000, deadline=gathering, force_refresh=force_refresh,
+            )
 
         if not crawl['success']:
+            searches.cancel()
             return JsonResponse({
                 'success': False,
                 'error': f"Could not fetch the website: {crawl['error']}",
                 'url': url,
+                'budget': deadline.report(),
             }, status=422)
 
         pages_summary = '\n'.join(
@@ -741,15 +1121,21 @@ def analyze_url_view(request):
             for p in crawl['pages']
         )
 
-        # ── Step 2: Parallel web searches ────────────────────────────────
-        search_queries = [
-            f"{site_name} {domain} tech stack technology used",
-            f"{site_name} {domain} API documentation developers",
-            f"{site_name} {domain} backend architecture how it works",
-        ]
+        # ── Step 2: Map-reduce mode: summarise every page while the searches finish ──
+        index = SiteIndex(crawl['index'])
+        content_tokens = SITE_INDEX_BUDGET if follow_up else 8750
+        if mode == 'auto':
+            mode = 'map_reduce' if index.tokens() > content_tokens else 'single'
+        summarising = None
+        if mode == 'map_reduce':
+            content_tokens = 8750
+            summarising = asyncio.ensure_future(
+                asummarise_pages(index.page_texts(), api_key=api_key, deadline=_gathering_budget(deadline))
+            )
+
+        # ── Step 3: Collect the web searches (run alongside the crawl) ────
         all_search_results = []
-        for q in search_queries:
-            results = web_search(q, max_results=4)
+        for q, results in zip(search_queries, await searches):
             if results:
                 all_search_results.append({
                     'query': q,
@@ -768,21 +1154,24 @@ def analyze_url_view(request):
                 parts.append(block)
             search_context = '\n\n'.join(parts)
 
-        # ── Step 3: Build the mega-analysis prompt ────────────────────────
+        page_summaries = await summarising if summarising is not None else None
+
+        # ── Step 4: Build the mega-analysis prompt ────────────────────────
         analysis_prompt = build_website_analysis_prompt(
             question, site_name, url,
             crawl['pages_scraped'], crawl['total_chars'],
-            pages_summary, crawl['combined_text'][:35000],
-            search_context if search_context else '(No additional search results available)'
+            pages_summary, crawl['index'],
+            search_context if search_context else '(No additional search results available)',
+            content_tokens, page_summaries,
         )
 
-        result = generate_with_fallback(analysis_prompt, max_tokens=8000, preferred_model=model_arg, api_key=api_key)
+        result = await agenerate_with_fallback(analysis_prompt, max_tokens=8000, preferred_model=model_arg, api_key=api_key, deadline=deadline)
 
         logger.info(
             f"Deep URL analysis complete: {url} | "
-            f"{crawl['pages_scraped']} pages | "
-            f"{crawl['total_chars']:,} chars | "
-            f"model={result['model']}"
+            f"{crawl['pages_scraped']} pages ({'indexed' if follow_up else 'crawled'}) | "
+            f"{crawl['total_chars']:,} chars ({crawl['dedup']['chars_removed']:,} repeated removed) | "
+            f"{mode} | model={result['model']}"
         )
 
         return JsonResponse({
@@ -792,11 +1181,27 @@ def analyze_url_view(request):
             'pages_scraped': crawl['pages_scraped'],
             'pages': [{'url': p['url'], 'title': p['title']} for p in crawl['pages']],
             'total_chars': crawl['total_chars'],
+            'crawl_cache': crawl['cache'],
+            'dedup': crawl['dedup'],
             'search_queries': [sr['query'] for sr in all_search_results],
+            'synthesis': {
+                'mode': mode,
+                'pages_summarised': len(page_summaries) if page_summaries is not None else 0,
+                'summary_fallbacks': sum(s['model'] is None for s in page_summaries or ()),
+                'summary_models': dict(Counter(s['model'] or 'extractive' for s in page_summaries or ())),
+            },
             'analysis': result['text'],
             'model': result['model'],
+            'hedge': result.get('hedge'),
+            'budget': deadline.report(),
         })
 
+    except QuotaExceededError as e:
+        logger.warning(f"Analyze-url quota exceeded: {str(e)}")
+        return _quota_response(e)
+    except DeadlineExceededError as e:
+        logger.warning(f"Analyze-url ran out of time: {str(e)}")
+        return _deadline_response(e, deadline)
     except Exception as e:
         logger.error(f"Error in analyze-url endpoint: {str(e)}")
         return JsonResponse({'error': 'An internal server error occurred.', 'success': False}, status=500)
@@ -808,8 +1213,9 @@ def analyze_url_view(request):
 
 @csrf_exempt
 @require_http_methods(["POST"])
-@ratelimit(key='ip', rate='15/m', block=True)
-def web_search_view(request):
+@async_ratelimit(key='ip', rate='15/m')
+@on_worker_loop
+async def web_search_view(request):
     """
     Search the web and return AI-synthesized results.
     Body: { query: string, model?: string }
@@ -827,13 +1233,15 @@ def web_search_view(request):
         api_key = request.headers.get('X-API-Key')
 
         logger.info(f"Web search: {query}")
-        results = web_search(query, max_results=6)
+        deadline = Deadline.for_route('web_search')
+        results = await aweb_search(query, max_results=6, deadline=_gathering_budget(deadline))
 
         if not results:
             return JsonResponse({
                 'success': False,
                 'error': 'No search results found. Try a different query.',
                 'results': [],
+                'budget': deadline.report(),
             }, status=422)
 
         # Format results for AI synthesis
@@ -864,7 +1272,7 @@ Any important context, caveats, or related information worth knowing.
 
 Be factual, specific, and cite which results support each point."""
 
-        result = generate_with_fallback(synthesis_prompt, max_tokens=2000, preferred_model=model_arg, api_key=api_key)
+        result = await agenerate_with_fallback(synthesis_prompt, max_tokens=2000, preferred_model=model_arg, api_key=api_key, deadline=deadline)
 
         return JsonResponse({
             'success': True,
@@ -872,9 +1280,17 @@ Be factual, specific, and cite which results support each point."""
             'raw_results': results,
             'synthesis': result['text'],
             'model': result['model'],
+            'hedge': result.get('hedge'),
             'result_count': len(results),
+            'budget': deadline.report(),
         })
 
+    except QuotaExceededError as e:
+        logger.warning(f"Web-search quota exceeded: {str(e)}")
+        return _quota_response(e)
+    except DeadlineExceededError as e:
+        logger.warning(f"Web-search ran out of time: {str(e)}")
+        return _deadline_response(e, deadline)
     except Exception as e:
         logger.error(f"Error in web-search endpoint: {str(e)}")
         return JsonResponse({'error': 'An internal server error occurred.', 'success': False}, status=500)
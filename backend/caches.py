@@ -0,0 +1,722 @@
+"""
+PromptX caches - frozen in-memory result caches, the shared on-disk response store, near-duplicate prompts
+"""
+import os
+import re
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import copy
+import json
+import sys
+import random
+import struct
+import asyncio
+import time
+import hashlib
+import threading
+import inspect
+import sqlite3
+import zlib
+from functools import wraps
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+# ============================================================================
+# FROZEN RESULTS & IN-MEMORY RESULT CACHES
+# ============================================================================
+
+class FrozenDict(dict):
+    """A read-only dict. Still a dict, so JsonResponse/json.dumps take it as is."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("cached results are read-only; thaw() or dict() them before modifying")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(value):
+    """Recursively turn dicts into FrozenDicts and lists into tuples."""
+    if isinstance(value, dict):
+        return value if isinstance(value, FrozenDict) else FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+def thaw(value):
+    """Mutable deep copy of a frozen value."""
+    if isinstance(value, dict):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(v) for v in value]
+    return value
+
+
+def _deep_sizeof(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_deep_sizeof(k) + _deep_sizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(_deep_sizeof(v) for v in value)
+    return size
+
+
+class _LeaderCancelled(Exception):
+    """Handed to a cancelled leader's followers, which then retry the call."""
+
+
+class _SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller (the
+    leader) does the work, later callers wait on the leader's future.
+    A concurrent.futures.Future lets sync threads and coroutines on any
+    loop follow the same leader. A cancelled leader only releases the
+    key: its followers retry, and one of them leads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def join(self, key):
+        """(future, is_leader) for key."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def run(self, key, func, *args, **kwargs):
+        """func(*args, **kwargs), or the in-flight leader's result for key."""
+        while True:
+            future, leader = self.join(key)
+            if leader:
+                break
+            try:
+                return future.result(), False
+            except _LeaderCancelled:
+                continue
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result)
+        return result, True
+
+    async def arun(self, key, func, *args, **kwargs):
+        """Async run(): func is a coroutine function."""
+        while True:
+            future, leader = self.join(key)
+            if leader:
+                break
+            try:
+                # shield: a cancelled follower must not cancel the shared future
+                return await asyncio.shield(asyncio.wrap_future(future)), False
+            except _LeaderCancelled:
+                continue
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            self.finish(key, future, error=_LeaderCancelled())
+            raise
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result)
+        return result, True
+
+
+class FrozenLRUCache:
+    """Thread-safe LRU cache of frozen results with single-flight misses.
+
+    Values are frozen (FrozenDict, tuples) when stored, so a hit hands out
+    the cached object itself with no copying; callers that want to modify
+    a result must thaw() it first. Concurrent misses on the same arguments
+    run the function once. Capacity is a byte budget measured with
+    sys.getsizeof over the frozen value.
+
+    Works on coroutine functions too. Decorating a sync function and its
+    async twin with the same instance makes them share one cache.
+    """
+    _MISS = object()
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.cache = OrderedDict()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._flight = _SingleFlight()
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return self._MISS
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _store(self, key, result):
+        value = freeze(result)
+        size = _deep_sizeof(value)
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            old = self.cache.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.cache[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.cache.popitem(last=False)
+                self.bytes -= evicted
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self.cache),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self._flight.coalesced,
+            }
+
+    def __call__(self, func):
+        if asyncio.iscoroutinefunction(func):
+            async def compute(key, args, kwargs):
+                return self._store(key, await func(*args, **kwargs))
+
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                key = (args, frozenset(kwargs.items()))
+                cached = self._lookup(key)
+                if cached is not self._MISS:
+                    return cached
+                result, _ = await self._flight.arun(key, compute, key, args, kwargs)
+                return result
+            return async_wrapper
+
+        def compute(key, args, kwargs):
+            return self._store(key, func(*args, **kwargs))
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (args, frozenset(kwargs.items()))
+            cached = self._lookup(key)
+            if cached is not self._MISS:
+                return cached
+            result, _ = self._flight.run(key, compute, key, args, kwargs)
+            return result
+        return wrapper
+
+
+# ============================================================================
+# RESPONSE STORE
+# ============================================================================
+
+CACHE_DIR = os.getenv('PROMPTX_CACHE_DIR') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '.promptx_cache'
+)
+
+
+def _sqlite_connection(local, path, schema):
+    """This thread's connection to path (reopened after fork), schema applied on open."""
+    conn = getattr(local, 'conn', None)
+    if conn is None or local.pid != os.getpid():
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = sqlite3.connect(path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in schema:
+            conn.execute(statement)
+        local.conn = conn
+        local.pid = os.getpid()
+    return conn
+
+
+def _hash_key(api_key):
+    """Stable, non-reversible id for an API key (never keep raw keys as dict keys)."""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+def _normalise_prompt(prompt):
+    """
+    Prompt with runs of spaces inside each line collapsed and blank ends
+    trimmed, for cache keys only. Line breaks and leading indentation are
+    kept: they carry meaning in code and lists.
+    """
+    if not isinstance(prompt, str):
+        return prompt
+    lines = []
+    for line in prompt.splitlines():
+        body = line.lstrip(' \t')
+        lines.append(line[:len(line) - len(body)] + ' '.join(body.split()) if body else '')
+    return '\n'.join(lines).strip('\n')
+
+
+class ResponseStore:
+    """
+    Content-addressed LLM response cache in a SQLite file that every
+    gunicorn worker opens, so a response generated by one worker (or before
+    a restart) is served by all of them.
+
+    Keys hash the call's arguments (less any request deadline, and any
+    `unkeyed` ones the other arguments already identify) with the
+    prompt whitespace-normalised and
+    the API key replaced by _hash_key(), so raw keys never reach the disk.
+    Values are zlib-compressed JSON. Entries expire after ttl seconds and
+    the least recently used are evicted once the file holds max_bytes.
+
+    Identical misses in one process are coalesced (single flight), so only
+    the leader calls the provider; followers get a deep copy of its result.
+    Decorating a sync function and its async twin with the same instance
+    makes them share entries, as with FrozenLRUCache. Store failures are
+    logged and treated as misses; they never fail the request.
+    """
+
+    _MISS = object()
+    _PRUNE_EVERY = 32
+    # Per-request arguments that don't change the answer
+    UNKEYED = ('deadline',)
+
+    def __init__(self, name, path=None, ttl=86400, max_bytes=256 * 1024 * 1024, cacheable=None, unkeyed=()):
+        self.name = name
+        self.unkeyed = self.UNKEYED + tuple(unkeyed)
+        self.path = path or os.path.join(CACHE_DIR, 'responses.sqlite3')
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.cacheable = cacheable or (lambda result: not (isinstance(result, dict) and result.get('success') is False))
+        self._local = threading.local()
+        self._flight = _SingleFlight()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.errors = 0
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS responses ('
+        ' key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,'
+        ' expires_at REAL NOT NULL, accessed_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)',
+    )
+
+    def _conn(self):
+        return _sqlite_connection(self._local, self.path, self.SCHEMA)
+
+    def _count(self, field):
+        with self._stats_lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def make_key(self, func, args, kwargs):
+        bound = inspect.signature(func).bind(*args, **kwargs)
+        bound.apply_defaults()
+        params = {k: v for k, v in bound.arguments.items() if k not in self.unkeyed}
+        if 'prompt' in params:
+            params['prompt'] = _normalise_prompt(params['prompt'])
+        if 'api_key' in params:
+            params['api_key'] = _hash_key(params['api_key']) if params['api_key'] else None
+        raw = json.dumps([self.name, sorted(params.items())], default=repr, ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        try:
+            now = time.time()
+            conn = self._conn()
+            row = conn.execute(
+                'SELECT value FROM responses WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+            if row is None:
+                self._count('misses')
+                return self._MISS
+            conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+            value = json.loads(zlib.decompress(row[0]))
+        except (sqlite3.Error, ValueError, zlib.error) as e:
+            print(f"Response store read failed: {e}")
+            self._count('errors')
+            return self._MISS
+        self._count('hits')
+        return value
+
+    def set(self, key, result):
+        if not self.cacheable(result):
+            return
+        try:
+            blob = zlib.compress(json.dumps(result, ensure_ascii=False).encode('utf-8'))
+            now = time.time()
+            conn = self._conn()
+            conn.execute(
+                'INSERT OR REPLACE INTO responses (key, value, size, expires_at, accessed_at)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (key, blob, len(blob), now + self.ttl, now),
+            )
+            self._count('writes')
+            if self.writes % self._PRUNE_EVERY == 0:
+                self.prune()
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print(f"Response store write failed: {e}")
+            self._count('errors')
+
+    def prune(self):
+        """Drop expired entries, then least recently used ones until under max_bytes."""
+        conn = self._conn()
+        conn.execute('DELETE FROM responses WHERE expires_at <= ?', (time.time(),))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        doomed = []
+        for key, size in conn.execute('SELECT key, size FROM responses ORDER BY accessed_at'):
+            doomed.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany('DELETE FROM responses WHERE key = ?', doomed)
+
+    def stats(self):
+        with self._stats_lock:
+            counters = {'hits': self.hits, 'misses': self.misses, 'writes': self.writes, 'errors': self.errors}
+        try:
+            entries, size = self._conn().execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses'
+            ).fetchone()
+        except sqlite3.Error:
+            entries, size = None, None
+        return {
+            'entries': entries, 'bytes': size, 'max_bytes': self.max_bytes,
+            'coalesced': self._flight.coalesced, **counters,
+        }
+
+    def __call__(self, func):
+        if asyncio.iscoroutinefunction(func):
+            async def compute(key, args, kwargs):
+                result = await func(*args, **kwargs)
+                await asyncio.to_thread(self.set, key, result)
+                return result
+
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                key = self.make_key(func, args, kwargs)
+                cached = await asyncio.to_thread(self.get, key)
+                if cached is not self._MISS:
+                    return cached
+                result, leader = await self._flight.arun(key, compute, key, args, kwargs)
+                return result if leader else copy.deepcopy(result)
+            return async_wrapper
+
+        def compute(key, args, kwargs):
+            result = func(*args, **kwargs)
+            self.set(key, result)
+            return result
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = self.make_key(func, args, kwargs)
+            cached = self.get(key)
+            if cached is not self._MISS:
+                return cached
+            result, leader = self._flight.run(key, compute, key, args, kwargs)
+            return result if leader else copy.deepcopy(result)
+        return wrapper
+
+
+def _response_store(name, ttl=None, **kwargs):
+    return ResponseStore(
+        name,
+        path=os.getenv('PROMPTX_RESPONSE_STORE') or None,
+        ttl=ttl if ttl is not None else int(os.getenv('PROMPTX_RESPONSE_TTL', 86400)),
+        max_bytes=int(os.getenv('PROMPTX_RESPONSE_STORE_MB', 256)) * 1024 * 1024,
+        **kwargs,
+    )
+
+
+# ============================================================================
+# NEAR-DUPLICATE CACHE
+# ============================================================================
+
+_NON_WORD_RE = re.compile(r'[^\w\s]+')
+_POLITENESS_RE = re.compile(r'\b(?:please|pls|plz|kindly|thanks|thank you|thx)\b')
+
+# Minimum estimated Jaccard similarity for reusing an answer, per /enhance
+# route. Greetings are interchangeable; elsewhere one changed word ("token
+# bucket" / "leaky bucket") is a different question, so a match must also
+# differ only in filler words.
+NEAR_DUPLICATE_THRESHOLDS = {
+    'greeting': float(os.getenv('PROMPTX_NEAR_DUP_GREETING', 0.5)),
+    'enhancement': float(os.getenv('PROMPTX_NEAR_DUP_ENHANCEMENT', 0.95)),
+    'deep_research': float(os.getenv('PROMPTX_NEAR_DUP_DEEP_RESEARCH', 0.97)),
+}
+_INTERCHANGEABLE_ROUTES = {'greeting'}
+_FILLER_WORDS = frozenset(
+    'a an the this that these those some any of to for in on at by with from about as and or '
+    'is are be was were do does can could would will should me my i we our you your it its just also'.split()
+)
+
+
+def canonicalise_prompt(prompt):
+    """Lower-case, punctuation- and politeness-free form of a prompt."""
+    text = _NON_WORD_RE.sub(' ', prompt.lower())
+    text = _POLITENESS_RE.sub(' ', text)
+    return ' '.join(text.split())
+
+
+def _differs_only_in_filler(canonical, other):
+    """True when the word sets of two canonical prompts differ by filler words alone."""
+    return set(canonical.split()) ^ set(other.split()) <= _FILLER_WORDS
+
+
+class MinHasher:
+    """
+    MinHash signatures over word shingles, split into LSH bands.
+
+    Two prompts share a band bucket with probability 1 - (1 - s^rows)^bands
+    for Jaccard similarity s, so with the defaults (16 bands of 4 rows)
+    pairs above ~0.6 are almost always found as candidates.
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, num_perm=64, bands=16, shingle_size=3, seed=1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self._perms = [(rng.randrange(1, self._PRIME), rng.randrange(self._PRIME)) for _ in range(num_perm)]
+
+    def shingles(self, canonical):
+        words = canonical.split()
+        k = self.shingle_size
+        if len(words) <= k:
+            return {canonical} if canonical else set()
+        return {' '.join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+    def signature(self, canonical):
+        """num_perm minimum hashes, or None for an empty prompt."""
+        hashes = [
+            int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'big')
+            for s in self.shingles(canonical)
+        ]
+        if not hashes:
+            return None
+        p = self._PRIME
+        return tuple(min((a * h + b) % p for h in hashes) for a, b in self._perms)
+
+    def buckets(self, signature):
+        return [
+            f"{band}:{hashlib.blake2b(repr(signature[band * self.rows:(band + 1) * self.rows]).encode(), digest_size=8).hexdigest()}"
+            for band in range(self.bands)
+        ]
+
+    @staticmethod
+    def similarity(a, b):
+        return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+class NearDuplicateIndex:
+    """
+    Bounded MinHash/LSH index of answered prompts, in a SQLite file shared
+    by every worker. lookup() returns the stored payload of the most
+    similar earlier prompt on the same route and scope (model preference
+    and hashed API key) when its similarity clears the route's threshold.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS near_entries ('
+        ' id INTEGER PRIMARY KEY, route TEXT NOT NULL, scope TEXT NOT NULL,'
+        ' canonical TEXT NOT NULL, signature BLOB NOT NULL, value BLOB NOT NULL,'
+        ' expires_at REAL NOT NULL, accessed_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS near_entries_accessed ON near_entries (accessed_at)',
+        'CREATE INDEX IF NOT EXISTS near_entries_canonical ON near_entries (route, scope, canonical)',
+        'CREATE TABLE IF NOT EXISTS near_bands (entry_id INTEGER NOT NULL, route TEXT NOT NULL,'
+        ' scope TEXT NOT NULL, bucket TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS near_bands_lookup ON near_bands (route, scope, bucket)',
+        'CREATE INDEX IF NOT EXISTS near_bands_entry ON near_bands (entry_id)',
+    )
+
+    def __init__(self, path=None, max_entries=5000, ttl=86400, thresholds=None, hasher=None):
+        self.path = path or os.path.join(CACHE_DIR, 'near_duplicates.sqlite3')
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.thresholds = NEAR_DUPLICATE_THRESHOLDS if thresholds is None else thresholds
+        self.hasher = hasher or MinHasher()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+
+    def _conn(self):
+        return _sqlite_connection(self._local, self.path, self.SCHEMA)
+
+    def _count(self, field):
+        with self._stats_lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    @staticmethod
+    def scope(preferred_model=None, api_key=None):
+        return f"{preferred_model or 'auto'}:{_hash_key(api_key) if api_key else 'default'}"
+
+    def _pack(self, signature):
+        return struct.pack(f'>{len(signature)}Q', *signature)
+
+    def _unpack(self, blob):
+        return struct.unpack(f'>{len(blob) // 8}Q', blob)
+
+    def lookup(self, route, prompt, scope):
+        """(payload, similarity) of the closest match above route's threshold, or None."""
+        threshold = self.thresholds.get(route)
+        if threshold is None or threshold > 1:
+            return None
+        canonical = canonicalise_prompt(prompt)
+        signature = self.hasher.signature(canonical)
+        if signature is None:
+            return None
+        strict = route not in _INTERCHANGEABLE_ROUTES
+        buckets = self.hasher.buckets(signature)
+        try:
+            now = time.time()
+            conn = self._conn()
+            rows = conn.execute(
+                'SELECT DISTINCT e.id, e.canonical, e.signature, e.value FROM near_bands b'
+                ' JOIN near_entries e ON e.id = b.entry_id'
+                ' WHERE b.route = ? AND b.scope = ? AND e.expires_at > ?'
+                f" AND b.bucket IN ({','.join('?' * len(buckets))})",
+                (route, scope, now, *buckets),
+            ).fetchall()
+            best = None
+            for entry_id, other, blob, value in rows:
+                similarity = self.hasher.similarity(signature, self._unpack(blob))
+                if similarity < threshold or (best is not None and similarity <= best[0]):
+                    continue
+                if strict and not _differs_only_in_filler(canonical, other):
+                    continue
+                best = (similarity, entry_id, value)
+            if best is None:
+                self._count('misses')
+                return None
+            conn.execute('UPDATE near_entries SET accessed_at = ? WHERE id = ?', (now, best[1]))
+            payload = json.loads(zlib.decompress(best[2]))
+        except (sqlite3.Error, ValueError, zlib.error) as e:
+            print(f"Near-duplicate lookup failed: {e}")
+            self._count('errors')
+            return None
+        self._count('hits')
+        return payload, best[0]
+
+    def add(self, route, prompt, scope, payload):
+        canonical = canonicalise_prompt(prompt)
+        signature = self.hasher.signature(canonical)
+        if signature is None or route not in self.thresholds:
+            return
+        try:
+            blob = zlib.compress(json.dumps(payload, ensure_ascii=False).encode('utf-8'))
+            now = time.time()
+            conn = self._conn()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                for (old_id,) in conn.execute(
+                    'SELECT id FROM near_entries WHERE route = ? AND scope = ? AND canonical = ?',
+                    (route, scope, canonical),
+                ).fetchall():
+                    self._delete(conn, old_id)
+                entry_id = conn.execute(
+                    'INSERT INTO near_entries (route, scope, canonical, signature, value, expires_at, accessed_at)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (route, scope, canonical, self._pack(signature), blob, now + self.ttl, now),
+                ).lastrowid
+                conn.executemany(
+                    'INSERT INTO near_bands (entry_id, route, scope, bucket) VALUES (?, ?, ?, ?)',
+                    [(entry_id, route, scope, bucket) for bucket in self.hasher.buckets(signature)],
+                )
+                self._evict(conn, now)
+            self._count('stores')
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print(f"Near-duplicate store failed: {e}")
+            self._count('errors')
+
+    def _delete(self, conn, entry_id):
+        conn.execute('DELETE FROM near_bands WHERE entry_id = ?', (entry_id,))
+        conn.execute('DELETE FROM near_entries WHERE id = ?', (entry_id,))
+
+    def _evict(self, conn, now):
+        doomed = [row[0] for row in conn.execute('SELECT id FROM near_entries WHERE expires_at <= ?', (now,))]
+        excess = conn.execute('SELECT COUNT(*) FROM near_entries').fetchone()[0] - len(doomed) - self.max_entries
+        if excess > 0:
+            doomed += [row[0] for row in conn.execute(
+                'SELECT id FROM near_entries WHERE expires_at > ? ORDER BY accessed_at LIMIT ?', (now, excess),
+            )]
+        for entry_id in doomed:
+            self._delete(conn, entry_id)
+
+    def stats(self):
+        with self._stats_lock:
+            counters = {'hits': self.hits, 'misses': self.misses, 'stores': self.stores, 'errors': self.errors}
+        try:
+            entries = self._conn().execute('SELECT COUNT(*) FROM near_entries').fetchone()[0]
+        except sqlite3.Error:
+            entries = None
+        return {'entries': entries, 'max_entries': self.max_entries, 'thresholds': dict(self.thresholds), **counters}
+
+
+_near_index = NearDuplicateIndex(
+    path=os.getenv('PROMPTX_NEAR_DUP_STORE') or None,
+    max_entries=int(os.getenv('PROMPTX_NEAR_DUP_MAX_ENTRIES', 5000)),
+    ttl=int(os.getenv('PROMPTX_RESPONSE_TTL', 86400)),
+)
+
+# Per-response fields that describe one delivery, not the answer
+_NEAR_DUP_VOLATILE = ('stream', 'cache', 'similarity')
+
+
+def near_duplicate_lookup(route, prompt, preferred_model=None, api_key=None):
+    """(payload, similarity) answered earlier for a near-identical prompt on route, or None."""
+    return _near_index.lookup(route, prompt, NearDuplicateIndex.scope(preferred_model, api_key))
+
+
+def near_duplicate_store(route, prompt, payload, preferred_model=None, api_key=None):
+    """Remember route's response payload for prompt."""
+    payload = {k: v for k, v in payload.items() if k not in _NEAR_DUP_VOLATILE}
+    _near_index.add(route, prompt, NearDuplicateIndex.scope(preferred_model, api_key), payload)
+
+
+async def anear_duplicate_lookup(route, prompt, preferred_model=None, api_key=None):
+    return await asyncio.to_thread(near_duplicate_lookup, route, prompt, preferred_model, api_key)
+
+
+async def anear_duplicate_store(route, prompt, payload, preferred_model=None, api_key=None):
+    await asyncio.to_thread(near_duplicate_store, route, prompt, payload, preferred_model, api_key)
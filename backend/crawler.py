@@ -0,0 +1,1544 @@
+"""
+PromptX crawler - page scraping, whole-site crawls with their cache and index, web search
+"""
+import os
+import re
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import copy
+import json
+import math
+import asyncio
+import time
+import hashlib
+import threading
+import sqlite3
+import zlib
+import weakref
+import codecs
+import xml.etree.ElementTree as ET
+from collections import Counter
+from html import unescape
+from html.parser import HTMLParser
+from urllib.robotparser import RobotFileParser
+
+from caches import CACHE_DIR, _SingleFlight, _response_store, _sqlite_connection, canonicalise_prompt
+from providers import (
+    DEADLINE_MIN_FETCH, Deadline, _async_limits, _async_pools_lock, _close_with_loop, _timeout,
+    count_tokens, deadline_step, run_on_worker_loop, trim_to_tokens,
+)
+
+
+# ============================================================================
+# WEB SCRAPING & SEARCH
+# ============================================================================
+
+_SCRAPE_HEADERS = {
+    'User-Agent': (
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+        'AppleWebKit/537.36 (KHTML, like Gecko) '
+        'Chrome/120.0.0.0 Safari/537.36'
+    ),
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+}
+
+# Pages worth crawling on any website
+_VALUABLE_PATHS = [
+    '/', '/about', '/about-us', '/features', '/pricing', '/docs',
+    '/documentation', '/api', '/api-docs', '/developers', '/tech',
+    '/blog', '/careers', '/team', '/product', '/solutions',
+    '/how-it-works', '/integrations', '/security', '/enterprise',
+]
+
+
+def _truncate_text(text: str, max_chars: int) -> str:
+    if len(text) > max_chars:
+        text = text[:max_chars] + f'\n[truncated at {max_chars} chars]'
+    return text
+
+
+# Elements whose content is never page text
+_NOISE_TAGS = frozenset({
+    'script', 'style', 'noscript', 'template', 'nav', 'header', 'footer', 'aside',
+    'iframe', 'svg', 'button', 'select', 'textarea',
+})
+# Noise elements holding raw code rather than markup; never restored when left open
+_RAW_TEXT_TAGS = frozenset({'script', 'style'})
+# Elements that start a new line of text
+_BLOCK_TAGS = frozenset({
+    'p', 'div', 'br', 'hr', 'li', 'ul', 'ol', 'dl', 'dt', 'dd', 'table', 'tr', 'td', 'th', 'section',
+    'article', 'main', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'blockquote', 'figcaption',
+})
+
+
+# Markup the extractor tokenises itself before handing a page to html.parser
+_TOKEN_RE = re.compile(r'([^<]+)|<(?:(/?)([a-zA-Z][^\t\n\r\f />\x00]*)([^>]*)>|!--|![a-zA-Z][^>]*>|\?[^>]*>)')
+_QUOTED_ATTRS_RE = re.compile(r'(?:[^"\']|"[^"]*"|\'[^\']*\')*')
+_ATTR_RE = re.compile(r'([^\s=/>]+)(?:\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]*))?')
+_RAW_TEXT_END = {tag: re.compile(rf'</{tag}[\s/>]', re.IGNORECASE) for tag in _RAW_TEXT_TAGS}
+
+
+class _TextExtractor(HTMLParser):
+    """
+    Single-pass, incremental page extractor: feed() it HTML in pieces as
+    it arrives, then read title(), text(), links() and canonical(). Noise
+    elements are skipped with everything inside them (their links still
+    count), the parser decodes every entity, and `chars` counts the text
+    collected so far so a fetch can stop once it has enough.
+
+    A noise element that is never closed (a stray <nav> before <main>)
+    would swallow the rest of the page, so each open one buffers what it
+    skipped; the buffer is dropped when the element closes and restored
+    at </body> or close() when it never does.
+
+    html.parser costs a few microseconds per tag, which made tag-dense
+    pages (pricing tables) slower than the regex chain this replaced. So
+    plain tags, comments and script/style bodies are tokenised here with
+    one regex match each, and the first construct that is not clear-cut
+    (a stray '<', an unbalanced quote in a tag, CDATA) hands the rest of
+    the page to html.parser. Both paths call the same handlers.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._pending = ''  # input not tokenised yet; None once html.parser has the page
+        self._scanned = 0  # how far into _pending a search for the end of a comment / raw text got
+        self._raw_tag = None  # script / style whose body _pending starts with
+        self._noise = []  # [(tag, skipped parts or None)], innermost last
+        self._in_title = False
+        self._title = []
+        self._parts = []
+        self._hrefs = []
+        self._canonical = None
+        self.chars = 0
+
+    def feed(self, data):
+        if self._pending is None:
+            super().feed(data)
+        else:
+            self._pending += data
+            self._tokenise(final=False)
+
+    def _tokenise(self, final):
+        buf, pos, end_of_buf = self._pending, 0, len(self._pending)
+        while pos < end_of_buf:
+            if self._raw_tag:
+                end = _RAW_TEXT_END[self._raw_tag].search(buf, pos + self._scanned)
+                if end is None:
+                    break
+                if end.start() > pos:
+                    self.handle_data(buf[pos:end.start()])
+                pos, self._raw_tag, self._scanned = end.start(), None, 0
+            token = _TOKEN_RE.match(buf, pos)
+            if token is None:
+                if not final and buf.find('>', pos) == -1:
+                    break  # the tag continues in the next piece
+                return self._hand_over(buf[pos:])
+            text, closing, tag, attrs = token.groups()
+            if text is not None:
+                if token.end() == end_of_buf:
+                    # The text may go on in the next piece: hold back only an entity it may cut in two
+                    held = text.rfind('&', max(0, len(text) - 40))
+                    text = text if held == -1 else text[:held]
+                if text:
+                    self.handle_data(unescape(text) if '&' in text else text)
+                pos += len(text)
+                if pos < token.end():
+                    break
+                continue
+            elif tag is not None:
+                if attrs and ('"' in attrs or "'" in attrs) and not _QUOTED_ATTRS_RE.fullmatch(attrs):
+                    return self._hand_over(buf[pos:])  # a quoted '>' or a stray quote
+                if closing:
+                    self.handle_endtag(tag.lower())
+                else:
+                    self._starttag(tag.lower(), attrs)
+            elif buf.startswith('<!--', pos):
+                end = buf.find('-->', pos + 4 + self._scanned)
+                if end == -1:
+                    break
+                pos, self._scanned = end + 3, 0
+                continue
+            pos = token.end()
+        rest = buf[pos:]
+        if final and rest:
+            return self._hand_over(rest)
+        if self._raw_tag or rest.startswith('<!--'):
+            # Only the tail of what was searched can hold the start of the terminator
+            self._scanned = max(0, len(rest) - 12)
+        self._pending = rest
+
+    def _starttag(self, tag, attrs):
+        # Only links read attributes
+        pairs = []
+        if tag == 'a' or tag == 'link':
+            for name, value in _ATTR_RE.findall(attrs):
+                if value[:1] in ('"', "'"):
+                    value = value[1:-1]
+                pairs.append((name.lower(), unescape(value) if '&' in value else value))
+        if attrs.rstrip().endswith('/'):
+            self.handle_startendtag(tag, pairs)
+        else:
+            self.handle_starttag(tag, pairs)
+            if tag in _RAW_TEXT_TAGS:
+                self._raw_tag = tag
+
+    def _hand_over(self, rest):
+        self._pending = None
+        if self._raw_tag:
+            self.set_cdata_mode(self._raw_tag)
+        super().feed(rest)
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a' or tag == 'link':
+            self._link(tag, dict(attrs))
+        if tag in _NOISE_TAGS:
+            raw = tag in _RAW_TEXT_TAGS or (self._noise and self._noise[-1][1] is None)
+            self._noise.append((tag, None if raw else []))
+        elif self._noise:
+            self._skip('\n' if tag in _BLOCK_TAGS else '')
+        elif tag == 'title':
+            self._in_title = not self._title
+        elif tag in _BLOCK_TAGS:
+            self._parts.append('\n')
+
+    def _link(self, tag, attrs):
+        href = (attrs.get('href') or '').strip()
+        if not href:
+            return
+        if tag == 'a':
+            self._hrefs.append(href)
+        elif self._canonical is None and 'canonical' in (attrs.get('rel') or '').lower().split():
+            self._canonical = href
+
+    def handle_endtag(self, tag):
+        if tag in _NOISE_TAGS:
+            # Closes the innermost open one, and any left open inside it
+            for i in range(len(self._noise) - 1, -1, -1):
+                if self._noise[i][0] == tag:
+                    del self._noise[i:]
+                    break
+        elif tag in ('body', 'html'):
+            self._restore_unclosed()
+        elif self._noise:
+            self._skip('\n' if tag in _BLOCK_TAGS else '')
+        elif tag == 'title':
+            self._in_title = False
+        elif tag in _BLOCK_TAGS:
+            self._parts.append('\n')
+
+    def handle_data(self, data):
+        if self._noise:
+            self._skip(data)
+            return
+        if self._in_title:
+            self._title.append(data)
+            return
+        self._parts.append(data)
+        # Never more than the final text holds, so stopping at a count is safe
+        self.chars += len(' '.join(data.split()))
+
+    def _skip(self, part):
+        skipped = self._noise[-1][1]
+        if part and skipped is not None:
+            skipped.append(part)
+
+    def _restore_unclosed(self):
+        # Outer buffers hold what came before the inner elements opened, so this is document order
+        for _, skipped in self._noise:
+            for part in skipped or ():
+                self._parts.append(part)
+                self.chars += len(' '.join(part.split()))
+        self._noise = []
+
+    def close(self):
+        if self._pending is not None:
+            self._tokenise(final=True)
+        super().close()
+        self._restore_unclosed()
+
+    def title(self):
+        return ' '.join(''.join(self._title).split())
+
+    def text(self):
+        lines = ''.join(self._parts).split('\n')
+        return '\n'.join(' '.join(line.split()) for line in lines if line.strip())
+
+    def links(self, url):
+        """Unique absolute links to url's host, without fragments, query strings or files."""
+        from urllib.parse import urljoin, urlparse
+        host = urlparse(url).netloc
+        seen = set()
+        links = []
+        for href in self._hrefs:
+            href = href.split('#', 1)[0]
+            if not href or '?' in href:
+                continue
+            full = urljoin(url, href)
+            parsed = urlparse(full)
+            if parsed.netloc == host and not _FILE_RE.search(parsed.path) and full not in seen:
+                seen.add(full)
+                links.append(full)
+        return links
+
+    def canonical(self, url):
+        """The page's <link rel="canonical"> target, absolute, or None."""
+        from urllib.parse import urljoin
+        return urljoin(url, self._canonical) if self._canonical else None
+
+
+def _clean_html(html: str, max_chars: int = 8000) -> tuple:
+    """Strip HTML and return (title, clean_text)."""
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.title(), _truncate_text(extractor.text(), max_chars)
+
+
+SCRAPE_TIMEOUT = 12
+SEARCH_TIMEOUT = 10
+# Most body bytes read per page, however little text it has
+SCRAPE_MAX_BYTES = int(os.getenv('PROMPTX_SCRAPE_MAX_BYTES', 2 * 1024 * 1024))
+
+# Crawl pages fetched at once per site, and the crawl's own time cap (a
+# request deadline, when given, can only shorten it)
+CRAWL_HOST_CONCURRENCY = int(os.getenv('PROMPTX_CRAWL_HOST_CONCURRENCY', 4))
+CRAWL_BUDGET = float(os.getenv('PROMPTX_CRAWL_BUDGET', 25))
+
+_async_http_clients = weakref.WeakKeyDictionary()
+
+
+def _get_async_http():
+    """Shared httpx.AsyncClient for scraping on the running loop."""
+    import httpx
+    loop = asyncio.get_running_loop()
+    with _async_pools_lock:
+        client = _async_http_clients.get(loop)
+        if client is None:
+            client = _async_http_clients[loop] = httpx.AsyncClient(
+                headers=_SCRAPE_HEADERS, follow_redirects=True, limits=_async_limits(),
+            )
+            _close_with_loop(loop, client.aclose)
+        return client
+
+
+def _scrape_failure(url, error):
+    return {'success': False, 'url': url, 'title': '', 'text': '',
+            'char_count': 0, 'links': [], 'canonical': None, 'error': error, 'cache': None}
+
+
+_META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w.:-]+)', re.IGNORECASE)
+
+
+def _is_html(content_type):
+    """Whether a Content-Type can be a web page (a missing one gets the benefit of the doubt)."""
+    return not content_type or 'html' in content_type.lower()
+
+
+def _known_charset(name):
+    try:
+        return codecs.lookup(name).name if name else None
+    except LookupError:
+        return None
+
+
+def _header_charset(content_type):
+    match = re.search(r'charset=["\']?([\w.:-]+)', content_type or '', re.IGNORECASE)
+    return _known_charset(match.group(1)) if match else None
+
+
+class _PageReader:
+    """
+    Reads one page body as it arrives: bytes are decoded incrementally
+    (charset from the Content-Type, else a <meta charset> in the first
+    chunk, else UTF-8) and fed to a _TextExtractor. feed() returns True
+    once the page has more than max_chars of text, SCRAPE_MAX_BYTES were
+    read or the deadline ran out, so the fetch stops without downloading
+    the rest; `complete` then turns false.
+    """
+
+    def __init__(self, url, content_type, max_chars):
+        self.url = url
+        self.max_chars = max_chars
+        self.extractor = _TextExtractor()
+        self.charset = _header_charset(content_type)
+        self.complete = True
+        self.bytes = 0
+        self._decoder = None
+
+    def feed(self, chunk, deadline=None):
+        if self._decoder is None:
+            sniffed = _META_CHARSET_RE.search(chunk[:2048])
+            charset = self.charset or _known_charset(sniffed and sniffed.group(1).decode('ascii')) or 'utf-8'
+            self._decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+        self.bytes += len(chunk)
+        self.extractor.feed(self._decoder.decode(chunk))
+        if (self.extractor.chars > self.max_chars or self.bytes >= SCRAPE_MAX_BYTES
+                or (deadline is not None and deadline.expired)):
+            self.complete = False
+        return not self.complete
+
+    def page(self):
+        """What the crawl cache keeps: {title, text, links, canonical, complete}."""
+        if self.complete:
+            if self._decoder is not None:
+                self.extractor.feed(self._decoder.decode(b'', final=True))
+            self.extractor.close()
+        return {
+            'title': self.extractor.title(),
+            'text': _truncate_text(self.extractor.text(), CRAWL_CACHE_TEXT_CHARS),
+            'links': self.extractor.links(self.url),
+            'canonical': self.extractor.canonical(self.url),
+            'complete': self.complete,
+        }
+
+
+def _not_html(url, content_type):
+    return _scrape_failure(url, f"Not an HTML page ({content_type.split(';')[0].strip()})")
+
+
+def _page_result(url, page, max_chars, cache):
+    text = _truncate_text(page['text'], max_chars)
+    return {
+        'success': True, 'url': url, 'title': page['title'] or url,
+        'text': text, 'char_count': len(text),
+        'links': page['links'], 'canonical': page['canonical'], 'error': None, 'cache': cache,
+    }
+
+
+async def ascrape_url(url: str, max_chars: int = 8000, deadline=None) -> dict:
+    """
+    Scrape a single URL. Returns { success, url, title, text, char_count, links, canonical, error, cache }.
+
+    The body is streamed: reading stops as soon as the page has max_chars
+    of text (or SCRAPE_MAX_BYTES were read), and anything but HTML is
+    rejected from its headers alone. A page in the crawl cache is fetched
+    with a conditional GET; on a 304 the stored copy is returned
+    ('cache': 'revalidated'), else 'miss'.
+    """
+    import httpx
+    if deadline is not None and not deadline.allows(DEADLINE_MIN_FETCH):
+        return _scrape_failure(url, 'Skipped: request time budget used up')
+    timeout = _timeout(deadline, SCRAPE_TIMEOUT)
+    try:
+        cached = await asyncio.to_thread(_crawl_cache.page, url, max_chars)
+        async with _get_async_http().stream(
+            'GET', url, timeout=timeout, headers=_conditional_headers(cached),
+        ) as resp:
+            if resp.status_code == 304 and cached is not None:
+                await asyncio.to_thread(_crawl_cache.revalidated, url, cached)
+                return _page_result(url, cached, max_chars, 'revalidated')
+            resp.raise_for_status()
+            content_type = resp.headers.get('Content-Type', '')
+            if not _is_html(content_type):
+                return _not_html(url, content_type)
+            reader = _PageReader(url, content_type, max_chars)
+            async for chunk in resp.aiter_bytes():
+                if reader.feed(chunk, deadline):
+                    break
+        page = reader.page()
+        await asyncio.to_thread(_crawl_cache.store_page, url, page, resp.headers, reader.bytes)
+        return _page_result(url, page, max_chars, 'miss')
+    except httpx.TimeoutException:
+        return _scrape_failure(url, f'Timed out after {timeout:.0f}s')
+    except httpx.HTTPStatusError as e:
+        return _scrape_failure(url, f'HTTP {e.response.status_code}')
+    except Exception as e:
+        return _scrape_failure(url, str(e))
+
+
+def scrape_url(url: str, max_chars: int = 8000, deadline=None) -> dict:
+    """Blocking ascrape_url, for sync callers."""
+    return run_on_worker_loop(ascrape_url(url, max_chars, deadline))
+
+
+# ── crawl frontier: robots.txt, sitemaps, ranking ───────────────────────────
+
+# Discovery (robots.txt + sitemaps) runs alongside the homepage fetch and
+# gets at most this many seconds of the crawl budget
+FRONTIER_BUDGET = float(os.getenv('PROMPTX_FRONTIER_BUDGET', 5))
+SITEMAP_MAX_URLS = int(os.getenv('PROMPTX_SITEMAP_MAX_URLS', 5000))
+SITEMAP_MAX_FILES = 4
+SITEMAP_MAX_BYTES = 8 * 1024 * 1024
+ROBOTS_AGENT = 'PromptX'
+
+# Path words that mark pages worth reading, with their weight
+_FRONTIER_KEYWORDS = {
+    'pricing': 5, 'price': 4, 'plans': 4,
+    'docs': 5, 'documentation': 5, 'api': 5, 'developers': 4, 'developer': 4,
+    'reference': 3, 'sdk': 3, 'getting-started': 3, 'quickstart': 3, 'guide': 2, 'guides': 2,
+    'features': 4, 'feature': 3, 'how-it-works': 4, 'product': 3, 'products': 3,
+    'solutions': 3, 'platform': 3, 'integrations': 3, 'architecture': 4,
+    'engineering': 3, 'tech': 3, 'technology': 3, 'security': 2, 'enterprise': 2,
+    'about': 3, 'about-us': 3, 'company': 2, 'faq': 2, 'customers': 1,
+    'blog': 1, 'changelog': 1, 'careers': 1, 'team': 1,
+}
+# Path words of pages that are never worth a fetch
+_FRONTIER_SKIP = {
+    'login', 'signin', 'sign-in', 'signup', 'sign-up', 'register', 'logout', 'cart', 'checkout',
+    'account', 'privacy', 'privacy-policy', 'terms', 'cookies', 'cookie-policy', 'legal',
+    'tag', 'tags', 'category', 'categories', 'author', 'page', 'search', 'feed', 'rss',
+}
+_LOCALE_RE = re.compile(r'^[a-z]{2}(?:[-_][a-z]{2})?$')
+_TRACKING_PARAMS = re.compile(r'^(utm_\w+|ref|fbclid|gclid|mc_\w+|_ga)$', re.IGNORECASE)
+_FILE_RE = re.compile(r'\.(pdf|jpe?g|png|gif|svg|webp|zip|gz|css|js|ico|woff2?|mp4|mp3|xml|json)$', re.IGNORECASE)
+
+
+def _canonical_url(url):
+    """
+    Dedupe key of a URL: lower-case host without 'www.' or a default port,
+    no fragment, tracking parameters or trailing slash, remaining query
+    parameters sorted.
+    """
+    from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if parts.port and parts.port not in (80, 443):
+        host = f'{host}:{parts.port}'
+    path = re.sub(r'/index\.html?$', '/', parts.path or '/').rstrip('/') or '/'
+    query = urlencode(sorted((k, v) for k, v in parse_qsl(parts.query) if not _TRACKING_PARAMS.match(k)))
+    return urlunsplit((parts.scheme.lower() or 'https', host, path, query, ''))
+
+
+def _frontier_score(key, from_home):
+    """How likely the page at canonical URL key is to be worth crawling (<= 0: not worth it)."""
+    from urllib.parse import urlsplit
+    parts = urlsplit(key)
+    segments = [seg for seg in parts.path.lower().split('/') if seg]
+    if not segments or _FILE_RE.search(parts.path):
+        return 0.0
+    if segments[0] != 'en' and _LOCALE_RE.match(segments[0]):
+        return -3.0  # translated copy of a page we can read in English
+    score = 1.0 if from_home else 0.0
+    for depth, seg in enumerate(segments):
+        if seg in _FRONTIER_SKIP or seg.isdigit():
+            return -5.0
+        words = [seg] + re.split(r'[-_.]', seg)
+        weight = max(_FRONTIER_KEYWORDS.get(w, 0) for w in words)
+        score += weight / (depth + 1)
+    score -= max(0, len(segments) - 2)
+    if parts.query:
+        score -= 2
+    return score
+
+
+def _sitemap_priority(url):
+    """Order for a sitemap index's children: page sitemaps before posts, media and archives."""
+    lower = url.lower()
+    return sum(word in lower for word in ('post', 'blog', 'news', 'product', 'image', 'video', 'tag', 'archive'))
+
+
+class _SitemapReader:
+    """
+    Incremental sitemap parser: feed() it the body as it arrives and read
+    <loc> values from locs. Handles sitemap indexes (is_index) and gzip,
+    so a large sitemap can be abandoned as soon as enough URLs are in.
+    """
+
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._gunzip = None
+        self._first = True
+        self.is_index = False
+        self.locs = []
+        self.failed = False
+
+    def feed(self, chunk):
+        if self.failed:
+            return
+        if self._first:
+            self._first = False
+            if chunk[:2] == b'\x1f\x8b':
+                self._gunzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            if self._gunzip is not None:
+                chunk = self._gunzip.decompress(chunk)
+            self._parser.feed(chunk)
+            for event, elem in self._parser.read_events():
+                tag = elem.tag.rsplit('}', 1)[-1]
+                if event == 'start':
+                    if tag == 'sitemapindex':
+                        self.is_index = True
+                elif tag == 'loc' and elem.text:
+                    self.locs.append(elem.text.strip())
+                elif tag in ('url', 'sitemap'):
+                    elem.clear()
+        except (ET.ParseError, zlib.error):
+            self.failed = True
+
+
+def _site_root(base_url):
+    from urllib.parse import urlparse
+    parsed = urlparse(base_url)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+
+def _parse_robots(text):
+    robots = RobotFileParser()
+    robots.parse(text.splitlines())
+    return robots
+
+
+async def _afetch_robots(root, deadline):
+    import httpx
+    try:
+        resp = await _get_async_http().get(f'{root}/robots.txt', timeout=_timeout(deadline, 5))
+    except httpx.HTTPError:
+        return None
+    if resp.status_code != 200 or 'html' in resp.headers.get('Content-Type', ''):
+        return None
+    return _parse_robots(resp.text)
+
+
+async def _afetch_sitemap(url, limit, deadline):
+    """(reader, bytes read) for one sitemap, read no further than `limit` URLs."""
+    import httpx
+    reader = _SitemapReader()
+    read = 0
+    try:
+        async with _get_async_http().stream('GET', url, timeout=_timeout(deadline, 5)) as resp:
+            if resp.status_code != 200:
+                return reader, 0
+            async for chunk in resp.aiter_bytes():
+                reader.feed(chunk)
+                read += len(chunk)
+                if len(reader.locs) >= limit or read >= SITEMAP_MAX_BYTES or reader.failed or deadline.expired:
+                    break
+    except httpx.HTTPError as e:
+        print(f"Sitemap fetch failed for {url}: {e}")
+    return reader, read
+
+
+def _sitemap_queue(root, robots):
+    return list(dict.fromkeys((robots.site_maps() if robots else None) or [f'{root}/sitemap.xml']))
+
+
+def _discovery(robots, sitemaps_read, urls, bytes_read):
+    return {'robots': robots, 'sitemap_urls': urls, 'sitemaps_read': sitemaps_read, 'sitemap_bytes': bytes_read}
+
+
+async def adiscover_site(base_url, deadline=None):
+    """
+    robots.txt plus the page URLs listed in the site's sitemaps (robots
+    Sitemap: lines, else /sitemap.xml), following sitemap indexes.
+    Bounded by SITEMAP_MAX_URLS / SITEMAP_MAX_FILES and FRONTIER_BUDGET.
+    """
+    deadline = deadline.within(FRONTIER_BUDGET) if deadline is not None else Deadline(FRONTIER_BUDGET)
+    root = _site_root(base_url)
+    robots = await _afetch_robots(root, deadline)
+    queue, urls, files, total = _sitemap_queue(root, robots), [], 0, 0
+    while queue and files < SITEMAP_MAX_FILES and len(urls) < SITEMAP_MAX_URLS and deadline.allows(DEADLINE_MIN_FETCH):
+        files += 1
+        reader, read = await _afetch_sitemap(queue.pop(0), SITEMAP_MAX_URLS - len(urls), deadline)
+        total += read
+        if reader.is_index:
+            queue.extend(sorted(reader.locs, key=_sitemap_priority))
+        else:
+            urls.extend(reader.locs)
+    return _discovery(robots, files, urls, total)
+
+
+def _crawl_frontier(base_url, home, site, needed):
+    """
+    (candidate URLs, stats) for a crawl needing `needed` more pages:
+    homepage links and sitemap URLs on the same site, deduped by
+    canonical URL, minus what robots.txt disallows, best-scoring first.
+    Only when neither source yields anything are _VALUABLE_PATHS probed.
+    """
+    from urllib.parse import urljoin, urlsplit
+    home_key = _canonical_url(base_url)
+    host = urlsplit(home_key).netloc
+    seen = {home_key}
+    if home.get('canonical'):
+        seen.add(_canonical_url(home['canonical']))
+    robots = site['robots']
+    sources = [(url, True) for url in home.get('links', [])] + [(url, False) for url in site['sitemap_urls']]
+    scored, blocked = [], 0
+    for order, (url, from_home) in enumerate(sources):
+        key = _canonical_url(url)
+        if key in seen or urlsplit(key).netloc != host:
+            continue
+        seen.add(key)
+        if robots is not None and not robots.can_fetch(ROBOTS_AGENT, url):
+            blocked += 1
+            continue
+        scored.append((_frontier_score(key, from_home), order, url, from_home))
+    scored.sort(key=lambda item: (-item[0], item[1]))
+
+    size = max(3 * needed, 12)
+    candidates = [url for score, _, url, _ in scored if score > 0][:size]
+    if len(candidates) < needed:
+        # Existing but unremarkable homepage links beat guessing
+        candidates += [url for score, _, url, from_home in scored if from_home and -3 < score <= 0][:needed - len(candidates)]
+    source = 'sitemap' if site['sitemap_urls'] else 'links'
+    if not candidates and not scored:
+        source = 'probe'
+        root = _site_root(base_url)
+        candidates = [
+            urljoin(root, path) for path in _VALUABLE_PATHS
+            if _canonical_url(urljoin(root, path)) not in seen
+            and (robots is None or robots.can_fetch(ROBOTS_AGENT, urljoin(root, path)))
+        ]
+    return candidates, {
+        'source': source,
+        'robots_txt': robots is not None,
+        'robots_blocked': blocked,
+        'sitemaps_read': site['sitemaps_read'],
+        'sitemap_urls': len(site['sitemap_urls']),
+        'considered': len(scored),
+        'candidates': len(candidates),
+    }
+
+
+# ── crawl cache: validators, conditional GETs, site snapshots ───────────────
+
+# Most cleaned text kept per page; callers get it trimmed to their max_chars
+CRAWL_CACHE_TEXT_CHARS = 50000
+# Whole-site crawls are served from their snapshot for this many seconds
+CRAWL_SNAPSHOT_TTL = int(os.getenv('PROMPTX_CRAWL_SNAPSHOT_TTL', 3600))
+# A site's index answers follow-up questions without a crawl for this many seconds;
+# never longer than the snapshot, so a site is re-checked as often either way
+SITE_INDEX_TTL = min(int(os.getenv('PROMPTX_SITE_INDEX_TTL', CRAWL_SNAPSHOT_TTL)), CRAWL_SNAPSHOT_TTL)
+
+
+def _conditional_headers(cached):
+    """If-None-Match / If-Modified-Since for a cached page (empty when there is none)."""
+    headers = {}
+    if cached is not None:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    return headers
+
+
+class CrawlCache:
+    """
+    On-disk crawl cache in a SQLite file that every worker opens.
+
+    `pages` holds each fetched page under its canonical URL: cleaned text,
+    title, links and rel=canonical, with the ETag / Last-Modified the site
+    sent. The next fetch of the page is a conditional GET, and a 304 reuses
+    the stored copy without transferring the body. Pages sent without
+    validators can't be revalidated, so they aren't stored. A page read
+    only partway (the fetch stopped once it had enough text) serves only
+    callers that want no more text than it holds.
+
+    `sites` holds whole scrape_website_deep results (snapshots) per base
+    URL and crawl shape for snapshot_ttl seconds, so a popular domain is
+    crawled once per TTL instead of once per request. Concurrent crawls
+    of the same snapshot are coalesced (single flight); crawls cut short
+    by the deadline are not stored.
+
+    Alongside each snapshot the site's latest crawl, whatever its shape, is
+    kept for index_ttl seconds (at most snapshot_ttl) under the base URL alone, its text held only
+    in the crawl's SiteIndex, so follow-up questions about the site can be
+    answered from ranked chunks without crawling again (site()).
+
+    Pages unused for ttl seconds are dropped, then the least recently used
+    until the file holds max_bytes. Cache failures are logged and treated
+    as misses; they never fail the crawl.
+    """
+
+    _PRUNE_EVERY = 64
+
+    def __init__(self, path=None, ttl=7 * 86400, snapshot_ttl=3600, max_bytes=256 * 1024 * 1024, index_ttl=3600):
+        self.path = path or os.path.join(CACHE_DIR, 'crawl.sqlite3')
+        self.ttl = ttl
+        self.snapshot_ttl = snapshot_ttl
+        self.index_ttl = min(index_ttl, snapshot_ttl)
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._flight = _SingleFlight()
+        self._stats_lock = threading.Lock()
+        self.counters = {
+            'snapshot_hits': 0, 'snapshot_misses': 0, 'index_hits': 0, 'index_misses': 0,
+            'revalidated': 0, 'revalidated_bytes': 0, 'stored': 0, 'errors': 0,
+        }
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS pages ('
+        ' key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,'
+        ' fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed_at)',
+        'CREATE TABLE IF NOT EXISTS sites ('
+        ' key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,'
+        ' created_at REAL NOT NULL, expires_at REAL NOT NULL)',
+    )
+
+    def _conn(self):
+        return _sqlite_connection(self._local, self.path, self.SCHEMA)
+
+    def _count(self, field, n=1):
+        with self._stats_lock:
+            self.counters[field] += n
+
+    def _failed(self, action, error):
+        print(f"Crawl cache {action} failed: {error}")
+        self._count('errors')
+
+    # ── pages ──
+
+    def page(self, url, min_chars=0):
+        """
+        The stored page for url ({title, text, links, canonical, complete,
+        etag, last_modified, bytes}), or None, also when it was read only
+        partway and holds less than min_chars of text.
+        """
+        try:
+            row = self._conn().execute(
+                'SELECT value FROM pages WHERE key = ?', (_canonical_url(url),)
+            ).fetchone()
+            page = json.loads(zlib.decompress(row[0])) if row else None
+        except (sqlite3.Error, ValueError, zlib.error) as e:
+            self._failed('read', e)
+            return None
+        if page is not None and not page.get('complete', True) and len(page['text']) < min_chars:
+            return None
+        return page
+
+    def store_page(self, url, page, headers, body_bytes):
+        """Keep a freshly fetched page, if the site sent validators to revalidate it with."""
+        etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+        if not (etag or last_modified):
+            return
+        value = {**page, 'etag': etag, 'last_modified': last_modified, 'bytes': body_bytes}
+        try:
+            blob = zlib.compress(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+            now = time.time()
+            conn = self._conn()
+            conn.execute(
+                'INSERT OR REPLACE INTO pages (key, value, size, fetched_at, accessed_at)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (_canonical_url(url), blob, len(blob), now, now),
+            )
+            self._count('stored')
+            if self.counters['stored'] % self._PRUNE_EVERY == 0:
+                self.prune()
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            self._failed('write', e)
+
+    def revalidated(self, url, cached):
+        """Record a 304 for a stored page: it stays, and its body wasn't transferred."""
+        self._count('revalidated')
+        self._count('revalidated_bytes', cached.get('bytes') or 0)
+        try:
+            self._conn().execute(
+                'UPDATE pages SET accessed_at = ? WHERE key = ?', (time.time(), _canonical_url(url))
+            )
+        except sqlite3.Error as e:
+            self._failed('write', e)
+
+    # ── site snapshots ──
+
+    @staticmethod
+    def snapshot_key(base_url, max_pages, chars_per_page):
+        return f'{_canonical_url(base_url)} {max_pages} {chars_per_page}'
+
+    def _site_row(self, key, counter):
+        """(crawl, age in seconds) stored in sites under key while fresh, else None."""
+        try:
+            row = self._conn().execute(
+                'SELECT value, created_at FROM sites WHERE key = ? AND expires_at > ?', (key, time.time())
+            ).fetchone()
+            if row is None:
+                self._count(f'{counter}_misses')
+                return None
+            crawl = json.loads(zlib.decompress(row[0]))
+        except (sqlite3.Error, ValueError, zlib.error) as e:
+            self._failed('read', e)
+            return None
+        self._count(f'{counter}_hits')
+        return crawl, time.time() - row[1]
+
+    def snapshot(self, key):
+        """(crawl result, age in seconds) stored under key while fresh, else None."""
+        return self._site_row(key, 'snapshot')
+
+    def site(self, base_url):
+        """The site's latest crawl while within index_ttl, served as 'index', else None."""
+        hit = self._site_row(_canonical_url(base_url), 'index')
+        return self._served(hit[0], 'index', hit[1]) if hit is not None else None
+
+    def store_snapshot(self, key, crawl):
+        """Keep a complete crawl as the snapshot under key and as its site's latest crawl."""
+        if not crawl['success'] or crawl.get('partial'):
+            return
+        now = time.time()
+        rows = []
+        try:
+            if self.snapshot_ttl > 0:
+                rows.append((key, crawl, now + self.snapshot_ttl))
+            if self.index_ttl > 0:
+                rows.append((_canonical_url(crawl['base_url']), _site_entry(crawl), now + self.index_ttl))
+            blobs = [(row_key, zlib.compress(json.dumps(value, ensure_ascii=False).encode('utf-8')), expires)
+                     for row_key, value, expires in rows]
+            self._conn().executemany(
+                'INSERT OR REPLACE INTO sites (key, value, size, created_at, expires_at) VALUES (?, ?, ?, ?, ?)',
+                [(row_key, blob, len(blob), now, expires) for row_key, blob, expires in blobs],
+            )
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            self._failed('write', e)
+
+    def _served(self, crawl, snapshot, age=0.0):
+        """crawl with its 'cache' report: how it was served and what the crawl revalidated."""
+        pages = crawl.get('cache') or {}
+        fresh = snapshot in ('miss', 'refresh')
+        return {**crawl, 'cache': {
+            'snapshot': snapshot, 'age_s': round(age, 1),
+            'fetched': pages.get('fetched', 0) if fresh else 0,
+            'revalidated': pages.get('revalidated', 0) if fresh else 0,
+        }}
+
+    async def acrawl(self, key, force_refresh, crawl, *args):
+        """
+        await crawl(*args), or the snapshot under key while fresh and not
+        force_refresh. A fresh crawl is stored as the new snapshot.
+        """
+        if not force_refresh:
+            hit = await asyncio.to_thread(self.snapshot, key)
+            if hit is not None:
+                return self._served(hit[0], 'hit', hit[1])
+
+        async def fresh():
+            result = await crawl(*args)
+            await asyncio.to_thread(self.store_snapshot, key, result)
+            return result
+        result, leader = await self._flight.arun(key, fresh)
+        return self._served(result if leader else copy.deepcopy(result), 'refresh' if force_refresh else 'miss')
+
+    def prune(self):
+        """Drop expired snapshots and stale pages, then least recently used pages until under max_bytes."""
+        now = time.time()
+        conn = self._conn()
+        conn.execute('DELETE FROM sites WHERE expires_at <= ?', (now,))
+        conn.execute('DELETE FROM pages WHERE accessed_at <= ?', (now - self.ttl,))
+        total = conn.execute(
+            'SELECT (SELECT COALESCE(SUM(size), 0) FROM pages) + (SELECT COALESCE(SUM(size), 0) FROM sites)'
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        doomed = []
+        for key, size in conn.execute('SELECT key, size FROM pages ORDER BY accessed_at'):
+            doomed.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany('DELETE FROM pages WHERE key = ?', doomed)
+
+    def stats(self):
+        with self._stats_lock:
+            counters = dict(self.counters)
+        try:
+            conn = self._conn()
+            pages, page_bytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages').fetchone()
+            sites, site_bytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM sites').fetchone()
+            entries = {'pages': pages, 'snapshots': sites, 'bytes': page_bytes + site_bytes}
+        except sqlite3.Error:
+            entries = {'pages': None, 'snapshots': None, 'bytes': None}
+        return {
+            **entries, 'max_bytes': self.max_bytes,
+            'snapshot_ttl': self.snapshot_ttl, 'index_ttl': self.index_ttl, 'coalesced': self._flight.coalesced, **counters,
+        }
+
+
+_crawl_cache = CrawlCache(
+    path=os.getenv('PROMPTX_CRAWL_CACHE') or None,
+    ttl=int(os.getenv('PROMPTX_CRAWL_CACHE_TTL', 7 * 86400)),
+    snapshot_ttl=CRAWL_SNAPSHOT_TTL,
+    max_bytes=int(os.getenv('PROMPTX_CRAWL_CACHE_MB', 256)) * 1024 * 1024,
+    index_ttl=SITE_INDEX_TTL,
+)
+
+
+# ── cross-page dedup: boilerplate blocks and near-identical pages ───────────
+
+# A block (text line) on at least this share of a crawl's pages is boilerplate
+BOILERPLATE_SHARE = float(os.getenv('PROMPTX_BOILERPLATE_SHARE', 0.5))
+# Blocks shorter than this (in words) are never dropped as repeats: table cells, labels
+MIN_REPEATED_BLOCK_WORDS = 4
+# Pages at least this similar (Jaccard over 5-word shingles) to an earlier one are dropped
+DUPLICATE_PAGE_SIMILARITY = float(os.getenv('PROMPTX_DUPLICATE_PAGE_SIMILARITY', 0.9))
+_YEAR_RE = re.compile(r'\b(?:19|20)\d\d\b')
+
+
+def _block_key(line):
+    """Fingerprint of a text block: case, punctuation and years (as in copyright lines) ignored."""
+    canonical = _YEAR_RE.sub('0', canonicalise_prompt(line))
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=8).digest() if canonical else None
+
+
+def _is_short_block(line):
+    return len(canonicalise_prompt(line).split()) < MIN_REPEATED_BLOCK_WORDS
+
+
+def _shingle_hashes(text, size=5):
+    words = canonicalise_prompt(text).split()
+    return {hash(tuple(words[i:i + size])) for i in range(max(1, len(words) - size + 1))} if words else set()
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+def _dedupe_pages(pages):
+    """
+    (pages, report) with cross-page repetition removed before the text
+    goes to a model: pages whose word shingles are near-identical to an
+    earlier page's are dropped, blocks on BOILERPLATE_SHARE of the pages
+    and at least three of them (navigation, cookie banners, footers) are
+    removed everywhere, and a block repeated on other pages is kept only
+    on the first page that has it. Repeats within one page (the rows of
+    a pricing table) and short blocks are never removed as repeats.
+    """
+    report = {'duplicate_pages': [], 'boilerplate_blocks': 0, 'repeated_blocks': 0,
+              'chars_removed': 0, 'tokens_removed': 0}
+    kept, shingles = [], []
+    for page in pages:
+        own = _shingle_hashes(page['text'])
+        twin = next((other for other, theirs in zip(kept, shingles)
+                     if _jaccard(own, theirs) >= DUPLICATE_PAGE_SIMILARITY), None)
+        if twin is not None:
+            report['duplicate_pages'].append({'url': page['url'], 'duplicate_of': twin['url']})
+            continue
+        kept.append(page)
+        shingles.append(own)
+
+    blocks = [[(line, _block_key(line)) for line in page['text'].split('\n')] for page in kept]
+    pages_with = Counter(key for page in blocks for key in {key for _, key in page if key})
+    boilerplate = max(3, math.ceil(BOILERPLATE_SHARE * len(kept)))
+    first_page = {}
+    for index, lines in enumerate(blocks):
+        for _, key in lines:
+            if key is not None:
+                first_page.setdefault(key, index)
+    deduped = []
+    for index, (page, lines) in enumerate(zip(kept, blocks)):
+        text = []
+        for line, key in lines:
+            if key is not None and pages_with[key] >= boilerplate:
+                report['boilerplate_blocks'] += 1
+            elif key is not None and first_page[key] != index and not _is_short_block(line):
+                report['repeated_blocks'] += 1
+            else:
+                text.append(line)
+        deduped.append({**page, 'text': '\n'.join(text)})
+
+    before = '\n\n'.join(p['text'] for p in pages)
+    after = '\n\n'.join(p['text'] for p in deduped)
+    report['chars_removed'] = len(before) - len(after)
+    report['tokens_removed'] = max(0, count_tokens(before) - count_tokens(after))
+    return deduped, report
+
+
+# ── site index: paragraph chunks ranked with BM25 ───────────────────────────
+
+# Paragraphs are grouped into chunks of about this many characters
+SITE_INDEX_CHUNK_CHARS = 800
+# Page text packed into a follow-up question's prompt
+SITE_INDEX_BUDGET = int(os.getenv('PROMPTX_SITE_INDEX_BUDGET', 3000))
+_TERM_RE = re.compile(r'\w+')
+_STOPWORDS = frozenset(
+    'a an and are as at be but by can do does for from has have how i in is it its me my of on or our '
+    'so that the their them this to us was we what when where which who why will with you your'.split()
+)
+
+
+def _terms(text):
+    return [t for t in _TERM_RE.findall(text.lower()) if len(t) > 1 and t not in _STOPWORDS]
+
+
+def _paragraph_chunks(text, size=SITE_INDEX_CHUNK_CHARS):
+    """Consecutive paragraphs of text joined into chunks of about size chars; longer paragraphs split on words."""
+    chunks, current = [], ''
+    for paragraph in text.split('\n'):
+        while len(paragraph) > 2 * size:
+            cut = paragraph.rfind(' ', 0, size)
+            cut = cut if cut > 0 else size
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(paragraph[:cut])
+            paragraph = paragraph[cut:].lstrip()
+        current = f'{current}\n{paragraph}' if current else paragraph
+        if len(current) >= size:
+            chunks.append(current)
+            current = ''
+    if current.strip():
+        chunks.append(current)
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+class SiteIndex:
+    """
+    Inverted index over one crawl's pages, split into paragraph chunks and
+    ranked with BM25 (page titles count as part of every chunk).
+
+    `data` is plain JSON (pages, chunks with their token counts, term
+    postings), so it is built once per crawl, stored with the crawl in the
+    crawl cache and loaded back without re-tokenising the site.
+    """
+
+    K1 = 1.2
+    B = 0.75
+    # Smallest piece of a chunk worth packing once the budget can't take it whole
+    MIN_TRIMMED_TOKENS = 40
+
+    def __init__(self, data):
+        self.data = data
+        self.pages = data['pages']
+        self.chunks = data['chunks']
+        self.postings = data['postings']
+        self.lengths = data['lengths']
+        self._avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+
+    @classmethod
+    def build(cls, pages):
+        """Index [{url, title, text}] pages."""
+        chunks, postings, lengths = [], {}, []
+        for page_no, page in enumerate(pages):
+            title_terms = _terms(page['title'])
+            for position, text in enumerate(_paragraph_chunks(page['text'])):
+                chunk_no = len(chunks)
+                terms = Counter(title_terms + _terms(text))
+                for term, tf in terms.items():
+                    postings.setdefault(term, []).append([chunk_no, tf])
+                lengths.append(sum(terms.values()))
+                chunks.append({'page': page_no, 'position': position, 'text': text, 'tokens': count_tokens(text)})
+        return cls({
+            'pages': [{'url': p['url'], 'title': p['title']} for p in pages],
+            'chunks': chunks, 'postings': postings, 'lengths': lengths,
+        })
+
+    def scores(self, query):
+        """BM25 score of every chunk for query."""
+        scores = [0.0] * len(self.chunks)
+        n = len(self.chunks)
+        for term in set(_terms(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_no, tf in postings:
+                norm = self.K1 * (1 - self.B + self.B * self.lengths[chunk_no] / (self._avg_length or 1))
+                scores[chunk_no] += idf * tf * (self.K1 + 1) / (tf + norm)
+        return scores
+
+    def ranked(self, query):
+        """
+        Chunk numbers, best first. Chunks the query doesn't match follow
+        in coverage order (every page's first chunk, then every second...),
+        so a vague question still sees the whole site.
+        """
+        scores = self.scores(query)
+        return sorted(
+            range(len(self.chunks)),
+            key=lambda i: (-scores[i], self.chunks[i]['position'], self.chunks[i]['page']),
+        )
+
+    def page_texts(self):
+        """The indexed pages as [{url, title, text}], text rebuilt from their chunks."""
+        texts = [[] for _ in self.pages]
+        for chunk in self.chunks:
+            texts[chunk['page']].append(chunk['text'])
+        return [{**page, 'text': '\n'.join(text)} for page, text in zip(self.pages, texts)]
+
+    def tokens(self):
+        return sum(chunk['tokens'] for chunk in self.chunks)
+
+    def pack(self, query, budget):
+        """
+        The best chunks for query that fit in budget tokens, laid out like
+        scrape_website_deep's combined_text: by page, in page order.
+        """
+        picked, used = {}, 0
+        pages_in = set()
+        for i in self.ranked(query):
+            chunk = self.chunks[i]
+            page = self.pages[chunk['page']]
+            header = 0 if chunk['page'] in pages_in else count_tokens(
+                f"{'─'*60}\n\n=== PAGE: {page['title']} ===\nURL: {page['url']}") + 2
+            room = budget - used - header - 1
+            if chunk['tokens'] <= room:
+                picked[i] = chunk['text']
+            elif room >= self.MIN_TRIMMED_TOKENS:
+                # The budget is full: what fits of the next best chunk, and stop
+                picked[i] = trim_to_tokens(chunk['text'], room, marker='')
+            else:
+                break
+            pages_in.add(chunk['page'])
+            used += header + min(chunk['tokens'], room) + 1
+            if chunk['tokens'] > room:
+                break
+
+        parts = []
+        for page_no in sorted(pages_in):
+            page = self.pages[page_no]
+            text = '\n'.join(picked[i] for i in sorted(picked) if self.chunks[i]['page'] == page_no)
+            parts.append(f"=== PAGE: {page['title']} ===\nURL: {page['url']}\n\n{text}")
+        return '\n\n' + ('\n\n' + '─'*60 + '\n\n').join(parts)
+
+
+def _site_entry(crawl):
+    """What the crawl cache keeps of a crawl to answer follow-up questions: everything but the raw text."""
+    entry = {key: value for key, value in crawl.items() if key != 'combined_text'}
+    entry['pages'] = [{'url': p['url'], 'title': p['title']} for p in crawl['pages']]
+    return entry
+
+
+def site_index(base_url):
+    """
+    The last crawl of base_url within SITE_INDEX_TTL, any shape, with the
+    text left only in its 'index' (SiteIndex data); None if there is none.
+    Follow-up questions about a site rank its chunks instead of crawling.
+    """
+    return _crawl_cache.site(base_url)
+
+
+async def asite_index(base_url):
+    return await asyncio.to_thread(_crawl_cache.site, base_url)
+
+
+def _crawl_failure(base_url, error):
+    return {
+        'success': False,
+        'base_url': base_url,
+        'pages_scraped': 0,
+        'pages': [],
+        'combined_text': '',
+        'total_chars': 0,
+        'error': error,
+    }
+
+
+def _crawl_result(base_url, home, pages, frontier=None, fetched=(), partial=False):
+    """
+    Combine the scraped pages into the scrape_website_deep return shape.
+    `fetched` is every scrape result of the crawl, for the cache report;
+    `partial` marks a crawl the deadline cut short. Repetition across the
+    pages is removed first ('dedup' reports how much), then the pages are
+    indexed for ranked retrieval ('index', SiteIndex data).
+    """
+    pages, dedup = _dedupe_pages(pages)
+    combined_parts = []
+    for p in pages:
+        combined_parts.append(
+            f"=== PAGE: {p['title']} ===\n"
+            f"URL: {p['url']}\n\n"
+            f"{p['text']}"
+        )
+    combined_text = '\n\n' + ('\n\n' + '─'*60 + '\n\n').join(combined_parts)
+
+    return {
+        'success': True,
+        'base_url': base_url,
+        'site_title': home['title'],
+        'pages_scraped': len(pages),
+        'pages': pages,
+        'combined_text': combined_text,
+        'total_chars': sum(p['text'].__len__() for p in pages),
+        'frontier': frontier,
+        'cache': {
+            'fetched': sum(r.get('cache') == 'miss' for r in fetched),
+            'revalidated': sum(r.get('cache') == 'revalidated' for r in fetched),
+        },
+        'partial': partial,
+        'dedup': dedup,
+        'index': SiteIndex.build(pages).data,
+        'error': None,
+    }
+
+
+class _PagePicker:
+    """
+    Collects crawl results as they land, in any order, and picks pages in
+    candidate order: the first `needed` good pages among the candidates,
+    skipping any whose canonical URL was already picked (or is in `seen`).
+    `complete` turns true as soon as those are settled, i.e. every earlier
+    candidate has been fetched, so the rest of the crawl can be cancelled
+    without changing the result.
+    """
+
+    def __init__(self, candidates, needed, seen=()):
+        self.candidates = candidates
+        self.needed = needed
+        self.seen = set(seen)
+        self.results = {}
+        self.complete = needed <= 0
+
+    def _pick(self, settled_only):
+        seen = set(self.seen)
+        picked = []
+        for i, url in enumerate(self.candidates):
+            result = self.results.get(i)
+            if result is None:
+                if settled_only:
+                    break
+                continue
+            if not _is_good_page(result):
+                continue
+            key = _canonical_url(result.get('canonical') or url)
+            if key in seen:
+                continue
+            seen.add(key)
+            picked.append(i)
+            if len(picked) >= self.needed:
+                return picked, True
+        return picked, False
+
+    def add(self, index, result):
+        self.results[index] = result
+        self.complete = self._pick(settled_only=True)[1]
+
+    def pages(self):
+        """Picked pages in candidate order (gaps allowed when the crawl was cut short)."""
+        return [
+            {'url': self.candidates[i], 'title': self.results[i]['title'], 'text': self.results[i]['text']}
+            for i in self._pick(settled_only=False)[0]
+        ]
+
+
+def _is_good_page(result):
+    return result['success'] and result['char_count'] > 200
+
+
+def _crawl_out_of_time(deadline, candidates_left):
+    """True (and the skip recorded) when the deadline leaves no time for another page."""
+    if deadline is None or deadline.allows(DEADLINE_MIN_FETCH):
+        return False
+    deadline.skip('crawl', f'{candidates_left} candidate pages not fetched')
+    return True
+
+
+def _crawl_deadline(deadline):
+    """The crawl's own budget: CRAWL_BUDGET, or less when the request has less left."""
+    return deadline.within(CRAWL_BUDGET) if deadline is not None else Deadline(CRAWL_BUDGET)
+
+
+async def ascrape_website_deep(base_url: str, max_pages: int = 8, chars_per_page: int = 6000, deadline=None,
+                               force_refresh=False) -> dict:
+    """
+    Multi-page website crawler.
+    Scrapes the homepage + up to max_pages valuable sub-pages.
+    Returns aggregated content with per-page breakdown.
+
+    Sub-pages are fetched CRAWL_HOST_CONCURRENCY at a time on the shared
+    client, within CRAWL_BUDGET (and the request deadline). Pages are
+    picked in candidate order, as a sequential crawl would, and fetches
+    still in flight once max_pages are settled are cancelled outright.
+
+    Within CRAWL_SNAPSHOT_TTL the site's last crawl is served from the
+    crawl cache instead, unless force_refresh; 'cache' reports which, and
+    how many pages a fresh crawl downloaded or revalidated with a 304.
+    """
+    key = CrawlCache.snapshot_key(base_url, max_pages, chars_per_page)
+    with deadline_step(deadline, 'crawl'):
+        return await _crawl_cache.acrawl(
+            key, force_refresh, _ascrape_website_deep, base_url, max_pages, chars_per_page, _crawl_deadline(deadline),
+        )
+
+
+async def _ascrape_website_deep(base_url, max_pages, chars_per_page, deadline):
+    # Step 1: Scrape homepage, reading robots.txt and sitemaps alongside
+    discovery = asyncio.ensure_future(adiscover_site(base_url, deadline))
+    home = await ascrape_url(base_url, chars_per_page, deadline)
+    if not home['success']:
+        discovery.cancel()
+        return _crawl_failure(base_url, home['error'])
+
+    pages = [{'url': base_url, 'title': home['title'], 'text': home['text']}]
+
+    # Step 2: Scrape the best candidates concurrently until max_pages are settled
+    needed = max_pages - len(pages)
+    candidates, frontier = _crawl_frontier(base_url, home, await discovery, needed)
+    picker = _PagePicker(candidates, needed, seen=[_canonical_url(base_url)])
+    queue = list(range(len(candidates)))
+    pending = {}
+    cut_short = False
+    try:
+        while not picker.complete:
+            while queue and len(pending) < CRAWL_HOST_CONCURRENCY:
+                if _crawl_out_of_time(deadline, len(queue)):
+                    queue, cut_short = [], True
+                    break
+                i = queue.pop(0)
+                pending[asyncio.ensure_future(ascrape_url(candidates[i], chars_per_page, deadline))] = i
+            if not pending:
+                break
+            done, _ = await asyncio.wait(list(pending), timeout=deadline.remaining(), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                deadline.skip('crawl', f'{len(pending)} page fetches abandoned')
+                cut_short = True
+                break
+            for task in done:
+                picker.add(pending.pop(task), task.result())
+    finally:
+        for task in pending:
+            task.cancel()
+    pages.extend(picker.pages())
+
+    # Step 3: Combine all page text
+    fetched = [home, *picker.results.values()]
+    return _crawl_result(base_url, home, pages, frontier, fetched, cut_short or deadline.expired)
+
+
+def scrape_website_deep(base_url: str, max_pages: int = 8, chars_per_page: int = 6000, deadline=None,
+                        force_refresh=False) -> dict:
+    """Blocking ascrape_website_deep, for sync callers."""
+    return run_on_worker_loop(ascrape_website_deep(base_url, max_pages, chars_per_page, deadline, force_refresh))
+
+
+def _search_out_of_time(deadline, query):
+    if deadline is None or deadline.allows(DEADLINE_MIN_FETCH):
+        return False
+    deadline.skip('search', f'query not run: {query[:60]}')
+    return True
+
+
+SEARCH_URL = os.getenv('PROMPTX_SEARCH_URL', 'https://html.duckduckgo.com/html/')
+# Searches in flight at once per event loop (aweb_search_many fans out)
+SEARCH_CONCURRENCY = int(os.getenv('PROMPTX_SEARCH_CONCURRENCY', 4))
+SEARCH_CACHE_TTL = int(os.getenv('PROMPTX_SEARCH_CACHE_TTL', 6 * 3600))
+
+_search_semaphores = weakref.WeakKeyDictionary()
+# Shared by web_search and aweb_search, across workers; empty results (failures) aren't kept
+_search_cache = _response_store('web_search', ttl=SEARCH_CACHE_TTL, cacheable=bool)
+
+
+def _get_search_semaphore():
+    """SEARCH_CONCURRENCY slots for searches on the running loop."""
+    loop = asyncio.get_running_loop()
+    with _async_pools_lock:
+        semaphore = _search_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = _search_semaphores[loop] = asyncio.Semaphore(SEARCH_CONCURRENCY)
+        return semaphore
+
+
+def _normalise_query(query):
+    return ' '.join(query.lower().split())
+
+
+def _result_url(href):
+    """The target of a DuckDuckGo result link (its uddg parameter)."""
+    from urllib.parse import unquote
+    match = re.search(r'uddg=([^&]+)', href)
+    return unquote(match.group(1)) if match else href
+
+
+class _SearchResultParser(HTMLParser):
+    """
+    Incremental parser of a DuckDuckGo HTML results page: feed() it the
+    body as it arrives and read `results` ({title, url, snippet}). `done`
+    turns true once max_results are complete, so the rest of the page
+    needn't be downloaded.
+    """
+
+    def __init__(self, max_results):
+        super().__init__(convert_charrefs=True)
+        self.max_results = max_results
+        self.results = []
+        self.done = max_results <= 0
+        self._current = None
+        self._field = None
+        self._field_tag = None
+        self._depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self._field is not None:
+            self._depth += tag == self._field_tag
+            return
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        if 'result__a' in classes:
+            self._finish()
+            self._current = {'title': [], 'snippet': [], 'url': _result_url(attrs.get('href') or '')}
+            self._field, self._field_tag = 'title', tag
+        elif 'result__snippet' in classes and self._current is not None:
+            self._field, self._field_tag = 'snippet', tag
+
+    def handle_endtag(self, tag):
+        if self._field is None or tag != self._field_tag:
+            return
+        if self._depth:
+            self._depth -= 1
+            return
+        field, self._field = self._field, None
+        if field == 'snippet':
+            self._finish()
+
+    def handle_data(self, data):
+        if self._field is not None:
+            self._current[self._field].append(data)
+
+    def _finish(self):
+        result, self._current = self._current, None
+        if result is None or self.done:
+            return
+        title = ' '.join(''.join(result['title']).split())
+        if title and result['url'].startswith('http'):
+            snippet = ' '.join(''.join(result['snippet']).split())
+            self.results.append({'title': title, 'url': result['url'], 'snippet': snippet})
+        self.done = len(self.results) >= self.max_results
+
+    def close(self):
+        super().close()
+        self._finish()
+
+
+def _search_params(query):
+    return {'q': query, 'kl': 'us-en', 'kp': '-1'}
+
+
+async def aweb_search(query: str, max_results: int = 6, deadline=None) -> list:
+    """
+    Search the web using DuckDuckGo HTML (no API key required).
+    Returns list of { title, url, snippet }; empty when the deadline leaves no time.
+
+    Results are cached per normalised query for SEARCH_CACHE_TTL, and the
+    results page is parsed as it streams in, stopping at max_results.
+    """
+    if _search_out_of_time(deadline, query):
+        return []
+    return await _asearch(_normalise_query(query), max_results, deadline)
+
+
+@_search_cache
+async def _asearch(query, max_results, deadline=None):
+    try:
+        async with _get_search_semaphore():
+            with deadline_step(deadline, 'search'):
+                async with _get_async_http().stream(
+                    'GET', SEARCH_URL, params=_search_params(query), timeout=_timeout(deadline, SEARCH_TIMEOUT),
+                ) as resp:
+                    resp.raise_for_status()
+                    decoder = codecs.getincrementaldecoder(
+                        _header_charset(resp.headers.get('Content-Type')) or 'utf-8')(errors='replace')
+                    parser = _SearchResultParser(max_results)
+                    async for chunk in resp.aiter_bytes():
+                        parser.feed(decoder.decode(chunk))
+                        if parser.done:
+                            break
+        if not parser.done:
+            parser.close()
+        return parser.results
+    except Exception as e:
+        print(f"Web search error: {e}")
+        return []
+
+
+def web_search(query: str, max_results: int = 6, deadline=None) -> list:
+    """Blocking aweb_search, for sync callers."""
+    return run_on_worker_loop(aweb_search(query, max_results, deadline))
+
+
+async def aweb_search_many(queries, max_results: int = 6, deadline=None) -> list:
+    """aweb_search for every query at once (SEARCH_CONCURRENCY in flight); result lists in query order."""
+    return list(await asyncio.gather(*(aweb_search(query, max_results, deadline) for query in queries)))
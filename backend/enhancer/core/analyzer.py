@@ -5,12 +5,6 @@ import logging
 from typing import Dict, List, Optional
 from dataclasses import dataclass, field
 
-try:
-    import spacy
-    nlp_available = True
-except ImportError:
-    nlp_available = False
-
 from .intent_classifier import IntentClassifier, IntentResult
 from .quality_scorer import QualityScorer, QualityScore
 from .complexity_assessor import ComplexityAssessor, ComplexityResult
@@ -19,6 +13,7 @@ from ..utils.text_processing import (
     extract_emails, extract_numbers, detect_language_in_text,
 )
 from ..utils.helpers import timer
+from .registry import get_nlp
 
 logger = logging.getLogger('enhancer')
 
@@ -55,15 +50,10 @@ class PromptAnalyzer:
     quality scoring, complexity assessment, and NLP analysis.
     """
 
-    def __init__(self):
-        if nlp_available:
-            try:
-                self.nlp = spacy.load("en_core_web_md")
-            except OSError:
-                logger.warning("spacy model not found, using simple tokenizer")
-                self.nlp = None
-        else:
-            self.nlp = None
+    def __init__(self, nlp=None):
+        # The spaCy model is shared process-wide; loading it per instance
+        # costs hundreds of milliseconds and tens of MB.
+        self.nlp = nlp if nlp is not None else get_nlp()
         self.intent_classifier = IntentClassifier()
         self.quality_scorer = QualityScorer()
         self.complexity_assessor = ComplexityAssessor()
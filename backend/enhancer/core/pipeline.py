@@ -107,11 +107,11 @@ class PromptXPipeline:
     9. FINAL SCORING         - Quality measurement
     """
 
-    def __init__(self):
+    def __init__(self, analyzer: Optional[PromptAnalyzer] = None):
         self.config = settings.PROMPTX
         self.pipeline_config = self.config['PIPELINE']
 
-        self.analyzer = PromptAnalyzer()
+        self.analyzer = analyzer or PromptAnalyzer()
         self.context_builder = ContextBuilder()
         self.template_manager = TemplateManager()
         self.validator = PromptValidator()
@@ -0,0 +1,129 @@
+"""Process-wide registry of warm PromptX components."""
+
+import time
+import logging
+import threading
+from typing import Dict, Optional
+
+try:
+    import spacy
+    nlp_available = True
+except ImportError:
+    nlp_available = False
+
+logger = logging.getLogger('enhancer')
+
+SPACY_MODEL = "en_core_web_md"
+
+
+class ModelRegistry:
+    """
+    Lazily builds the spaCy model, analyzer and pipeline once per process
+    and hands the same instances to every request.
+
+    All loaders are double-checked under a single lock, so concurrent
+    first requests in a threaded worker still trigger exactly one load.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._nlp = None
+        self._nlp_loaded = False
+        self._analyzer = None
+        self._pipeline = None
+        self.load_times_ms: Dict[str, float] = {}
+        self.load_counts: Dict[str, int] = {}
+        self.warmed_at_startup = False
+
+    def _record(self, name: str, started: float):
+        self.load_times_ms[name] = round((time.perf_counter() - started) * 1000, 2)
+        self.load_counts[name] = self.load_counts.get(name, 0) + 1
+        logger.info(f"Registry loaded {name} in {self.load_times_ms[name]:.2f}ms")
+
+    def get_nlp(self):
+        """Return the shared spaCy model, or None when spaCy is unavailable."""
+        if self._nlp_loaded:
+            return self._nlp
+        with self._lock:
+            if not self._nlp_loaded:
+                started = time.perf_counter()
+                nlp = None
+                if nlp_available:
+                    try:
+                        nlp = spacy.load(SPACY_MODEL)
+                    except OSError:
+                        logger.warning("spacy model not found, using simple tokenizer")
+                self._nlp = nlp
+                self._nlp_loaded = True
+                self._record('nlp', started)
+        return self._nlp
+
+    def get_analyzer(self):
+        """Return the shared PromptAnalyzer."""
+        if self._analyzer is not None:
+            return self._analyzer
+        with self._lock:
+            if self._analyzer is None:
+                from .analyzer import PromptAnalyzer
+                started = time.perf_counter()
+                self._analyzer = PromptAnalyzer(nlp=self.get_nlp())
+                self._record('analyzer', started)
+        return self._analyzer
+
+    def get_pipeline(self):
+        """Return the shared PromptXPipeline."""
+        if self._pipeline is not None:
+            return self._pipeline
+        with self._lock:
+            if self._pipeline is None:
+                from .pipeline import PromptXPipeline
+                started = time.perf_counter()
+                self._pipeline = PromptXPipeline(analyzer=self.get_analyzer())
+                self._record('pipeline', started)
+        return self._pipeline
+
+    def warm(self) -> Dict:
+        """Eagerly load everything (used at WSGI startup)."""
+        self.get_pipeline()
+        self.warmed_at_startup = True
+        return self.status()
+
+    @property
+    def is_warm(self) -> bool:
+        return self._pipeline is not None
+
+    def status(self) -> Dict:
+        """Warm/cold flag plus load timings, for health reporting."""
+        return {
+            'state': 'warm' if self.is_warm else 'cold',
+            'warmed_at_startup': self.warmed_at_startup,
+            'spacy_model': SPACY_MODEL if self._nlp is not None else None,
+            'load_times_ms': dict(self.load_times_ms),
+            'load_counts': dict(self.load_counts),
+        }
+
+
+registry = ModelRegistry()
+
+
+def get_nlp():
+    return registry.get_nlp()
+
+
+def get_analyzer():
+    return registry.get_analyzer()
+
+
+def get_pipeline():
+    return registry.get_pipeline()
+
+
+def warm_start() -> Optional[Dict]:
+    """Warm the registry, logging instead of raising so startup never fails."""
+    try:
+        status = registry.warm()
+        logger.info(f"PromptX registry warmed: {status['load_times_ms']}")
+        return status
+    except Exception as e:
+        logger.warning(f"PromptX registry warm start failed: {e}")
+        return None
@@ -9,6 +9,7 @@ from .core.validator import PromptValidator
 from .core.fact_checker import FactChecker
 from .core.intent_classifier import IntentClassifier
 from .core.complexity_assessor import ComplexityAssessor
+from .core.registry import ModelRegistry
 
 
 class IntentClassifierTests(TestCase):
@@ -248,6 +249,29 @@ class PipelineTests(TestCase):
         self.assertIn(result.complexity, ['high', 'expert'])
 
 
+class ModelRegistryTests(TestCase):
+    def setUp(self):
+        self.registry = ModelRegistry()
+
+    def test_starts_cold(self):
+        self.assertEqual(self.registry.status()['state'], 'cold')
+
+    def test_pipeline_shared(self):
+        first = self.registry.get_pipeline()
+        second = self.registry.get_pipeline()
+        self.assertIs(first, second)
+        self.assertIs(first.analyzer, self.registry.get_analyzer())
+        self.assertEqual(self.registry.status()['state'], 'warm')
+
+    def test_model_loaded_once_under_concurrency(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            analyzers = list(pool.map(lambda _: self.registry.get_analyzer(), range(16)))
+        self.assertTrue(all(a is analyzers[0] for a in analyzers))
+        self.assertEqual(self.registry.load_counts['nlp'], 1)
+        self.assertEqual(self.registry.load_counts['analyzer'], 1)
+
+
 class APIEndpointTests(TestCase):
     def setUp(self):
         self.client = APIClient()
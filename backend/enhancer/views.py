@@ -15,9 +15,7 @@ from .serializers import (
     FeedbackSerializer,
     BatchEnhanceRequestSerializer,
 )
-from .core.pipeline import PromptXPipeline
-from .core.analyzer import PromptAnalyzer
-from .core.quality_scorer import QualityScorer
+from .core.registry import registry, get_pipeline, get_analyzer
 from .models import PromptHistory
 from .utils.text_processing import hash_text
 
@@ -52,8 +50,8 @@ class EnhancePromptView(APIView):
             cached['from_cache'] = True
             return Response(cached, status=status.HTTP_200_OK)
 
-        # Execute pipeline
-        pipeline = PromptXPipeline()
+        # Execute pipeline (shared, warm instance)
+        pipeline = get_pipeline()
         result = pipeline.execute(
             prompt=prompt,
             enhancement_level=level,
@@ -119,7 +117,7 @@ class AnalyzePromptView(APIView):
 
         prompt = serializer.validated_data['prompt']
 
-        analyzer = PromptAnalyzer()
+        analyzer = get_analyzer()
         analysis = analyzer.analyze(prompt)
 
         return Response({
@@ -280,8 +278,7 @@ class ComparePromptsView(APIView):
                 'details': serializer.errors,
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        scorer = QualityScorer()
-        analyzer = PromptAnalyzer()
+        analyzer = get_analyzer()
 
         prompt_a = serializer.validated_data['prompt_a']
         prompt_b = serializer.validated_data['prompt_b']
@@ -350,7 +347,7 @@ class BatchEnhanceView(APIView):
         prompts = serializer.validated_data['prompts']
         level = serializer.validated_data['enhancement_level']
 
-        pipeline = PromptXPipeline()
+        pipeline = get_pipeline()
         results = []
 
         for i, prompt in enumerate(prompts):
@@ -417,9 +414,12 @@ class HealthCheckView(APIView):
     permission_classes = [AllowAny]
 
     def get(self, request):
+        # Cold here means this request paid for the model load
+        was_warm = registry.is_warm
+
         # Quick pipeline test
         try:
-            pipeline = PromptXPipeline()
+            pipeline = get_pipeline()
             result = pipeline.execute("test prompt for health check", "basic")
             pipeline_ok = result.success
         except Exception:
@@ -428,5 +428,6 @@ class HealthCheckView(APIView):
         return Response({
             'status': 'healthy' if pipeline_ok else 'degraded',
             'pipeline': 'operational' if pipeline_ok else 'error',
+            'models': {**registry.status(), 'served_warm': was_warm},
             'version': '1.0.0',
         }, status=status.HTTP_200_OK)
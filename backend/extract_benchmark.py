@@ -0,0 +1,201 @@
+"""
+Page-extraction benchmark: the single-pass _TextExtractor against the regex chain it replaced.
+
+Both sides do what scrape_url needs from a page (title, text, internal
+links, rel=canonical). Run it over saved real-world pages:
+
+    python extract_benchmark.py --fetch https://stripe.com https://docs.python.org/3/ --corpus pages/
+    python extract_benchmark.py --corpus pages/ --repeat 5
+
+Next to the timings it prints how much text and how many links each
+side extracted, so a speed-up that comes from dropping content shows up
+(pages where the new text is under half the old are marked "!").
+
+--fetch downloads the given URLs into --corpus first. Without --corpus a
+generated corpus shaped like common pages is used (marketing homepage,
+docs page, single-page-app shell with a large inline state blob, pricing
+table, long blog post) plus malformed pages, where an unclosed <script>
+or <nav> makes the old backreferencing regex scan to the end of the
+document from every opening tag.
+
+The trade-off: the regex chain does its work in C, so on small,
+well-formed, tag-dense pages it can still win. On the generated pricing
+page (a 300-row table) it takes about 3 ms against about 4.5 ms for the
+single pass, down from about 10 ms when every tag went through
+html.parser (_TextExtractor now tokenises plain tags itself). Every
+other page is at parity or faster, and no page has a worst case.
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import crawler
+
+parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+parser.add_argument('--corpus', help='directory of saved .html pages (default: generated corpus)')
+parser.add_argument('--fetch', nargs='+', metavar='URL', help='download these pages into --corpus first')
+parser.add_argument('--repeat', type=int, default=3, help='passes over the corpus per implementation')
+parser.add_argument('--max-chars', type=int, default=6000)
+args = parser.parse_args()
+
+
+# ── the regex chain scrape_url used before the single-pass extractor ──
+
+def legacy_extract(html, url, max_chars):
+    from urllib.parse import urljoin, urlparse
+    title_match = re.search(r'<title[^>]*>(.*?)</title>', html, re.IGNORECASE | re.DOTALL)
+    title = re.sub(r'<[^>]+>', '', title_match.group(1)).strip() if title_match else ''
+    text = re.sub(
+        r'<(script|style|noscript|nav|footer|header|aside|iframe|svg|'
+        r'form|button|input|select|textarea|meta|link)[^>]*>.*?</\1>',
+        '', html, flags=re.IGNORECASE | re.DOTALL
+    )
+    text = re.sub(r'<[^>]+>', ' ', text)
+    for ent, ch in [
+        ('&amp;', '&'), ('&lt;', '<'), ('&gt;', '>'), ('&quot;', '"'),
+        ('&#39;', "'"), ('&nbsp;', ' '), ('&mdash;', '—'), ('&ndash;', '–'),
+        ('&hellip;', '...'), ('&copy;', '©'), ('&reg;', '®'),
+    ]:
+        text = text.replace(ent, ch)
+    text = re.sub(r'[ \t]+', ' ', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = '\n'.join(l.strip() for l in text.splitlines() if l.strip())
+    if len(text) > max_chars:
+        text = text[:max_chars] + f'\n[truncated at {max_chars} chars]'
+
+    base = urlparse(url)
+    links, seen = [], set()
+    for href in re.findall(r'<a[^>]+href=["\']([^"\'#?]+)["\']', html, re.IGNORECASE):
+        full = urljoin(f'{base.scheme}://{base.netloc}', href)
+        parsed = urlparse(full)
+        if (parsed.netloc == base.netloc and full not in seen and
+                not re.search(r'\.(pdf|jpg|png|gif|svg|zip|css|js|ico|woff)$', parsed.path, re.I)):
+            seen.add(full)
+            links.append(full)
+    canonical = re.search(
+        r'<link[^>]+rel=["\']canonical["\'][^>]*href=["\']([^"\']+)["\']'
+        r'|<link[^>]+href=["\']([^"\']+)["\'][^>]*rel=["\']canonical["\']', html, re.IGNORECASE)
+    return title, text, links, canonical and urljoin(url, canonical.group(1) or canonical.group(2))
+
+
+def single_pass_extract(html, url, max_chars):
+    extractor = crawler._TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return (extractor.title(), crawler._truncate_text(extractor.text(), max_chars),
+            extractor.links(url), extractor.canonical(url))
+
+
+# ── corpus ──
+
+def _nav(n):
+    return '<nav><ul>' + ''.join(f'<li><a href="/section-{i}/">Section {i}</a></li>' for i in range(n)) + '</ul></nav>'
+
+
+def _paragraphs(n, words=60):
+    return ''.join(f'<p>Paragraph {i} &mdash; ' + 'lorem ipsum dolor sit amet &amp; more ' * (words // 6) + '</p>'
+                   for i in range(n))
+
+
+def generated_corpus():
+    head = '<!doctype html><html><head><meta charset="utf-8"><title>{t} &ndash; Acme</title>' \
+           '<link rel="canonical" href="https://acme.test/{slug}"><style>' + 'body{{margin:0}}' * 200 + '</style></head><body>'
+    foot = '<footer>' + _nav(40) + '&copy; Acme</footer></body></html>'
+    pages = {
+        'homepage': head.format(t='Home', slug='') + _nav(60) + '<main><h1>Acme</h1>' + _paragraphs(20) + '</main>'
+        + '<script>' + 'window.x=1;' * 2000 + '</script>' + foot,
+        'docs': head.format(t='Docs', slug='docs') + _nav(200) + '<article>'
+        + ''.join(f'<h2>Endpoint {i}</h2><pre><code>GET /v1/items/{i}?limit=10</code></pre>' + _paragraphs(3)
+                  for i in range(80)) + '</article>' + foot,
+        'spa-shell': head.format(t='App', slug='app') + '<div id="root"></div><script id="__NEXT_DATA__">'
+        + '{"props":{"items":[' + ','.join(f'{{"id":{i},"name":"item {i}","html":"<p>x</p>"}}' for i in range(20000))
+        + ']}}</script>' + foot,
+        'pricing': head.format(t='Pricing', slug='pricing') + _nav(60) + '<table>'
+        + ''.join(f'<tr><td>Plan {i}</td><td>${i * 10}/mo</td><td>{i * 5} seats</td></tr>' for i in range(300))
+        + '</table>' + foot,
+        'blog-post': head.format(t='Post', slug='blog/post') + _nav(60) + '<article>' + _paragraphs(400) + '</article>' + foot,
+        # Malformed: the backreference scans to the end of the page from every unclosed opening tag
+        'unclosed-script': head.format(t='Broken', slug='broken') + _paragraphs(200)
+        + '<script>var a = 1;' * 300 + _paragraphs(200) + '</body></html>',
+        'unclosed-nav': head.format(t='Broken nav', slug='broken-nav') + '<nav><a href="/a">a</a>' * 400
+        + _paragraphs(300) + '</body></html>',
+    }
+    return {name: (html, f'https://acme.test/{name}') for name, html in pages.items()}
+
+
+def load_corpus(directory):
+    corpus = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(('.html', '.htm')):
+            with open(os.path.join(directory, name), 'rb') as f:
+                html = f.read().decode('utf-8', errors='replace')
+            url = re.search(r'<link[^>]+rel=["\']canonical["\'][^>]*href=["\']([^"\']+)', html, re.IGNORECASE)
+            corpus[name] = (html, url.group(1) if url else 'https://example.com/')
+    return corpus
+
+
+def fetch_corpus(urls, directory):
+    import requests
+    os.makedirs(directory, exist_ok=True)
+    for url in urls:
+        try:
+            resp = requests.get(url, headers=crawler._SCRAPE_HEADERS, timeout=20)
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            print(f"  skipped {url}: {e}")
+            continue
+        name = re.sub(r'[^\w.-]+', '_', url.split('://', 1)[-1]).strip('_')[:80] + '.html'
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(resp.content)
+        print(f"  saved {url} -> {name} ({len(resp.content) / 1024:.0f} KB)")
+
+
+# ── run ──
+
+if args.fetch:
+    if not args.corpus:
+        parser.error('--fetch needs --corpus')
+    fetch_corpus(args.fetch, args.corpus)
+corpus = load_corpus(args.corpus) if args.corpus else generated_corpus()
+if not corpus:
+    sys.exit(f"No .html pages in {args.corpus}")
+total_mb = sum(len(html.encode('utf-8')) for html, _ in corpus.values()) / 1024 / 1024
+print(f"{len(corpus)} pages, {total_mb:.1f} MB, {args.repeat} passes\n")
+
+implementations = {'regex chain': legacy_extract, 'single pass': single_pass_extract}
+timings = {impl: {name: [] for name in corpus} for impl in implementations}
+outputs = {}
+for _ in range(args.repeat):
+    for impl, extract in implementations.items():
+        for name, (html, url) in corpus.items():
+            started = time.perf_counter()
+            outputs[impl, name] = extract(html, url, args.max_chars)
+            timings[impl][name].append((time.perf_counter() - started) * 1000)
+
+width = max(len(name) for name in corpus)
+print(f"{'page':<{width}}  {'KB':>7}  " + '  '.join(f'{impl:>14}' for impl in implementations)
+      + '  text chars (old/new)  links (old/new)')
+text_chars = {impl: 0 for impl in implementations}
+for name, (html, _) in corpus.items():
+    row = '  '.join(f'{min(timings[impl][name]):>11.1f} ms' for impl in implementations)
+    old_text, new_text = len(outputs['regex chain', name][1]), len(outputs['single pass', name][1])
+    text_chars['regex chain'] += old_text
+    text_chars['single pass'] += new_text
+    text = f"{old_text}/{new_text}" + (' !' if new_text < old_text / 2 else '  ')
+    links = f"{len(outputs['regex chain', name][2])}/{len(outputs['single pass', name][2])}"
+    print(f"{name:<{width}}  {len(html) / 1024:>7.0f}  {row}  {text:>21}  {links:>15}")
+
+print()
+for impl in implementations:
+    best = [min(t) for t in timings[impl].values()]
+    total = sum(best)
+    print(
+        f"{impl:<12} total {total:8.1f} ms | {total_mb / (total / 1000):6.1f} MB/s | "
+        f"median page {statistics.median(best):7.2f} ms | worst page {max(best):8.1f} ms | "
+        f"text {text_chars[impl]:,} chars"
+    )
@@ -0,0 +1,54 @@
+"""
+Gunicorn configuration for PromptX.
+
+    gunicorn -c gunicorn.conf.py promptx_project.wsgi:application
+
+Set PROMPTX_PRELOAD=true to load the spaCy model, enhancer pattern tables
+and provider SDKs in the master before forking, so workers share them
+copy-on-write. Each worker logs its RSS/PSS/USS once the app is loaded;
+compare a PROMPTX_PRELOAD=true run against PROMPTX_WARM_START=true (each
+worker loads its own copy) with memory_report.py to see the saving.
+
+Set PROMPTX_ASGI=true (and serve promptx_project.asgi:application) to run
+uvicorn workers, where one worker holds many in-flight provider calls.
+"""
+
+import os
+
+from promptx_project.preload import (
+    preload_enabled, asgi_enabled, preload_shared_state, freeze_heap, memory_report,
+)
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WORKERS', 4))
+timeout = int(os.getenv('TIMEOUT', 120))
+keepalive = int(os.getenv('KEEP_ALIVE', 2))
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', 30))
+max_requests = int(os.getenv('MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.getenv('MAX_REQUESTS_JITTER', 100))
+loglevel = os.getenv('LOG_LEVEL', 'info')
+
+preload_app = preload_enabled()
+
+if asgi_enabled():
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    wsgi_app = 'promptx_project.asgi:application'
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    timings = preload_shared_state()
+    frozen = freeze_heap()
+    server.log.info(f"Preloaded shared state: {timings}")
+    server.log.info(f"Froze {frozen} objects before fork; master memory: {memory_report()}")
+
+
+def post_worker_init(worker):
+    if preload_app:
+        from providers import prewarm_clients
+        prewarm_clients()
+    worker.log.info(
+        f"Worker {worker.pid} ready ({'preloaded' if preload_app else 'no preload'}): "
+        f"{memory_report(worker.pid)}"
+    )
@@ -0,0 +1,156 @@
+"""
+Throughput / tail-latency benchmark of the PromptX API on recorded provider responses.
+
+Record a cassette once with real provider keys (every distinct call is appended):
+
+    PROMPTX_PROVIDER_BACKEND=record python load_benchmark.py --requests 30 --concurrency 3
+
+Then replay it offline as often as needed; no network or quota is used:
+
+    python load_benchmark.py --requests 500 --concurrency 32
+    python load_benchmark.py --endpoint ab-test --latency-scale 0.5
+
+Without --url the Django ASGI app runs in this process behind httpx's
+ASGI transport, so the whole stack (middleware, views, fallback, hedging)
+is measured. With --url a running server is driven instead; start it with
+PROMPTX_PROVIDER_BACKEND=replay RATELIMIT_ENABLE=false. analyze-url still
+crawls the live site; only the provider calls come from the cassette.
+
+--simulate runs provider_simulator.py in this process and points the live
+provider clients at it instead, to see how fallback and timeouts behave
+when upstreams are slow, rate limited or hanging:
+
+    python load_benchmark.py --simulate scenario.json --provider-timeout 5
+    python load_benchmark.py --simulate default --requests 100
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+PROMPTS = [
+    "Write a blog post about remote work productivity",
+    "Create a python function that merges two sorted lists",
+    "Explain the CAP theorem to a junior developer",
+    "Draft a product launch email for a note-taking app",
+    "Summarise the key ideas of event sourcing",
+    "Plan a 3 day itinerary for Lisbon on a budget",
+    "Write unit tests for a REST API that manages todos",
+    "Compare PostgreSQL and MongoDB for an analytics workload",
+]
+
+parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+parser.add_argument('--endpoint', default='enhance', choices=['enhance', 'ab-test', 'analyze-url'])
+parser.add_argument('--requests', type=int, default=200)
+parser.add_argument('--concurrency', type=int, default=16)
+parser.add_argument('--url', help='base URL of a running server (default: in-process ASGI app)')
+parser.add_argument('--site', default='https://example.com', help='site for --endpoint analyze-url')
+parser.add_argument('--latency-scale', type=float, default=None, help='replay latency multiplier')
+parser.add_argument('--cached', action='store_true', help='keep the response and near-duplicate caches on')
+parser.add_argument('--simulate', metavar='SCENARIO', help="provider_simulator scenario file, or 'default'")
+parser.add_argument('--provider-timeout', type=float, help='PROMPTX_PROVIDER_TIMEOUT/GEMINI_TIMEOUT for this run')
+args = parser.parse_args()
+
+simulator = None
+if args.simulate:
+    import threading
+    from provider_simulator import make_server
+    scenario = {}
+    if args.simulate != 'default':
+        with open(args.simulate) as f:
+            scenario = json.load(f)
+    simulator = make_server('127.0.0.1', 0, scenario)
+    threading.Thread(target=simulator.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{simulator.server_port}'
+    os.environ.update({
+        'PROMPTX_PROVIDER_BACKEND': 'live',
+        'PROMPTX_GEMINI_BACKEND': 'google',
+        'PROMPTX_GROQ_BASE_URL': f'{base}/groq/openai/v1',
+        'PROMPTX_NVIDIA_BASE_URL': f'{base}/nvidia/v1',
+        'PROMPTX_GEMINI_BASE_URL': f'{base}/gemini',
+    })
+    for name in ('GEMINI_API_KEY', 'GROQ_API_KEY', 'NVIDIA_API_KEY'):
+        os.environ.setdefault(name, 'simulated')
+if args.provider_timeout is not None:
+    os.environ['PROMPTX_PROVIDER_TIMEOUT'] = os.environ['PROMPTX_GEMINI_TIMEOUT'] = str(args.provider_timeout)
+
+# In-process runs configure the app before Django loads
+os.environ.setdefault('PROMPTX_PROVIDER_BACKEND', 'replay')
+os.environ['RATELIMIT_ENABLE'] = 'false'
+if args.latency_scale is not None:
+    os.environ['PROMPTX_REPLAY_LATENCY_SCALE'] = str(args.latency_scale)
+if not args.cached:
+    os.environ['PROMPTX_RESPONSE_TTL'] = '0'
+    for route in ('GREETING', 'ENHANCEMENT', 'DEEP_RESEARCH'):
+        os.environ[f'PROMPTX_NEAR_DUP_{route}'] = '2'
+
+
+def payload(i):
+    prompt = PROMPTS[i % len(PROMPTS)]
+    if args.endpoint == 'analyze-url':
+        return {'url': args.site, 'question': prompt}
+    return {'prompt': prompt}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def run():
+    import httpx
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=300)
+    else:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'promptx_project.settings')
+        from promptx_project.asgi import application
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=application), base_url='http://bench', timeout=300)
+
+    latencies, statuses, models = [], {}, {}
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            i = queue.get_nowait()
+            started = time.perf_counter()
+            response = await client.post(f'/api/{args.endpoint}', json=payload(i))
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            try:
+                model = response.json().get('model', '?')
+            except json.JSONDecodeError:
+                model = '?'
+            models[model] = models.get(model, 0) + 1
+
+    started = time.perf_counter()
+    async with client:
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    return elapsed, latencies, statuses, models
+
+
+elapsed, latencies, statuses, models = asyncio.run(run())
+
+print("\n" + "="*60)
+backend = 'simulator' if simulator else os.environ['PROMPTX_PROVIDER_BACKEND']
+print(f"PROMPTX LOAD BENCHMARK  /api/{args.endpoint}  ({backend})")
+print("="*60 + "\n")
+print(f"Requests:      {len(latencies)}  (concurrency {args.concurrency})")
+print(f"Throughput:    {len(latencies) / elapsed:.1f} req/s over {elapsed:.2f}s")
+print(f"Latency ms:    p50 {percentile(latencies, 50):.0f}   p90 {percentile(latencies, 90):.0f}   "
+      f"p99 {percentile(latencies, 99):.0f}   max {max(latencies):.0f}   mean {statistics.mean(latencies):.0f}")
+print(f"Status codes:  {statuses}")
+print(f"Models:        {models}")
+if not args.url:
+    from services import provider_stats
+    stats = provider_stats()
+    print(f"Cassette:      {stats['cassette']}")
+    if simulator:
+        print(f"Upstream:      {simulator.RequestHandlerClass.sim.stats}")
+        print(f"Health:        {stats['health']}")
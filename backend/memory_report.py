@@ -0,0 +1,33 @@
+"""Print RSS / PSS / USS for the gunicorn master and each of its workers"""
+import os
+import sys
+
+from promptx_project.preload import cluster_report
+
+PID_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.promptx.gunicorn.pid')
+
+if len(sys.argv) > 1:
+    master_pid = int(sys.argv[1])
+elif os.path.exists(PID_FILE):
+    with open(PID_FILE) as f:
+        master_pid = int(f.read().strip())
+else:
+    print(f"Usage: python memory_report.py <gunicorn-master-pid>  (no {PID_FILE} found)")
+    exit(1)
+
+report = cluster_report(master_pid)
+
+print("\n" + "="*60)
+print(f"PROMPTX MEMORY REPORT (master {master_pid})")
+print("="*60 + "\n")
+print(f"{'process':<10} {'pid':>8} {'RSS MB':>10} {'PSS MB':>10} {'USS MB':>10} {'shared MB':>10}")
+
+rows = [('master', report['master'])] + [('worker', w) for w in report['workers']]
+for label, m in rows:
+    print(f"{label:<10} {m['pid']:>8} {m['rss_mb']:>10} {m['pss_mb']:>10} {m['uss_mb']:>10} {m['shared_mb']:>10}")
+
+print()
+print(f"Workers:              {len(report['workers'])}")
+print(f"Total RSS:            {report['total_rss_mb']} MB  (double-counts shared pages)")
+print(f"Total PSS:            {report['total_pss_mb']} MB  (real footprint)")
+print(f"Avg worker USS:       {report['avg_worker_uss_mb']} MB  (cost of one more worker)")
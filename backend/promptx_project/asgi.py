@@ -0,0 +1,18 @@
+"""
+ASGI config for PromptX project.
+
+The LLM-bound endpoints are async views; under ASGI they await provider
+calls on the worker's event loop instead of holding a thread each:
+
+    PROMPTX_ASGI=true gunicorn -c gunicorn.conf.py promptx_project.asgi:application
+"""
+
+import os
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'promptx_project.settings')
+
+application = get_asgi_application()
+
+from promptx_project.preload import warm_worker
+warm_worker()
@@ -0,0 +1,154 @@
+"""
+Pre-fork preloading and per-worker memory reporting.
+
+With gunicorn's preload_app the master imports the WSGI app once. Loading
+the spaCy model, the enhancer pattern tables and the provider SDKs there
+and then moving everything into the GC's permanent generation
+(gc.freeze) lets forked workers share those pages copy-on-write instead
+of each holding a private copy.
+"""
+
+import gc
+import os
+import time
+import logging
+import importlib
+
+logger = logging.getLogger(__name__)
+
+# Heavy modules every worker needs; imported once in the master.
+PRELOAD_MODULES = [
+    'enhancer.utils.constants',
+    'services',
+    'google.genai',
+    'openai',
+    'httpx',
+    'tiktoken',
+]
+
+
+def preload_enabled() -> bool:
+    return os.getenv('PROMPTX_PRELOAD', 'false').lower() in ('true', '1', 'yes')
+
+
+def asgi_enabled() -> bool:
+    """Serve promptx_project.asgi with uvicorn workers instead of sync WSGI workers."""
+    return os.getenv('PROMPTX_ASGI', 'false').lower() in ('true', '1', 'yes')
+
+
+def warm_worker():
+    """
+    PROMPTX_WARM_START hook shared by wsgi.py and asgi.py: load the spaCy
+    model and enhancer pipeline once per worker at startup instead of on
+    the first request that needs them.
+    """
+    if os.getenv('PROMPTX_WARM_START', 'false').lower() not in ('true', '1', 'yes'):
+        return
+    from enhancer.core.registry import warm_start
+    warm_start()
+
+    # Provider clients hold connection pools, so they must be built after
+    # fork; under gunicorn --preload this module runs in the master and
+    # gunicorn.conf.py prewarms each worker instead.
+    if not preload_enabled():
+        from providers import prewarm_clients
+        prewarm_clients()
+
+
+def preload_shared_state() -> dict:
+    """
+    Import heavy modules and warm the enhancer registry in the current
+    (master) process. Never opens network connections, since sockets must
+    not be shared across fork.
+    """
+    timings = {}
+    for name in PRELOAD_MODULES:
+        started = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.warning(f"Preload skipped {name}: {e}")
+            continue
+        timings[name] = round((time.perf_counter() - started) * 1000, 2)
+
+    from enhancer.core.registry import warm_start
+    timings['registry'] = warm_start()
+    return timings
+
+
+def freeze_heap() -> int:
+    """Collect once, then exempt every surviving object from future GC passes.
+
+    Without this, the first collection in each worker touches the refcount
+    and GC headers of the inherited objects and un-shares their pages.
+    """
+    gc.collect()
+    gc.freeze()
+    return gc.get_freeze_count()
+
+
+def memory_report(pid=None) -> dict:
+    """
+    RSS / PSS / USS of a process in MB.
+
+    USS (private pages) is what a worker really costs; PSS splits shared
+    pages evenly between the processes mapping them. Both come from
+    /proc/<pid>/smaps_rollup, so they are only available on Linux.
+    """
+    pid = pid or os.getpid()
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1])
+    except OSError:
+        import resource
+        maxrss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {'pid': pid, 'rss_mb': round(maxrss_kb / 1024, 1),
+                'pss_mb': None, 'uss_mb': None, 'shared_mb': None}
+
+    uss = fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    shared = fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0)
+    return {
+        'pid': pid,
+        'rss_mb': round(fields.get('Rss', 0) / 1024, 1),
+        'pss_mb': round(fields.get('Pss', 0) / 1024, 1),
+        'uss_mb': round(uss / 1024, 1),
+        'shared_mb': round(shared / 1024, 1),
+    }
+
+
+def child_pids(master_pid: int) -> list:
+    """PIDs whose parent is master_pid (i.e. gunicorn workers)."""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # Field 4 is the ppid; the command name in field 2 may contain spaces
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        if ppid == master_pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def cluster_report(master_pid: int) -> dict:
+    """Memory of the master and each of its workers, plus totals."""
+    master = memory_report(master_pid)
+    workers = [memory_report(pid) for pid in child_pids(master_pid)]
+    processes = [master] + workers
+    return {
+        'master': master,
+        'workers': workers,
+        'total_rss_mb': round(sum(p['rss_mb'] or 0 for p in processes), 1),
+        'total_pss_mb': round(sum(p['pss_mb'] or 0 for p in processes), 1),
+        'avg_worker_uss_mb': round(
+            sum(w['uss_mb'] or 0 for w in workers) / len(workers), 1
+        ) if workers else 0,
+    }
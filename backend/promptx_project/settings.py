@@ -130,6 +130,12 @@ DATABASES = {
     }
 }
 
+# django-ratelimit; switch off only for local load benchmarks
+RATELIMIT_ENABLE = os.getenv('RATELIMIT_ENABLE', 'true').lower() in ('true', '1', 'yes')
+
+# Bearer token for /api/stats (staff sessions need none); unset leaves it to staff only
+STATS_TOKEN = os.getenv('PROMPTX_STATS_TOKEN', '')
+
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
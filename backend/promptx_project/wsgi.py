@@ -8,3 +8,6 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'promptx_project.settings')
 
 application = get_wsgi_application()
+
+from promptx_project.preload import warm_worker
+warm_worker()
@@ -0,0 +1,272 @@
+"""
+Fault-injecting stand-in for the Groq, NVIDIA and Gemini APIs.
+
+    python provider_simulator.py --port 8900 --latency-p50 400 --latency-p99 4000 --rate-429 0.1
+
+then point the backend at it (any key value is accepted):
+
+    PROMPTX_GROQ_BASE_URL=http://127.0.0.1:8900/groq/openai/v1
+    PROMPTX_NVIDIA_BASE_URL=http://127.0.0.1:8900/nvidia/v1
+    PROMPTX_GEMINI_BASE_URL=http://127.0.0.1:8900/gemini
+
+It speaks the OpenAI-compatible chat completions API (JSON and SSE) under
+/groq and /nvidia, and Gemini's generateContent, streamGenerateContent
+and cachedContents under /gemini. Every request draws its fate from the
+scenario: a latency sample, a 429 with Retry-After, a 5xx (randomly or
+inside periodic bursts), or a connection that hangs without answering.
+Streams drip one word per drip_ms. A JSON scenario file can override
+the defaults per provider:
+
+    {"default": {"latency": {"dist": "uniform", "min": 100, "max": 300}},
+     "gemini": {"rate_429": 1.0, "retry_after": 30}}
+
+GET /_stats returns per-provider outcome counts, and POST /_scenario
+replaces the scenario of a running simulator.
+"""
+import re
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_FAULTS = {
+    'latency': {'dist': 'lognormal', 'p50': 300, 'p99': 2000},  # ms before the first byte
+    'rate_429': 0.0,        # share of requests answered 429
+    'retry_after': 20,      # seconds, sent as Retry-After and in the error body
+    'rate_5xx': 0.0,        # share of requests answered with status_5xx
+    'status_5xx': 503,
+    'burst_every_s': 0,     # every N seconds...
+    'burst_for_s': 0,       # ...fail everything with status_5xx for this long
+    'hang_rate': 0.0,       # share of requests that never get an answer
+    'hang_s': 600,
+    'drip_ms': 20,          # delay between streamed words
+    'words': 80,            # length of a generated answer
+}
+
+_GEMINI_PATH_RE = re.compile(r'/models/([^/:]+):(generateContent|streamGenerateContent)')
+
+
+def sample_latency(spec):
+    """Milliseconds drawn from a 'fixed', 'uniform' or 'lognormal' (p50/p99) spec."""
+    dist = spec.get('dist', 'fixed')
+    if dist == 'uniform':
+        return random.uniform(spec['min'], spec['max'])
+    if dist == 'lognormal':
+        sigma = math.log(spec['p99'] / spec['p50']) / 2.326
+        return random.lognormvariate(math.log(spec['p50']), sigma)
+    return spec.get('ms', 0)
+
+
+class Simulator:
+    """Scenario, outcome counters and answer text shared by all handler threads."""
+
+    def __init__(self, scenario=None):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.caches = {}
+        self.set_scenario(scenario or {})
+
+    def set_scenario(self, scenario):
+        with self.lock:
+            self.scenario = scenario
+
+    def faults(self, provider):
+        with self.lock:
+            return {**DEFAULT_FAULTS, **self.scenario.get('default', {}), **self.scenario.get(provider, {})}
+
+    def count(self, provider, outcome):
+        with self.lock:
+            counters = self.stats.setdefault(provider, {})
+            counters[outcome] = counters.get(outcome, 0) + 1
+
+    def fate(self, provider, faults):
+        """'hang', '429', '5xx' or 'ok' for the next request."""
+        every, length = faults['burst_every_s'], faults['burst_for_s']
+        if every and (time.time() - self.started) % every < length:
+            return '5xx'
+        roll = random.random()
+        for outcome, rate in (('hang', faults['hang_rate']), ('429', faults['rate_429']), ('5xx', faults['rate_5xx'])):
+            if roll < rate:
+                return outcome
+            roll -= rate
+        return 'ok'
+
+    def answer(self, provider, prompt, faults):
+        words = (prompt.split() or ['simulated']) * (faults['words'] // max(1, len(prompt.split())) + 1)
+        return f"[{provider} simulator] " + ' '.join(words[:faults['words']])
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    sim = None  # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_sse(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+    def _event(self, payload):
+        self.wfile.write(f"data: {payload}\n\n".encode('utf-8'))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == '/_stats':
+            with self.sim.lock:
+                return self._json(200, {'uptime_s': round(time.time() - self.sim.started, 1), 'providers': self.sim.stats})
+        self._json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        path = self.path.split('?', 1)[0]
+        if path == '/_scenario':
+            self.sim.set_scenario(body)
+            return self._json(200, {'ok': True})
+
+        provider = path.strip('/').split('/', 1)[0]
+        if provider == 'gemini' and path.endswith('/cachedContents'):
+            name = f"cachedContents/sim-{len(self.sim.caches) + 1}"
+            self.sim.caches[name] = body
+            return self._json(200, {'name': name, 'model': body.get('model')})
+        if provider in ('groq', 'nvidia') and path.endswith('/chat/completions'):
+            prompt = ' '.join(str(m.get('content', '')) for m in body.get('messages', []))
+            return self._serve(provider, prompt, bool(body.get('stream')), self._openai_chunk, self._openai_reply, body.get('model'))
+        match = _GEMINI_PATH_RE.search(path)
+        if provider == 'gemini' and match:
+            prompt = ' '.join(
+                part.get('text', '') for content in body.get('contents', []) for part in content.get('parts', [])
+            )
+            return self._serve(provider, prompt, match.group(2) == 'streamGenerateContent',
+                               self._gemini_chunk, self._gemini_reply, match.group(1))
+        self._json(404, {'error': f'unknown endpoint {path}'})
+
+    def _serve(self, provider, prompt, stream, chunk, reply, model):
+        faults = self.sim.faults(provider)
+        fate = self.sim.fate(provider, faults)
+        self.sim.count(provider, fate)
+        if fate == 'hang':
+            time.sleep(faults['hang_s'])
+            self.close_connection = True
+            return
+        time.sleep(sample_latency(faults['latency']) / 1000)
+        if fate == '429':
+            return self._json(429, {'error': {
+                'code': 429, 'status': 'RESOURCE_EXHAUSTED',
+                'message': f"Simulated quota exceeded. Please retry in {faults['retry_after']}s.",
+            }}, headers={'Retry-After': str(faults['retry_after'])})
+        if fate == '5xx':
+            return self._json(faults['status_5xx'], {'error': {
+                'code': faults['status_5xx'], 'status': 'UNAVAILABLE', 'message': 'Simulated upstream failure',
+            }})
+
+        text = self.sim.answer(provider, prompt, faults)
+        if not stream:
+            return self._json(200, reply(model, text, prompt))
+        self._start_sse()
+        try:
+            words = text.split(' ')
+            for i, word in enumerate(words):
+                self._event(json.dumps(chunk(model, word if i == len(words) - 1 else word + ' ')))
+                time.sleep(faults['drip_ms'] / 1000)
+            if provider != 'gemini':
+                self._event('[DONE]')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    # ── wire formats ─────────────────────────────────────────────────────
+
+    @staticmethod
+    def _usage(prompt, text):
+        return len(prompt.split()), len(text.split())
+
+    def _openai_reply(self, model, text, prompt):
+        prompt_tokens, output_tokens = self._usage(prompt, text)
+        return {
+            'id': f'chatcmpl-sim-{random.getrandbits(32):x}', 'object': 'chat.completion',
+            'created': int(time.time()), 'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': output_tokens,
+                      'total_tokens': prompt_tokens + output_tokens},
+        }
+
+    def _openai_chunk(self, model, text):
+        return {
+            'id': 'chatcmpl-sim', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+            'choices': [{'index': 0, 'delta': {'content': text}, 'finish_reason': None}],
+        }
+
+    def _gemini_reply(self, model, text, prompt):
+        prompt_tokens, output_tokens = self._usage(prompt, text)
+        return {
+            'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]}, 'finishReason': 'STOP'}],
+            'usageMetadata': {'promptTokenCount': prompt_tokens, 'candidatesTokenCount': output_tokens,
+                              'totalTokenCount': prompt_tokens + output_tokens},
+            'modelVersion': model,
+        }
+
+    def _gemini_chunk(self, model, text):
+        return {'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]}}], 'modelVersion': model}
+
+
+def make_server(host='127.0.0.1', port=8900, scenario=None):
+    """A ThreadingHTTPServer running the simulator; port 0 picks a free port."""
+    handler = type('SimulatorHandler', (Handler,), {'sim': Simulator(scenario)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--scenario', help='JSON scenario file (per-provider overrides)')
+    parser.add_argument('--latency-p50', type=float, help='lognormal latency median, ms')
+    parser.add_argument('--latency-p99', type=float, help='lognormal latency p99, ms')
+    for name in ('rate_429', 'retry_after', 'rate_5xx', 'status_5xx', 'burst_every_s', 'burst_for_s',
+                 'hang_rate', 'hang_s', 'drip_ms', 'words'):
+        parser.add_argument('--' + name.replace('_', '-'), dest=name, type=float)
+    args = parser.parse_args()
+
+    scenario = {}
+    if args.scenario:
+        with open(args.scenario) as f:
+            scenario = json.load(f)
+    default = scenario.setdefault('default', {})
+    if args.latency_p50:
+        p50 = args.latency_p50
+        default['latency'] = {'dist': 'lognormal', 'p50': p50, 'p99': max(args.latency_p99 or p50 * 4, p50 * 1.01)}
+    for name in DEFAULT_FAULTS:
+        value = getattr(args, name, None)
+        if value is not None:
+            default[name] = int(value) if name in ('status_5xx', 'words') else value
+
+    server = make_server(args.host, args.port, scenario)
+    print(f"Provider simulator on http://{args.host}:{server.server_port}  scenario: {json.dumps(scenario)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2165 @@
+"""
+PromptX providers - Gemini / NVIDIA / Groq clients, quota and health tracking, token budgets,
+deadlines, multi-model fallback (threads and asyncio)
+"""
+from google import genai
+import os
+import re
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import json
+import math
+import random
+import asyncio
+import time
+import hashlib
+import threading
+import contextvars
+import inspect
+import weakref
+from functools import lru_cache
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from caches import CACHE_DIR, _SingleFlight, _hash_key, _normalise_prompt, _response_store
+
+
+# ============================================================================
+# PROVIDER CLIENT POOL
+# ============================================================================
+
+# Base URLs can point at provider_simulator.py (or any compatible proxy)
+_NVIDIA_BASE_URL = os.getenv('PROMPTX_NVIDIA_BASE_URL') or "https://integrate.api.nvidia.com/v1"
+_GROQ_BASE_URL = (os.getenv('PROMPTX_GROQ_BASE_URL') or 'https://api.groq.com/openai/v1').rstrip('/')
+_GEMINI_BASE_URL = os.getenv('PROMPTX_GEMINI_BASE_URL') or None
+
+# Whole-request timeouts in seconds. Gemini's default is longer because
+# 8k-token deep-research answers from gemini_pro take over a minute.
+PROVIDER_TIMEOUT = float(os.getenv('PROMPTX_PROVIDER_TIMEOUT', 60))
+GEMINI_TIMEOUT = float(os.getenv('PROMPTX_GEMINI_TIMEOUT', 120))
+
+_MODEL_PROVIDERS = {
+    'gemini_flash': 'gemini',
+    'gemini_flash_8b': 'gemini',
+    'gemini_pro': 'gemini',
+    'nvidia_minimax': 'nvidia',
+    'groq': 'groq',
+}
+
+_PROVIDER_KEY_ENV = {
+    'gemini': 'GEMINI_API_KEY',
+    'nvidia': 'NVIDIA_API_KEY',
+    'groq': 'GROQ_API_KEY',
+}
+
+
+def _build_gemini_client(key):
+    if os.getenv('PROMPTX_GEMINI_BACKEND', 'google') == 'local':
+        return LocalGeminiClient()
+    http_options = {'timeout': int(GEMINI_TIMEOUT * 1000)}
+    if _GEMINI_BASE_URL:
+        http_options['base_url'] = _GEMINI_BASE_URL
+    return genai.Client(api_key=key, http_options=http_options)
+
+
+def _build_nvidia_client(key):
+    from openai import OpenAI
+    import httpx
+    return OpenAI(
+        base_url=_NVIDIA_BASE_URL,
+        api_key=key,
+        timeout=httpx.Timeout(PROVIDER_TIMEOUT, connect=10.0),  # total, 10s connect
+        http_client=httpx.Client(
+            timeout=httpx.Timeout(PROVIDER_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=120),
+        ),
+    )
+
+
+def _build_groq_client(key):
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    session.headers['Authorization'] = f'Bearer {key}'
+    session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=20))
+    return session
+
+
+class ProviderClientPool:
+    """
+    Bounded LRU of long-lived provider clients keyed by (provider, hashed key).
+
+    Reusing a client keeps its HTTP keep-alive pool, so repeat calls skip
+    the TCP + TLS handshake. Server-default keys live until idle_ttl;
+    user-supplied X-API-Key clients get the much shorter user_ttl.
+    Evicted clients are only dropped, never closed, because another thread
+    may still be mid-request on them.
+    """
+
+    FACTORIES = {
+        'gemini': _build_gemini_client,
+        'nvidia': _build_nvidia_client,
+        'groq': _build_groq_client,
+    }
+
+    def __init__(self, capacity=32, idle_ttl=1800, user_ttl=300):
+        self.capacity = capacity
+        self.idle_ttl = idle_ttl
+        self.user_ttl = user_ttl
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, provider, api_key, user_supplied=False):
+        pool_key = (provider, _hash_key(api_key))
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(pool_key)
+            if entry:
+                self._clients.move_to_end(pool_key)
+                entry['last_used'] = now
+                self.hits += 1
+                return entry['client']
+            self.misses += 1
+
+        # Build outside the lock — constructing SDK clients is not free
+        client = self.FACTORIES[provider](api_key)
+
+        with self._lock:
+            entry = self._clients.get(pool_key)
+            if entry:
+                return entry['client']
+            self._clients[pool_key] = {
+                'client': client,
+                'last_used': now,
+                'ttl': self.user_ttl if user_supplied else self.idle_ttl,
+            }
+            while len(self._clients) > self.capacity:
+                self._clients.popitem(last=False)
+                self.evictions += 1
+        return client
+
+    def _evict_idle(self, now):
+        expired = [k for k, e in self._clients.items() if now - e['last_used'] > e['ttl']]
+        for k in expired:
+            del self._clients[k]
+        self.evictions += len(expired)
+
+    def prewarm(self):
+        """Build clients for every server-default key present in the environment."""
+        warmed = []
+        for provider, env_var in _PROVIDER_KEY_ENV.items():
+            key = os.getenv(env_var)
+            if not key:
+                continue
+            try:
+                self.get(provider, key)
+                warmed.append(provider)
+            except Exception as e:
+                print(f"Client prewarm failed for {provider}: {e}")
+        return warmed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._clients),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+_client_pool = ProviderClientPool(
+    capacity=int(os.getenv('PROMPTX_CLIENT_POOL_SIZE', 32)),
+    idle_ttl=int(os.getenv('PROMPTX_CLIENT_IDLE_TTL', 1800)),
+    user_ttl=int(os.getenv('PROMPTX_CLIENT_USER_TTL', 300)),
+)
+
+
+def prewarm_clients():
+    """Create pooled clients for the server-default keys (call once per worker, after fork)."""
+    return _client_pool.prewarm()
+
+
+# ============================================================================
+# PROVIDER ERRORS & QUOTA LEDGER
+# ============================================================================
+
+class ProviderError(Exception):
+    """A provider call failed. `model` is the fallback-chain model name."""
+
+    def __init__(self, message, model=None, status=None, retry_after=None):
+        super().__init__(message)
+        self.model = model
+        self.status = status
+        self.retry_after = retry_after
+
+    def rewrap(self, message):
+        """Same error type and metadata, new message."""
+        return type(self)(message, model=self.model, status=self.status, retry_after=self.retry_after)
+
+
+class QuotaExceededError(ProviderError):
+    """429 / RESOURCE_EXHAUSTED. `retry_after` is in seconds when the provider said."""
+
+
+class ProviderTimeoutError(ProviderError):
+    """The provider did not answer in time."""
+
+
+class DeadlineExceededError(ProviderTimeoutError):
+    """The request's Deadline ran out before a provider answered."""
+
+
+class ProviderUnavailableError(ProviderError):
+    """5xx or connection failure."""
+
+
+class ProviderAuthError(ProviderError):
+    """401 / 403 — the key was rejected."""
+
+
+class ProviderConfigError(ProviderError):
+    """No API key configured for this provider, or a model name it doesn't know."""
+
+
+class CircuitOpenError(ProviderError):
+    """Raised instead of calling a provider whose circuit breaker is open."""
+
+
+_RETRY_DELAY_RE = re.compile(r"retryDelay['\"]?\s*:\s*['\"]?(\d+(?:\.\d+)?)s")
+# SDK errors that carry no status code still start with it, e.g. "429 RESOURCE_EXHAUSTED ..."
+_QUOTA_MESSAGE_RE = re.compile(
+    r'^\s*429\b|resource_exhausted|quota exceeded|exceeded your current quota|rate limit exceeded', re.IGNORECASE)
+# Gemini's free-tier daily quotas, e.g. quotaId GenerateRequestsPerDayPerProjectPerModel-FreeTier
+_DAILY_QUOTA_RE = re.compile(r"quotaId['\"]?\s*:\s*['\"]?[\w-]*PerDay", re.IGNORECASE)
+
+# How long a 429 without Retry-After (and not a daily quota) keeps a provider out of rotation
+QUOTA_RETRY_DEFAULT = float(os.getenv('PROMPTX_QUOTA_RETRY_DEFAULT', 60))
+# Everything back within this many seconds reads as a rate limit, not an exhausted quota
+QUOTA_SHORT_WAIT = 3600
+
+
+def _parse_retry_after(value):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _classify_provider_error(model_name, exc):
+    """Map any SDK / HTTP exception onto the ProviderError hierarchy."""
+    if isinstance(exc, ProviderError):
+        if exc.model is None:
+            exc.model = model_name
+        return exc
+
+    status = None
+    headers = {}
+    response = getattr(exc, 'response', None)
+    if response is not None:
+        status = getattr(response, 'status_code', None)
+        headers = getattr(response, 'headers', None) or {}
+    # google-genai APIError and openai APIStatusError carry the code directly
+    status = getattr(exc, 'code', None) if isinstance(getattr(exc, 'code', None), int) else status
+    status = getattr(exc, 'status_code', None) or status
+
+    message = str(exc)
+    lower = message.lower()
+    retry_after = _parse_retry_after(headers.get('retry-after') if headers else None)
+    if retry_after is None:
+        match = _RETRY_DELAY_RE.search(message)
+        if match:
+            retry_after = float(match.group(1))
+
+    if status == 429 or _QUOTA_MESSAGE_RE.search(message):
+        if retry_after is None and 'resource_exhausted' in lower and _DAILY_QUOTA_RE.search(message):
+            retry_after = max(0.0, _next_quota_reset() - time.time())
+        return QuotaExceededError(message, model=model_name, status=429, retry_after=retry_after)
+    if status in (401, 403):
+        return ProviderAuthError(message, model=model_name, status=status)
+    if isinstance(exc, requests.exceptions.Timeout) or 'timeout' in type(exc).__name__.lower() or 'timed out' in lower:
+        return ProviderTimeoutError(message, model=model_name, status=status)
+    if (status is not None and status >= 500) or isinstance(exc, requests.exceptions.ConnectionError) or \
+            'connect' in type(exc).__name__.lower():
+        return ProviderUnavailableError(message, model=model_name, status=status)
+    return ProviderError(message, model=model_name, status=status)
+
+
+def _next_quota_reset(now=None):
+    """Next daily quota boundary (midnight in PROMPTX_QUOTA_RESET_TZ, Pacific by default)."""
+    try:
+        from zoneinfo import ZoneInfo
+        tz = ZoneInfo(os.getenv('PROMPTX_QUOTA_RESET_TZ', 'America/Los_Angeles'))
+    except Exception:
+        tz = timezone.utc
+    now = now or datetime.now(tz)
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return midnight.timestamp()
+
+
+class QuotaLedger:
+    """
+    Remembers which (model, hashed key) pairs are out of quota and until
+    when, so routing skips them instead of re-discovering the 429 on every
+    request. Gemini quotas are per model, so the model name is the unit.
+    """
+
+    def __init__(self):
+        self._exhausted = {}
+        self._lock = threading.Lock()
+
+    def mark_exhausted(self, model_name, api_key, retry_after=None):
+        """
+        Skip the pair for retry_after seconds (QUOTA_RETRY_DEFAULT when the
+        provider didn't say; daily quotas arrive with the time to the reset).
+        """
+        reset_at = time.time() + (retry_after if retry_after is not None else QUOTA_RETRY_DEFAULT)
+        with self._lock:
+            self._exhausted[(model_name, _hash_key(api_key))] = reset_at
+        print(f"Quota exhausted for {model_name} until {datetime.fromtimestamp(reset_at).isoformat(timespec='seconds')}")
+        return reset_at
+
+    def exhausted_until(self, model_name, api_key):
+        """Reset timestamp if still exhausted, else None."""
+        pair = (model_name, _hash_key(api_key))
+        with self._lock:
+            reset_at = self._exhausted.get(pair)
+            if reset_at is None:
+                return None
+            if reset_at <= time.time():
+                del self._exhausted[pair]
+                return None
+            return reset_at
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            return [
+                {'model': model, 'key': key_hash, 'resets_in_s': round(reset_at - now)}
+                for (model, key_hash), reset_at in self._exhausted.items()
+                if reset_at > now
+            ]
+
+
+_quota_ledger = QuotaLedger()
+
+
+# ============================================================================
+# PROVIDER HEALTH & CIRCUIT BREAKERS
+# ============================================================================
+
+class ProviderHealth:
+    """
+    Per-model rolling latency / error window plus a circuit breaker,
+    shared by every thread in the worker.
+
+    closed    -> calls flow; opens after `failure_threshold` consecutive
+                 failures or an error rate >= `error_rate_threshold`
+    open      -> calls are skipped until `cooldown` seconds have passed
+    half_open -> exactly one probe call is let through; success closes
+                 the circuit, failure re-opens it
+    """
+
+    def __init__(self, window=100, failure_threshold=5, error_rate_threshold=0.5,
+                 min_calls=10, cooldown=30.0, probe_timeout=90.0):
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, model_name):
+        entry = self._models.get(model_name)
+        if entry is None:
+            entry = self._models[model_name] = {
+                'latencies': deque(maxlen=self.window),
+                'outcomes': deque(maxlen=self.window),
+                'consecutive_failures': 0,
+                'state': 'closed',
+                'opened_at': 0.0,
+                'probe_started': None,
+            }
+        return entry
+
+    def acquire(self, model_name):
+        """True if a call to model_name may proceed right now."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entry(model_name)
+            if entry['state'] == 'closed':
+                return True
+            if entry['state'] == 'open':
+                if now - entry['opened_at'] < self.cooldown:
+                    return False
+                entry['state'] = 'half_open'
+                entry['probe_started'] = None
+            # half_open: allow a single probe at a time
+            probe = entry['probe_started']
+            if probe is not None and now - probe < self.probe_timeout:
+                return False
+            entry['probe_started'] = now
+            return True
+
+    def record_success(self, model_name, latency):
+        with self._lock:
+            entry = self._entry(model_name)
+            entry['latencies'].append(latency)
+            entry['outcomes'].append(True)
+            entry['consecutive_failures'] = 0
+            if entry['state'] != 'closed':
+                entry['state'] = 'closed'
+                entry['probe_started'] = None
+                entry['outcomes'].clear()
+                print(f"Circuit closed for {model_name}")
+
+    def record_failure(self, model_name, latency):
+        with self._lock:
+            entry = self._entry(model_name)
+            entry['outcomes'].append(False)
+            entry['consecutive_failures'] += 1
+            outcomes = entry['outcomes']
+            error_rate = outcomes.count(False) / len(outcomes)
+            if entry['state'] == 'half_open' or (
+                entry['state'] == 'closed' and (
+                    entry['consecutive_failures'] >= self.failure_threshold or
+                    (len(outcomes) >= self.min_calls and error_rate >= self.error_rate_threshold)
+                )
+            ):
+                entry['state'] = 'open'
+                entry['opened_at'] = time.monotonic()
+                entry['probe_started'] = None
+                print(f"Circuit opened for {model_name} (error rate {error_rate:.0%})")
+
+    def percentile(self, model_name, pct, min_samples=20):
+        """Latency percentile in seconds, or None until min_samples successes exist."""
+        with self._lock:
+            samples = sorted(self._entry(model_name)['latencies'])
+        if len(samples) < min_samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def error_rate(self, model_name):
+        with self._lock:
+            outcomes = self._entry(model_name)['outcomes']
+            return outcomes.count(False) / len(outcomes) if outcomes else 0.0
+
+    def ordered(self, model_names):
+        """
+        Auto-mode chain for this request: models with an open circuit (still
+        cooling down) are dropped, the rest are sorted by their static
+        priority plus a penalty for recent errors and slow medians. Healthy
+        providers keep their configured order.
+        """
+        now = time.monotonic()
+        scored = []
+        for priority, name in enumerate(model_names):
+            with self._lock:
+                entry = self._entry(name)
+                if entry['state'] == 'open' and now - entry['opened_at'] < self.cooldown:
+                    continue
+            p50 = self.percentile(name, 50, min_samples=5) or 0.0
+            penalty = 5 * self.error_rate(name) + p50 / 5
+            scored.append((priority + penalty, priority, name))
+        return [name for _, _, name in sorted(scored)]
+
+    def snapshot(self):
+        names = list(self._models)
+        report = {}
+        for name in names:
+            p50 = self.percentile(name, 50, min_samples=1)
+            p95 = self.percentile(name, 95, min_samples=1)
+            with self._lock:
+                entry = self._models[name]
+                report[name] = {
+                    'state': entry['state'],
+                    'calls': len(entry['outcomes']),
+                    'consecutive_failures': entry['consecutive_failures'],
+                    'p50_ms': round(p50 * 1000) if p50 is not None else None,
+                    'p95_ms': round(p95 * 1000) if p95 is not None else None,
+                }
+            report[name]['error_rate'] = round(self.error_rate(name), 3)
+        return report
+
+
+_provider_health = ProviderHealth(
+    failure_threshold=int(os.getenv('PROMPTX_CIRCUIT_FAILURES', 5)),
+    error_rate_threshold=float(os.getenv('PROMPTX_CIRCUIT_ERROR_RATE', 0.5)),
+    cooldown=float(os.getenv('PROMPTX_CIRCUIT_COOLDOWN', 30)),
+)
+
+# Hedging: in auto mode, if the current model hasn't answered within its
+# p95 latency, fire the next model in parallel and keep whichever wins.
+HEDGE_ENABLED = os.getenv('PROMPTX_HEDGE', 'false').lower() in ('true', '1', 'yes')
+HEDGE_PERCENTILE = float(os.getenv('PROMPTX_HEDGE_PERCENTILE', 95))
+HEDGE_DEFAULT_DELAY = float(os.getenv('PROMPTX_HEDGE_DELAY', 8.0))
+HEDGE_MIN_DELAY = float(os.getenv('PROMPTX_HEDGE_MIN_DELAY', 1.0))
+HEDGE_MAX_PARALLEL = int(os.getenv('PROMPTX_HEDGE_MAX_PARALLEL', 2))
+
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(
+                    max_workers=int(os.getenv('PROMPTX_HEDGE_POOL', 16)),
+                    thread_name_prefix='promptx-hedge',
+                )
+    return _hedge_executor
+
+
+# ============================================================================
+# TOKEN BUDGETS
+# ============================================================================
+
+# Per-model token limits. 'context' is the provider's window, 'output' the
+# most we ever request, 'input' a deliberate cap below the window (Groq's
+# free-tier TPM, MiniMax latency). Counts use tiktoken's cl100k_base, which
+# only approximates Gemini/Llama/MiniMax tokenizers, hence the headroom.
+MODEL_LIMITS = {
+    'gemini_flash':    {'context': 1_048_576, 'input': None, 'output': 8192},
+    'gemini_flash_8b': {'context': 1_048_576, 'input': None, 'output': 8192},
+    'gemini_pro':      {'context': 1_048_576, 'input': None, 'output': 65_536},
+    'nvidia_minimax':  {'context': 196_608,   'input': 1500, 'output': 2048},
+    'groq':            {'context': 131_072,   'input': 7500, 'output': 4096},
+}
+TOKENIZER_HEADROOM = 0.95
+
+_TRIM_MARKER = "\n\n[Content trimmed to fit the model's context]"
+_SENTENCE_END_RE = re.compile(r'[.!?]["\')\]]?\s|\n')
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+_budget_stats = {'trimmed_prompts': 0, 'tokens_trimmed': 0}
+_budget_stats_lock = threading.Lock()
+# Paragraphs of registered static prompt blocks; only these have their counts cached
+_static_fragments = set()
+
+
+def get_tokenizer():
+    """
+    The shared tiktoken encoding, or None when tiktoken or its BPE file is
+    unavailable (offline hosts); counting then falls back to ~4 chars/token.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                try:
+                    import tiktoken
+                    _tokenizer = tiktoken.get_encoding(os.getenv('PROMPTX_TOKENIZER', 'cl100k_base'))
+                except Exception as e:
+                    print(f"tiktoken unavailable, estimating tokens from length: {e}")
+                    _tokenizer = False
+    return _tokenizer or None
+
+
+def _count_fragment(fragment):
+    enc = get_tokenizer()
+    if enc is None:
+        return (len(fragment) + 3) // 4
+    return len(enc.encode(fragment, disallowed_special=()))
+
+
+@lru_cache(maxsize=None)
+def _count_static_fragment(fragment):
+    return _count_fragment(fragment)
+
+
+def register_static_text(text):
+    """Declare text as a fixed prompt block whose paragraphs count_tokens may cache."""
+    _static_fragments.update(text.split('\n\n'))
+
+
+def count_tokens(text):
+    """
+    Token count of text, summed over its paragraphs so that fixed fragments
+    (MASTER_PROMPT, DEEP_RESEARCH_PROMPT, ...) are only ever encoded once.
+    User text and page content are counted afresh rather than kept as keys.
+    One token per paragraph break keeps the sum an upper bound.
+    """
+    if not text:
+        return 0
+    fragments = text.split('\n\n')
+    counted = sum(_count_static_fragment(f) if f in _static_fragments else _count_fragment(f) for f in fragments)
+    return counted + len(fragments) - 1
+
+
+def trim_to_tokens(text, budget, marker=_TRIM_MARKER):
+    """Cut text to at most budget tokens (marker included), ending on a sentence boundary."""
+    if count_tokens(text) <= budget:
+        return text
+    room = max(0, budget - count_tokens(marker))
+    enc = get_tokenizer()
+    if enc is None:
+        head = text[:room * 4]
+    else:
+        head = enc.decode(enc.encode(text, disallowed_special=())[:room])
+
+    # Prefer the last sentence end in the back half, else the last space
+    ends = [m.end() for m in _SENTENCE_END_RE.finditer(head)]
+    if ends and ends[-1] > len(head) // 2:
+        head = head[:ends[-1]]
+    elif ' ' in head:
+        head = head[:head.rindex(' ')]
+    trimmed = head.rstrip() + marker
+
+    # Re-tokenising a cut can merge differently; shave until it really fits
+    while count_tokens(trimmed) > budget and head:
+        head = head[:int(len(head) * 0.95)]
+        trimmed = head.rstrip() + marker
+    removed = count_tokens(text) - count_tokens(trimmed)
+    with _budget_stats_lock:
+        _budget_stats['trimmed_prompts'] += 1
+        _budget_stats['tokens_trimmed'] += removed
+    return trimmed
+
+
+def output_budget(model_name, max_tokens):
+    """The caller's max_tokens, capped at what the model can produce."""
+    return max(1, min(max_tokens, MODEL_LIMITS[model_name]['output']))
+
+
+def input_budget(model_name, max_tokens):
+    """Prompt tokens model_name accepts once its output budget is reserved."""
+    limits = MODEL_LIMITS[model_name]
+    budget = limits['context'] - output_budget(model_name, max_tokens)
+    if limits['input'] is not None:
+        budget = min(budget, limits['input'])
+    return int(budget * TOKENIZER_HEADROOM)
+
+
+def fit_messages(model_name, messages, max_tokens):
+    """
+    Trim chat messages to model_name's input budget. The longest non-system
+    message gives way first, so instructions survive and a cached system
+    prefix stays byte-identical.
+    """
+    budget = input_budget(model_name, max_tokens)
+    messages = [dict(m) for m in messages]
+    total = sum(count_tokens(m['content']) for m in messages)
+    if total <= budget:
+        return messages
+    candidates = [m for m in messages if m['role'] != 'system'] or messages
+    longest = max(candidates, key=lambda m: count_tokens(m['content']))
+    others = total - count_tokens(longest['content'])
+    longest['content'] = trim_to_tokens(longest['content'], max(0, budget - others))
+    return messages
+
+
+# ============================================================================
+# REQUEST DEADLINES
+# ============================================================================
+
+# Wall-clock budget of each endpoint in seconds. Keep them under the
+# worker timeout (gunicorn TIMEOUT) and any serverless platform limit.
+REQUEST_BUDGETS = {
+    'enhance': float(os.getenv('PROMPTX_BUDGET_ENHANCE', 55)),
+    'analyze_url': float(os.getenv('PROMPTX_BUDGET_ANALYZE_URL', 90)),
+    'web_search': float(os.getenv('PROMPTX_BUDGET_WEB_SEARCH', 30)),
+    'ab_test': float(os.getenv('PROMPTX_BUDGET_AB_TEST', 45)),
+}
+
+# Time kept back for the final generation while crawling, searching or
+# running an optional analysis pass
+GENERATION_RESERVE = float(os.getenv('PROMPTX_GENERATION_RESERVE', 20))
+
+# Fetches and model attempts are not started with less than this left
+DEADLINE_MIN_FETCH = 1.0
+DEADLINE_MIN_ATTEMPT = 2.0
+
+
+class Deadline:
+    """
+    Time budget of one API request, passed as `deadline=` to everything
+    that does network I/O on its behalf. Each step sizes its timeout from
+    what is left (timeout()), skips optional work that no longer fits
+    (allows() / skip()) and books its time under a name (step()), so the
+    response can report where the budget went.
+
+    within() carves out a sub-budget for one phase, e.g. a crawl that has
+    to leave time for generation. It books into the same report and never
+    outlives its parent.
+    """
+
+    def __init__(self, seconds, parent=None):
+        self.seconds = max(0.0, seconds)
+        self.started = time.monotonic()
+        self.parent = parent
+        root = parent.root if parent is not None else None
+        self.root = root or self
+        if root is None:
+            self._lock = threading.Lock()
+            self.steps = {}
+            self.skipped = []
+
+    @classmethod
+    def for_route(cls, route):
+        return cls(REQUEST_BUDGETS[route])
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        left = self.seconds - self.elapsed()
+        if self.parent is not None:
+            left = min(left, self.parent.remaining())
+        return max(0.0, left)
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def allows(self, seconds):
+        """Whether at least `seconds` are left."""
+        return self.remaining() >= seconds
+
+    def timeout(self, cap):
+        """Timeout for one blocking call: cap, or what is left if that is less."""
+        return min(cap, self.remaining())
+
+    def within(self, seconds):
+        """A child deadline of at most `seconds`."""
+        return Deadline(min(seconds, self.remaining()), parent=self)
+
+    @contextmanager
+    def step(self, name):
+        """Book the time spent in the block under name. Concurrent steps overlap."""
+        started = time.monotonic()
+        try:
+            yield self
+        finally:
+            root = self.root
+            with root._lock:
+                entry = root.steps.setdefault(name, {'ms': 0.0, 'calls': 0})
+                entry['ms'] += (time.monotonic() - started) * 1000
+                entry['calls'] += 1
+
+    def skip(self, name, reason):
+        """Record optional work that was dropped for lack of time."""
+        root = self.root
+        with root._lock:
+            root.skipped.append({'step': name, 'reason': reason, 'at_ms': round(root.elapsed() * 1000)})
+
+    def report(self):
+        """Where the request's budget went, for the response payload."""
+        root = self.root
+        with root._lock:
+            return {
+                'budget_ms': round(root.seconds * 1000),
+                'elapsed_ms': round(root.elapsed() * 1000),
+                'remaining_ms': round(root.remaining() * 1000),
+                'steps': {name: {'ms': round(e['ms']), 'calls': e['calls']} for name, e in root.steps.items()},
+                'skipped': list(root.skipped),
+            }
+
+
+def deadline_step(deadline, name):
+    """deadline.step(name), or a no-op for calls made without a deadline."""
+    return deadline.step(name) if deadline is not None else nullcontext()
+
+
+def _timeout(deadline, cap):
+    return cap if deadline is None else deadline.timeout(cap)
+
+
+# Timeout of the provider attempt running in this context. _timed_call sets
+# it from the request deadline; the request builders read it through
+# _provider_timeout(), so the deadline needn't be passed to every SDK call.
+_attempt_timeout = contextvars.ContextVar('promptx_attempt_timeout', default=None)
+
+
+def _provider_timeout(cap=None):
+    cap = PROVIDER_TIMEOUT if cap is None else cap
+    limit = _attempt_timeout.get()
+    return cap if limit is None else min(cap, limit)
+
+
+@contextmanager
+def _attempt(deadline):
+    """Cap provider timeouts in this block at what deadline has left."""
+    token = _attempt_timeout.set(deadline.remaining() if deadline is not None else None)
+    try:
+        yield
+    finally:
+        _attempt_timeout.reset(token)
+
+
+# ============================================================================
+# PREFIX CACHE
+# ============================================================================
+
+# Gemini refuses explicit caches smaller than this many tokens
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv('PROMPTX_GEMINI_CACHE_MIN_TOKENS', 1024))
+
+
+class PrefixCache:
+    """
+    Static prompt prefixes (MASTER_PROMPT, DEEP_RESEARCH_PROMPT) registered
+    once so providers can cache them instead of re-reading them per request.
+
+    split() peels a registered prefix off a prompt. Gemini then gets a
+    cached-content handle, created once per (model, key, prefix) and reused
+    until just before its TTL runs out; when no handle can be made (prefix
+    under the model's minimum, API error) the prefix is sent as
+    system_instruction and creation is retried after retry_after seconds.
+    OpenAI-compatible providers get the prefix as a byte-identical first
+    system message, which their automatic prefix caching can match.
+    Input tokens saved are taken from the providers' usage reports.
+    """
+
+    def __init__(self, ttl=3600, retry_after=600):
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self._prefixes = {}
+        self._handles = {}
+        self._lock = threading.Lock()
+        self._flight = _SingleFlight()
+        self._stats = {}
+
+    def register(self, name, text):
+        with self._lock:
+            self._prefixes[name] = text
+
+    def split(self, prompt):
+        """(name, prefix, rest) for the longest registered prefix of prompt, else (None, None, prompt)."""
+        with self._lock:
+            prefixes = sorted(self._prefixes.items(), key=lambda item: -len(item[1]))
+        for name, text in prefixes:
+            if prompt.startswith(text):
+                return name, text, prompt[len(text):].strip()
+        return None, None, prompt
+
+    def _counters(self, provider):
+        return self._stats.setdefault(provider, {
+            'prefixed_requests': 0, 'handles_created': 0, 'handles_unavailable': 0, 'input_tokens_saved': 0,
+        })
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._handles.get(key)
+        if entry and entry[1] > time.monotonic():
+            return entry
+        return None
+
+    def _remember(self, key, handle, error=None):
+        if error is not None:
+            print(f"Prefix cache handle for {key[0]}/{key[1]} ({key[3]}) unavailable: {error}")
+        lifetime = self.ttl * 0.9 if handle else self.retry_after
+        with self._lock:
+            self._handles[key] = (handle, time.monotonic() + lifetime)
+            self._counters(key[0])['handles_created' if handle else 'handles_unavailable'] += 1
+        return handle
+
+    def handle(self, provider, model_id, api_key, name, create):
+        """Live handle for prefix name on model_id, made by create(text) at most once per TTL; None if unavailable."""
+        key = (provider, model_id, _hash_key(api_key or ''), name)
+        entry = self._lookup(key)
+        if entry:
+            return entry[0]
+
+        def build():
+            try:
+                return self._remember(key, create(self._prefixes[name]))
+            except Exception as e:
+                return self._remember(key, None, e)
+        return self._flight.run(key, build)[0]
+
+    async def ahandle(self, provider, model_id, api_key, name, create):
+        """Async handle(); create is a coroutine function."""
+        key = (provider, model_id, _hash_key(api_key or ''), name)
+        entry = self._lookup(key)
+        if entry:
+            return entry[0]
+
+        async def build():
+            try:
+                return self._remember(key, await create(self._prefixes[name]))
+            except Exception as e:
+                return self._remember(key, None, e)
+        return (await self._flight.arun(key, build))[0]
+
+    def record(self, provider, cached_tokens):
+        """Count a prefixed request and the cached input tokens its provider reported."""
+        with self._lock:
+            counters = self._counters(provider)
+            counters['prefixed_requests'] += 1
+            counters['input_tokens_saved'] += cached_tokens or 0
+
+    def snapshot(self):
+        with self._lock:
+            prefixes = dict(self._prefixes)
+            providers = {p: dict(c) for p, c in self._stats.items()}
+        return {
+            'registered': {name: count_tokens(text) for name, text in prefixes.items()},
+            'providers': providers,
+        }
+
+
+_prefix_cache = PrefixCache(ttl=int(os.getenv('PROMPTX_PREFIX_CACHE_TTL', 3600)))
+
+
+def register_prefix(name, text):
+    """Declare text as a static prompt prefix that providers may cache."""
+    register_static_text(text)
+    _prefix_cache.register(name, text)
+
+
+class LocalGeminiClient:
+    """
+    Offline stand-in for genai.Client (PROMPTX_GEMINI_BACKEND=local).
+
+    Implements the slice of the SDK the fallback uses (models.generate_content,
+    models.generate_content_stream, caches.create, and the same on .aio) and
+    answers with a deterministic echo, reporting usage_metadata the way
+    Gemini does, so prefix caching can be exercised without network or quota.
+    """
+
+    def __init__(self):
+        self._contents = {}
+        self._lock = threading.Lock()
+        self.models = SimpleNamespace(
+            generate_content=self._generate, generate_content_stream=self._stream,
+        )
+        self.caches = SimpleNamespace(create=self._create_cache)
+        self.aio = SimpleNamespace(
+            models=SimpleNamespace(generate_content=self._agenerate, generate_content_stream=self._astream),
+            caches=SimpleNamespace(create=self._acreate_cache),
+        )
+
+    def _create_cache(self, model, config):
+        system = config['system_instruction']
+        if count_tokens(system) < GEMINI_CACHE_MIN_TOKENS:
+            raise ValueError(f"400 INVALID_ARGUMENT. Cached content is too small (min {GEMINI_CACHE_MIN_TOKENS} tokens)")
+        name = f"cachedContents/local-{hashlib.sha256((model + system).encode('utf-8')).hexdigest()[:12]}"
+        with self._lock:
+            self._contents[name] = system
+        return SimpleNamespace(name=name, model=model)
+
+    def _generate(self, model, contents, config=None):
+        config = config or {}
+        handle = config.get('cached_content')
+        system = config.get('system_instruction') or ''
+        if handle:
+            with self._lock:
+                system = self._contents.get(handle)
+            if system is None:
+                raise ValueError(f"404 NOT_FOUND. CachedContent {handle} not found")
+        text = f"[local {model}] {' '.join(contents.split()[:40])}"
+        if config.get('max_output_tokens'):
+            text = trim_to_tokens(text, config['max_output_tokens'], marker='')
+        usage = SimpleNamespace(
+            prompt_token_count=count_tokens(system) + count_tokens(contents),
+            cached_content_token_count=count_tokens(system) if handle else None,
+            candidates_token_count=count_tokens(text),
+        )
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+    def _stream(self, model, contents, config=None):
+        response = self._generate(model, contents, config)
+        words = response.text.split(' ')
+        for i, word in enumerate(words):
+            last = i == len(words) - 1
+            yield SimpleNamespace(
+                text=word if last else word + ' ',
+                usage_metadata=response.usage_metadata if last else None,
+            )
+
+    async def _acreate_cache(self, model, config):
+        return self._create_cache(model, config)
+
+    async def _agenerate(self, model, contents, config=None):
+        return self._generate(model, contents, config)
+
+    async def _astream(self, model, contents, config=None):
+        async def chunks():
+            for chunk in self._stream(model, contents, config):
+                yield chunk
+        return chunks()
+
+
+# ============================================================================
+# PROVIDER CASSETTES (record / replay)
+# ============================================================================
+
+# Recorded error type name -> class to raise on replay
+_CASSETTE_ERRORS = {
+    cls.__name__: cls for cls in (
+        ProviderError, QuotaExceededError, ProviderTimeoutError, ProviderUnavailableError,
+        ProviderAuthError, ProviderConfigError, CircuitOpenError,
+    )
+}
+
+
+class ProviderCassette:
+    """
+    Record/replay backend for AIModelFallback (PROMPTX_PROVIDER_BACKEND).
+
+    record: calls go to the live provider and every outcome (text or
+    classified error, latency, stream chunk timings, prompt and output
+    token counts) is appended to a JSONL cassette. Prompts are stored only
+    as a hash.
+
+    replay: no network. The recording for (model, prompt, max_tokens) is
+    played back after its recorded latency times latency_scale, streams
+    chunk by chunk at their recorded offsets. Several recordings of the
+    same call form a distribution to sample from. A prompt that was never
+    recorded gets a random recording of the same model (on_miss='any',
+    for load tests with varied prompts) or ProviderUnavailableError
+    (on_miss='error').
+    """
+
+    def __init__(self, path, mode='replay', latency_scale=1.0, on_miss='any', seed=None):
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.on_miss = on_miss
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._by_key = defaultdict(list)
+        self._by_model = defaultdict(list)
+        self.stats_counters = {'recorded': 0, 'replayed': 0, 'exact': 0, 'substituted': 0, 'missing': 0}
+        if mode == 'replay':
+            self.load()
+
+    def load(self):
+        self._by_key.clear()
+        self._by_model.clear()
+        if not os.path.exists(self.path):
+            print(f"Cassette {self.path} not found; replay has nothing to play")
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    self._index(json.loads(line))
+
+    def _index(self, entry):
+        self._by_key[entry['key']].append(entry)
+        self._by_model[entry['model']].append(entry)
+
+    @staticmethod
+    def key(model_name, prompt, max_tokens):
+        raw = json.dumps([model_name, _normalise_prompt(prompt), max_tokens], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _count(self, field):
+        with self._lock:
+            self.stats_counters[field] += 1
+
+    # ── recording ────────────────────────────────────────────────────────
+
+    def _entry(self, model_name, prompt, max_tokens, started, text, chunks=None, error=None):
+        entry = {
+            'key': self.key(model_name, prompt, max_tokens),
+            'model': model_name,
+            'max_tokens': max_tokens,
+            'latency_ms': round((time.perf_counter() - started) * 1000, 1),
+            'prompt_tokens': count_tokens(prompt),
+            'output_tokens': count_tokens(text),
+            'text': text,
+            'recorded_at': time.time(),
+        }
+        if chunks is not None:
+            entry['chunks'] = chunks
+            entry['ttft_ms'] = chunks[0][0] if chunks else None
+        if error is not None:
+            error = _classify_provider_error(model_name, error)
+            entry['error'] = {
+                'type': type(error).__name__, 'message': str(error),
+                'status': error.status, 'retry_after': error.retry_after,
+            }
+        return entry
+
+    def _append(self, entry):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._index(entry)
+            self.stats_counters['recorded'] += 1
+
+    # ── replay ───────────────────────────────────────────────────────────
+
+    def _pick(self, model_name, prompt, max_tokens):
+        with self._lock:
+            exact = self._by_key.get(self.key(model_name, prompt, max_tokens))
+            pool = exact or (self._by_model.get(model_name) if self.on_miss == 'any' else None)
+            entry = self._rng.choice(pool) if pool else None
+        if entry is None:
+            self._count('missing')
+            raise ProviderUnavailableError(f"no cassette recording for {model_name}", model=model_name, status=503)
+        self._count('replayed')
+        self._count('exact' if exact else 'substituted')
+        return entry
+
+    def _error(self, entry):
+        error = entry.get('error')
+        if not error:
+            return None
+        cls = _CASSETTE_ERRORS.get(error['type'], ProviderError)
+        return cls(error['message'], model=entry['model'], status=error.get('status'), retry_after=error.get('retry_after'))
+
+    def _chunks(self, entry):
+        return entry.get('chunks') or [[entry['latency_ms'], entry['text']]]
+
+    def _delay(self, ms):
+        return max(0.0, ms * self.latency_scale / 1000)
+
+    # ── backend interface (live is a zero-argument callable) ───────────────
+
+    def call(self, model_name, prompt, max_tokens, live):
+        if self.mode == 'record':
+            started = time.perf_counter()
+            try:
+                text = live()
+            except Exception as e:
+                self._append(self._entry(model_name, prompt, max_tokens, started, '', error=e))
+                raise
+            self._append(self._entry(model_name, prompt, max_tokens, started, text))
+            return text
+        entry = self._pick(model_name, prompt, max_tokens)
+        time.sleep(self._delay(entry['latency_ms']))
+        error = self._error(entry)
+        if error:
+            raise error
+        return entry['text']
+
+    async def acall(self, model_name, prompt, max_tokens, live):
+        """call() for coroutines: live returns an awaitable."""
+        if self.mode == 'record':
+            started = time.perf_counter()
+            try:
+                text = await live()
+            except Exception as e:
+                self._append(self._entry(model_name, prompt, max_tokens, started, '', error=e))
+                raise
+            self._append(self._entry(model_name, prompt, max_tokens, started, text))
+            return text
+        entry = self._pick(model_name, prompt, max_tokens)
+        await asyncio.sleep(self._delay(entry['latency_ms']))
+        error = self._error(entry)
+        if error:
+            raise error
+        return entry['text']
+
+    async def astream(self, model_name, prompt, max_tokens, live):
+        """Streaming call(): live returns an async iterator, and chunk timings are recorded and replayed."""
+        if self.mode == 'record':
+            started = time.perf_counter()
+            chunks = []
+            try:
+                async for chunk in live():
+                    chunks.append([round((time.perf_counter() - started) * 1000, 1), chunk])
+                    yield chunk
+            except Exception as e:
+                self._append(self._entry(model_name, prompt, max_tokens, started, ''.join(c for _, c in chunks), chunks, e))
+                raise
+            self._append(self._entry(model_name, prompt, max_tokens, started, ''.join(c for _, c in chunks), chunks))
+            return
+        entry = self._pick(model_name, prompt, max_tokens)
+        elapsed = 0.0
+        for offset, chunk in self._chunks(entry):
+            await asyncio.sleep(self._delay(offset - elapsed))
+            elapsed = offset
+            yield chunk
+        error = self._error(entry)
+        if error:
+            raise error
+
+    def stats(self):
+        with self._lock:
+            return {
+                'mode': self.mode, 'latency_scale': self.latency_scale,
+                'recordings': sum(len(v) for v in self._by_key.values()), **self.stats_counters,
+            }
+
+
+def _cassette_from_env():
+    mode = os.getenv('PROMPTX_PROVIDER_BACKEND', 'live').lower()
+    if mode not in ('record', 'replay'):
+        return None
+    return ProviderCassette(
+        os.getenv('PROMPTX_CASSETTE') or os.path.join(CACHE_DIR, 'providers.cassette.jsonl'),
+        mode=mode,
+        latency_scale=float(os.getenv('PROMPTX_REPLAY_LATENCY_SCALE', 1.0)),
+        on_miss=os.getenv('PROMPTX_CASSETTE_MISS', 'any'),
+    )
+
+
+_cassette = _cassette_from_env()
+
+
+# ============================================================================
+# MULTI-MODEL FALLBACK SYSTEM
+# ============================================================================
+
+_GEMINI_MODEL_IDS = {
+    'gemini_flash': 'gemini-2.0-flash',
+    'gemini_flash_8b': 'gemini-2.0-flash-lite',
+    'gemini_pro': 'gemini-2.5-pro',
+}
+
+_GEMINI_GENERATION_CONFIG = {
+    'temperature': 0.3,
+    'top_p': 0.95,
+    'top_k': 40,
+}
+
+_GROQ_CHAT_URL = f'{_GROQ_BASE_URL}/chat/completions'
+
+
+def _sse_delta(line):
+    """Parse one line of an OpenAI-style SSE stream into (done, text)."""
+    if not line or not line.startswith('data:'):
+        return False, None
+    data = line[len('data:'):].strip()
+    if data == '[DONE]':
+        return True, None
+    delta = json.loads(data).get('choices', [{}])[0].get('delta', {})
+    return False, delta.get('content')
+
+class AIModelFallback:
+    """Handles automatic fallback between Gemini and Groq"""
+    
+    def __init__(self):
+        self.models = [
+            {'name': 'gemini_flash', 'priority': 1},
+            {'name': 'gemini_flash_8b', 'priority': 2},
+            {'name': 'gemini_pro', 'priority': 3},
+            {'name': 'nvidia_minimax', 'priority': 4},
+            {'name': 'groq', 'priority': 5},
+        ]
+        self.health = _provider_health
+        self.quota = _quota_ledger
+        self.prefixes = _prefix_cache
+        self.cassette = _cassette
+        self.hedge_enabled = HEDGE_ENABLED
+        self._stats_lock = threading.Lock()
+        self.hedge_stats = {
+            'requests': 0,
+            'hedged_requests': 0,
+            'hedge_wins': 0,
+            'abandoned_calls': 0,
+            'duplicate_input_tokens_est': 0,
+            'duplicate_output_tokens_est': 0,
+        }
+    
+    def generate(self, prompt, max_tokens=2000, preferred_model=None, api_key=None, deadline=None):
+        """
+        Try models in order until one succeeds. If preferred_model is explicitly set, ONLY use that model.
+        With a deadline, each attempt's timeout is capped at what is left and
+        models are skipped once too little remains (DeadlineExceededError).
+        """
+        errors = []
+        
+        # If user explicitly chose a model, ONLY use that model (no fallback)
+        if self._is_explicit(preferred_model):
+            self._check_quota(preferred_model, api_key)
+            try:
+                result = self._timed_call(preferred_model, prompt, max_tokens, api_key, check_circuit=False, deadline=deadline)
+                if result:
+                    return {'text': result, 'model': preferred_model, 'success': True}
+            except ProviderError as e:
+                # When user explicitly selects a model, don't fallback - just fail with clear error
+                raise e.rewrap(f"Selected model '{preferred_model}' failed: {str(e)}")
+        
+        chain = self._auto_chain(api_key, errors)
+
+        # Auto mode with hedging: overlap slow models with the next one
+        if self.hedge_enabled and len(chain) > 1:
+            result = self._generate_hedged(chain, prompt, max_tokens, api_key, errors, deadline)
+            if result:
+                return result
+        else:
+            # Auto mode: Try all models in fallback order
+            for model_name in chain:
+                try:
+                    result = self._timed_call(model_name, prompt, max_tokens, api_key, deadline=deadline)
+                    if result:
+                        return {'text': result, 'model': model_name, 'success': True}
+                except ProviderError as e:
+                    errors.append(e)
+                    continue
+        
+        raise self._exhausted_error(errors, api_key)
+
+    def _check_quota(self, preferred_model, api_key):
+        """Fail fast when an explicitly selected model is known to be out of quota."""
+        reset_at = self.quota.exhausted_until(preferred_model, self._effective_key(preferred_model, api_key))
+        if reset_at:
+            raise QuotaExceededError(
+                f"Selected model '{preferred_model}' is out of quota until "
+                f"{datetime.fromtimestamp(reset_at).isoformat(timespec='seconds')}",
+                model=preferred_model, status=429, retry_after=reset_at - time.time(),
+            )
+
+    def _is_explicit(self, preferred_model):
+        return bool(preferred_model and preferred_model != 'auto'
+                    and preferred_model in [m['name'] for m in self.models])
+
+    def _auto_chain(self, api_key, errors):
+        """Models to try in auto mode, healthiest first; skipped ones go to errors."""
+        all_models = [m['name'] for m in self.models]
+        healthy = self.health.ordered(all_models)
+        chain = []
+        for name in healthy:
+            # Known-exhausted quota: skip without spending a round trip on the 429
+            reset_at = self.quota.exhausted_until(name, self._effective_key(name, api_key))
+            if reset_at:
+                errors.append(QuotaExceededError(
+                    "quota exhausted", model=name, status=429, retry_after=reset_at - time.time()))
+            else:
+                chain.append(name)
+        errors.extend(CircuitOpenError("circuit open", model=name) for name in all_models if name not in healthy)
+        return chain
+
+    def _exhausted_error(self, errors, api_key=None):
+        """The error to raise once every model in the chain has failed."""
+        if any(isinstance(e, DeadlineExceededError) for e in errors):
+            return DeadlineExceededError(
+                "Request time budget ran out before a model answered. Errors: "
+                + '; '.join(f"{e.model}: {str(e)}" for e in errors),
+                status=504,
+            )
+        # Quota on everything that is configured (missing keys don't count against it)
+        quota_errors = [e for e in errors if isinstance(e, QuotaExceededError)]
+        if quota_errors and all(isinstance(e, (QuotaExceededError, ProviderConfigError)) for e in errors):
+            return self._quota_exhausted_error(quota_errors, api_key)
+        return ProviderError(f"All models failed. Errors: {'; '.join(f'{e.model}: {str(e)}' for e in errors)}")
+
+    def _quota_exhausted_error(self, quota_errors, api_key):
+        """429 saying when the soonest model comes back, per the quota ledger."""
+        now = time.time()
+        resets = []
+        for e in quota_errors:
+            reset_at = None
+            if e.model in _MODEL_PROVIDERS:
+                reset_at = self.quota.exhausted_until(e.model, self._effective_key(e.model, api_key))
+            if reset_at is None and e.retry_after is not None:
+                reset_at = now + e.retry_after
+            if reset_at is not None:
+                resets.append(reset_at)
+        details = '; '.join(f"{e.model}: {str(e)}" for e in quota_errors[:2])
+        if not resets:
+            return QuotaExceededError(
+                f"⚠️ QUOTA EXCEEDED: every available model is out of quota. Current errors: {details}", status=429)
+        retry_after = max(0.0, min(resets) - now)
+        if retry_after < QUOTA_SHORT_WAIT:
+            message = (f"⚠️ RATE LIMITED: every available model is rate-limited right now. "
+                       f"Retry in about {math.ceil(retry_after)} s. Current errors: {details}")
+        else:
+            until = datetime.fromtimestamp(min(resets)).isoformat(timespec='seconds')
+            message = (f"⚠️ QUOTA EXCEEDED: every available model is out of quota until {until}. "
+                       "Solutions: (1) Wait for the quota reset, (2) Get a new API key from https://aistudio.google.com/apikey, "
+                       f"(3) Add GROQ_API_KEY to .env for fallback. Current errors: {details}")
+        return QuotaExceededError(message, status=429, retry_after=retry_after)
+
+    def _effective_key(self, model_name, api_key):
+        """The key a call to model_name would actually use."""
+        return api_key or os.getenv(_PROVIDER_KEY_ENV[_MODEL_PROVIDERS[model_name]]) or ''
+
+    def _timed_call(self, model_name, prompt, max_tokens, api_key, check_circuit=True, deadline=None):
+        """_call_model plus circuit-breaker gating, quota and health bookkeeping.
+
+        Always raises a ProviderError subclass on failure.
+        """
+        self._check_deadline(model_name, deadline)
+        if check_circuit and not self.health.acquire(model_name):
+            raise CircuitOpenError(f"circuit open for {model_name}", model=model_name)
+        started = time.perf_counter()
+        try:
+            with deadline_step(deadline, f'generate:{model_name}'), _attempt(deadline):
+                result = self._call_model(model_name, prompt, max_tokens, api_key=api_key)
+        except Exception as e:
+            error = self._record_failure(model_name, api_key, started, e, deadline)
+            if error is e:
+                raise
+            raise error from e
+        self.health.record_success(model_name, time.perf_counter() - started)
+        return result
+
+    def _check_deadline(self, model_name, deadline):
+        """Skip a model that has no realistic chance of answering in the time left."""
+        if deadline is not None and not deadline.allows(DEADLINE_MIN_ATTEMPT):
+            deadline.skip(f'generate:{model_name}', 'not enough time left')
+            raise DeadlineExceededError(
+                f"{deadline.remaining():.1f}s left of the request budget", model=model_name, status=504)
+
+    def _record_failure(self, model_name, api_key, started, exc, deadline=None):
+        """Classify a provider exception and update the quota ledger / breaker."""
+        error = _classify_provider_error(model_name, exc)
+        if isinstance(error, ProviderTimeoutError) and deadline is not None \
+                and not deadline.allows(DEADLINE_MIN_ATTEMPT):
+            # Cut short by the request budget, not slow by the provider's own standards
+            return DeadlineExceededError(f"timed out at the request deadline {str(error)}".strip(), model=model_name, status=504)
+        if isinstance(error, QuotaExceededError):
+            # Out of quota is not a health problem; the ledger handles it
+            self.quota.mark_exhausted(model_name, self._effective_key(model_name, api_key), error.retry_after)
+        elif not isinstance(error, (ProviderConfigError, ProviderAuthError)) and not api_key:
+            # A failing user-supplied key says nothing about the provider
+            # for everyone else, so only server-key failures trip the breaker
+            self.health.record_failure(model_name, time.perf_counter() - started)
+        return error
+
+    def _hedge_delay(self, model_name):
+        p = self.health.percentile(model_name, HEDGE_PERCENTILE)
+        if p is None:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, p)
+
+    def _generate_hedged(self, chain, prompt, max_tokens, api_key, errors, deadline=None):
+        """
+        Race the fallback chain. The next model is launched when the newest
+        in-flight call outlives its p95 delay, or immediately when a call
+        fails. The first non-empty answer wins; losers that haven't started
+        are cancelled, the rest are left to finish and counted as waste.
+        Returns None when every model failed or the deadline ran out
+        (errors is filled in).
+        """
+        executor = _get_hedge_executor()
+        queue = list(chain)
+        pending = {}
+        launched = []
+        last_launch = [0.0]
+
+        def launch():
+            name = queue.pop(0)
+            future = executor.submit(self._timed_call, name, prompt, max_tokens, api_key, deadline=deadline)
+            pending[future] = name
+            launched.append(name)
+            last_launch[0] = time.perf_counter()
+
+        with self._stats_lock:
+            self.hedge_stats['requests'] += 1
+
+        launch()
+        while pending:
+            timeout = None
+            if queue and len(pending) < HEDGE_MAX_PARALLEL:
+                elapsed = time.perf_counter() - last_launch[0]
+                timeout = max(0.0, self._hedge_delay(launched[-1]) - elapsed)
+            if deadline is not None:
+                timeout = deadline.remaining() if timeout is None else min(timeout, deadline.remaining())
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                if deadline is not None and deadline.expired:
+                    # In-flight calls were launched with timeouts inside the budget
+                    for future, name in pending.items():
+                        future.cancel()
+                        errors.append(DeadlineExceededError("request budget ran out", model=name, status=504))
+                    return None
+                # Timers can fire a little early (~15 ms on Windows): only hedge when there is room
+                if queue and len(pending) < HEDGE_MAX_PARALLEL:
+                    launch()
+                continue
+
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    text = future.result()
+                except ProviderError as e:
+                    errors.append(e)
+                    continue
+                if not text:
+                    errors.append(ProviderError("empty response", model=name))
+                    continue
+                return {
+                    'text': text,
+                    'model': name,
+                    'success': True,
+                    'hedge': self._settle_hedge(name, launched, pending, prompt),
+                }
+
+            # A call failed: move on to the next model straight away
+            if queue and len(pending) < HEDGE_MAX_PARALLEL:
+                launch()
+        return None
+
+    def _settle_hedge(self, winner, launched, pending, prompt):
+        """Cancel or abandon losing calls and account for duplicate spend."""
+        abandoned = []
+        for future, name in pending.items():
+            if not future.cancel():
+                abandoned.append(name)
+                future.add_done_callback(self._account_abandoned)
+
+        duplicate_input = count_tokens(prompt) * len(abandoned)
+        hedged = len(launched) > 1
+        with self._stats_lock:
+            if hedged:
+                self.hedge_stats['hedged_requests'] += 1
+            if winner != launched[0]:
+                self.hedge_stats['hedge_wins'] += 1
+            self.hedge_stats['abandoned_calls'] += len(abandoned)
+            self.hedge_stats['duplicate_input_tokens_est'] += duplicate_input
+
+        return {
+            'hedged': hedged,
+            'launched': list(launched),
+            'winner': winner,
+            'abandoned': abandoned,
+            'duplicate_calls': len(abandoned),
+            'duplicate_input_tokens_est': duplicate_input,
+        }
+
+    def _account_abandoned(self, future):
+        """Output tokens of a losing call still get billed; record them once it lands."""
+        if future.cancelled() or future.exception() is not None:
+            return
+        text = future.result() or ''
+        with self._stats_lock:
+            self.hedge_stats['duplicate_output_tokens_est'] += count_tokens(text)
+
+    def _call_model(self, model_name, prompt, max_tokens, api_key=None):
+        if self.cassette is not None:
+            return self.cassette.call(
+                model_name, prompt, max_tokens,
+                lambda: self._call_provider(model_name, prompt, max_tokens, api_key),
+            )
+        return self._call_provider(model_name, prompt, max_tokens, api_key)
+
+    def _call_provider(self, model_name, prompt, max_tokens, api_key=None):
+        if model_name in _GEMINI_MODEL_IDS:
+            return self._call_gemini(prompt, model_name, max_tokens, api_key=api_key)
+        elif model_name == 'nvidia_minimax':
+            return self._call_nvidia_minimax(prompt, max_tokens, api_key=api_key)
+        elif model_name == 'groq':
+            return self._call_groq(prompt, max_tokens, api_key=api_key)
+
+    def _pool(self):
+        return _client_pool
+
+    def _provider_client(self, provider, api_key):
+        """Pooled client for provider, using the caller's key or the server default."""
+        env_var = _PROVIDER_KEY_ENV[provider]
+        key = api_key or os.getenv(env_var)
+        if not key:
+            raise ProviderConfigError(f"{env_var} not found")
+        return self._pool().get(provider, key, user_supplied=bool(api_key))
+
+    def _gemini_kwargs(self, model_name, max_tokens, contents, prefix=None, handle=None):
+        """generate_content kwargs sized to model_name's token budget; a static prefix goes by handle or system_instruction."""
+        config = {**_GEMINI_GENERATION_CONFIG, 'max_output_tokens': output_budget(model_name, max_tokens)}
+        budget = input_budget(model_name, max_tokens)
+        if prefix is not None:
+            budget -= count_tokens(prefix)
+            if handle:
+                config['cached_content'] = handle
+            else:
+                config['system_instruction'] = prefix
+        if _attempt_timeout.get() is not None:
+            config['http_options'] = {'timeout': int(_provider_timeout(GEMINI_TIMEOUT) * 1000)}
+        return {
+            'model': _GEMINI_MODEL_IDS[model_name],
+            'contents': trim_to_tokens(contents, max(0, budget)),
+            'config': config,
+        }
+
+    def _gemini_cache_args(self, model_name, prefix_name, text):
+        """caches.create() kwargs for a static prefix, or None when it is too small to cache."""
+        if count_tokens(text) < GEMINI_CACHE_MIN_TOKENS:
+            return None
+        return {
+            'model': _GEMINI_MODEL_IDS[model_name],
+            'config': {
+                'system_instruction': text,
+                'ttl': f'{self.prefixes.ttl}s',
+                'display_name': f'promptx-{prefix_name}',
+            },
+        }
+
+    def _gemini_request(self, prompt, model_name, max_tokens, api_key):
+        """(client, generate_content kwargs, prefix name or None)."""
+        client = self._provider_client('gemini', api_key)
+        name, prefix, rest = self.prefixes.split(prompt)
+        if name is None:
+            return client, self._gemini_kwargs(model_name, max_tokens, prompt), None
+
+        def create(text):
+            args = self._gemini_cache_args(model_name, name, text)
+            return client.caches.create(**args).name if args else None
+
+        handle = self.prefixes.handle(
+            'gemini', _GEMINI_MODEL_IDS[model_name], self._effective_key(model_name, api_key), name, create,
+        )
+        return client, self._gemini_kwargs(model_name, max_tokens, rest, prefix, handle), name
+
+    def _record_gemini_usage(self, prefix_name, usage):
+        if prefix_name:
+            self.prefixes.record('gemini', getattr(usage, 'cached_content_token_count', None))
+
+    def _call_gemini(self, prompt, model_name='gemini_flash', max_tokens=2000, api_key=None):
+        client, kwargs, prefix_name = self._gemini_request(prompt, model_name, max_tokens, api_key)
+        response = client.models.generate_content(**kwargs)
+        self._record_gemini_usage(prefix_name, response.usage_metadata)
+        return response.text.strip()
+
+    def _groq_request(self, prompt, max_tokens, api_key):
+        """(HTTP client, JSON body) for a Groq chat completion."""
+        client = self._provider_client('groq', api_key)
+        return client, {
+            'model': 'llama-3.3-70b-versatile',
+            'messages': fit_messages('groq', self._split_prompt(prompt), max_tokens),
+            'max_tokens': output_budget('groq', max_tokens),
+            'temperature': 0.7,
+        }
+
+    def _call_groq(self, prompt, max_tokens, api_key=None):
+        session, body = self._groq_request(prompt, max_tokens, api_key)
+        response = session.post(_GROQ_CHAT_URL, json=body, timeout=_provider_timeout())
+        response.raise_for_status()
+        data = response.json()
+        self._record_chat_usage('groq', prompt, data.get('usage'))
+        msg = data.get('choices', [{}])[0].get('message', {})
+        return str(msg.get('content', '')).strip()
+
+    def _nvidia_request(self, prompt, max_tokens, api_key):
+        """(client, create() kwargs) for an NVIDIA MiniMax chat completion."""
+        client = self._provider_client('nvidia', api_key)
+        return client, {
+            'model': "minimaxai/minimax-m2.7",
+            'messages': fit_messages('nvidia_minimax', self._split_prompt(prompt), max_tokens),
+            'temperature': 0.7,
+            'top_p': 0.9,
+            'max_tokens': output_budget('nvidia_minimax', max_tokens),
+            'timeout': _provider_timeout(),
+        }
+
+    def _call_nvidia_minimax(self, prompt, max_tokens, api_key=None):
+        client, kwargs = self._nvidia_request(prompt, max_tokens, api_key)
+        try:
+            completion = client.chat.completions.create(**kwargs, stream=False)
+            self._record_chat_usage('nvidia', prompt, completion.usage)
+            return completion.choices[0].message.content.strip()
+        except Exception as e:
+            raise self._nvidia_error(e) from e
+
+    def _record_chat_usage(self, provider, prompt, usage):
+        """Count the cached prompt tokens an OpenAI-compatible provider reported for a prefixed prompt."""
+        if self.prefixes.split(prompt)[0] is None:
+            return
+        if hasattr(usage, 'model_dump'):
+            usage = usage.model_dump()
+        details = (usage or {}).get('prompt_tokens_details') or {}
+        self.prefixes.record(provider, details.get('cached_tokens'))
+
+    def _nvidia_error(self, e):
+        error = _classify_provider_error('nvidia_minimax', e)
+        if isinstance(error, ProviderTimeoutError):
+            return ProviderTimeoutError(
+                "NVIDIA API timeout - the model is taking too long to respond. Try a simpler prompt or use a different model.",
+                model='nvidia_minimax',
+            )
+        return error.rewrap(f"NVIDIA API error: {str(e)}")
+
+    def _split_prompt(self, prompt):
+        """Separate system and user parts if combined."""
+        name, prefix, rest = self.prefixes.split(prompt)
+        if name:
+            # Byte-identical system message, so server-side prefix caching can match it
+            return [
+                {'role': 'system', 'content': prefix},
+                {'role': 'user',   'content': rest}
+            ]
+        delimiter = "\n\nUser prompt to enhance:\n"
+        if delimiter in prompt:
+            parts = prompt.split(delimiter, 1)
+            return [
+                {'role': 'system', 'content': parts[0].strip()},
+                {'role': 'user',   'content': parts[1].strip()}
+            ]
+        if ":\n" in prompt and any(k in prompt for k in ["Make this prompt concise", "Rewrite this prompt", "Expand this prompt"]):
+            parts = prompt.split(":\n", 1)
+            return [
+                {'role': 'system', 'content': parts[0].strip()},
+                {'role': 'user',   'content': parts[1].strip()}
+            ]
+        return [{'role': 'user', 'content': prompt}]
+
+
+# Global fallback instance
+_fallback = AIModelFallback()
+
+def get_client():
+    """Legacy function - returns Gemini client"""
+    api_key = os.getenv('GEMINI_API_KEY')
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY not found in environment")
+    return _client_pool.get('gemini', api_key)
+
+# Shared by generate_with_fallback and agenerate_with_fallback, across workers
+_generation_cache = _response_store('generate')
+
+
+@_generation_cache
+def generate_with_fallback(prompt, max_tokens=2000, preferred_model=None, api_key=None, deadline=None):
+    """Generate text with automatic model fallback."""
+    return _fallback.generate(prompt, max_tokens, preferred_model=preferred_model, api_key=api_key, deadline=deadline)
+
+
+# ============================================================================
+# ASYNC PROVIDER LAYER
+# ============================================================================
+
+# Per-worker ceiling on concurrent upstream connections per provider client
+ASYNC_MAX_CONNECTIONS = int(os.getenv('PROMPTX_ASYNC_MAX_CONNECTIONS', 200))
+
+
+def _async_limits():
+    import httpx
+    return httpx.Limits(
+        max_connections=ASYNC_MAX_CONNECTIONS,
+        max_keepalive_connections=min(ASYNC_MAX_CONNECTIONS, 50),
+        keepalive_expiry=120,
+    )
+
+
+def _build_gemini_async_client(key):
+    # The async surface of the google-genai SDK lives on Client.aio
+    return _build_gemini_client(key).aio
+
+
+def _build_nvidia_async_client(key):
+    from openai import AsyncOpenAI
+    import httpx
+    return AsyncOpenAI(
+        base_url=_NVIDIA_BASE_URL,
+        api_key=key,
+        timeout=httpx.Timeout(PROVIDER_TIMEOUT, connect=10.0),
+        http_client=httpx.AsyncClient(timeout=httpx.Timeout(PROVIDER_TIMEOUT, connect=10.0), limits=_async_limits()),
+    )
+
+
+def _build_groq_async_client(key):
+    import httpx
+    return httpx.AsyncClient(
+        headers={'Authorization': f'Bearer {key}'},
+        timeout=httpx.Timeout(PROVIDER_TIMEOUT, connect=10.0),
+        limits=_async_limits(),
+    )
+
+
+class AsyncProviderClientPool(ProviderClientPool):
+    """ProviderClientPool of asyncio clients. One per event loop, since their connection pools are loop-bound."""
+
+    FACTORIES = {
+        'gemini': _build_gemini_async_client,
+        'nvidia': _build_nvidia_async_client,
+        'groq': _build_groq_async_client,
+    }
+
+    async def aclose(self):
+        """Close every pooled client (called as their loop shuts down)."""
+        with self._lock:
+            clients = [entry['client'] for entry in self._clients.values()]
+            self._clients.clear()
+        for client in clients:
+            await _aclose_client(client)
+
+
+async def _aclose_client(client):
+    # httpx and google-genai clients have aclose(); AsyncOpenAI has an async close()
+    close = getattr(client, 'aclose', None) or getattr(client, 'close', None)
+    if close is not None:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
+
+
+# ── loop lifetime ───────────────────────────────────────────────────────────
+# Pools and clients below are kept per event loop. Under ASGI that is the
+# worker's loop; under WSGI Django would run every async view on a fresh
+# loop (async_to_sync), so views and _iterate_sync are routed onto one
+# long-lived loop per worker process instead. Whatever loop a client was
+# made on, it is closed when that loop shuts down its async generators
+# (asyncio.run does, so one-off loops don't leak connections).
+
+_async_pools = weakref.WeakKeyDictionary()
+_async_pools_lock = threading.Lock()
+_loop_closers = weakref.WeakKeyDictionary()
+_worker_loop = None
+_worker_loop_pid = None
+
+
+def _close_with_loop(loop, close):
+    """Await close() when the running loop shuts down its async generators."""
+    async def closer():
+        try:
+            yield
+        finally:
+            await close()
+
+    agen = closer()
+    asyncio.ensure_future(agen.__anext__())
+    # The loop only tracks async generators weakly
+    _loop_closers.setdefault(loop, []).append(agen)
+
+
+def worker_loop():
+    """This process's long-lived event loop, run forever in a daemon thread."""
+    global _worker_loop, _worker_loop_pid
+    with _async_pools_lock:
+        if _worker_loop is None or _worker_loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='promptx-worker-loop', daemon=True).start()
+            _worker_loop, _worker_loop_pid = loop, os.getpid()
+        return _worker_loop
+
+
+def run_on_worker_loop(coro):
+    """Run a coroutine on worker_loop() from sync code and return its result."""
+    return asyncio.run_coroutine_threadsafe(coro, worker_loop()).result()
+
+
+async def arun_on_worker_loop(coro):
+    """Await a coroutine on worker_loop() from another loop (cancellation is passed through)."""
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, worker_loop()))
+
+
+def _get_async_pool():
+    """The AsyncProviderClientPool for the running loop (one per worker, see worker_loop)."""
+    loop = asyncio.get_running_loop()
+    with _async_pools_lock:
+        pool = _async_pools.get(loop)
+        if pool is None:
+            pool = _async_pools[loop] = AsyncProviderClientPool(
+                capacity=_client_pool.capacity,
+                idle_ttl=_client_pool.idle_ttl,
+                user_ttl=_client_pool.user_ttl,
+            )
+            _close_with_loop(loop, pool.aclose)
+        return pool
+
+
+class AsyncAIModelFallback(AIModelFallback):
+    """
+    asyncio twin of AIModelFallback for async views. Model order, circuit
+    breakers, the quota ledger and request building are inherited; only
+    the network calls and the hedging race are re-implemented, so a single
+    worker can hold hundreds of provider calls in flight. Streaming exists
+    only here.
+    """
+
+    def __init__(self, shared=None):
+        super().__init__()
+        if shared is not None:
+            # Report hedging alongside the sync instance
+            self._stats_lock = shared._stats_lock
+            self.hedge_stats = shared.hedge_stats
+
+    def _pool(self):
+        return _get_async_pool()
+
+    async def generate(self, prompt, max_tokens=2000, preferred_model=None, api_key=None, deadline=None):
+        """Async AIModelFallback.generate."""
+        errors = []
+
+        if self._is_explicit(preferred_model):
+            self._check_quota(preferred_model, api_key)
+            try:
+                result = await self._timed_call(preferred_model, prompt, max_tokens, api_key, check_circuit=False, deadline=deadline)
+                if result:
+                    return {'text': result, 'model': preferred_model, 'success': True}
+            except ProviderError as e:
+                raise e.rewrap(f"Selected model '{preferred_model}' failed: {str(e)}")
+
+        chain = self._auto_chain(api_key, errors)
+
+        if self.hedge_enabled and len(chain) > 1:
+            result = await self._generate_hedged(chain, prompt, max_tokens, api_key, errors, deadline)
+            if result:
+                return result
+        else:
+            for model_name in chain:
+                try:
+                    result = await self._timed_call(model_name, prompt, max_tokens, api_key, deadline=deadline)
+                    if result:
+                        return {'text': result, 'model': model_name, 'success': True}
+                except ProviderError as e:
+                    errors.append(e)
+
+        raise self._exhausted_error(errors, api_key)
+
+    async def generate_stream(self, prompt, max_tokens=2000, preferred_model=None, api_key=None, deadline=None):
+        """
+        Streaming counterpart of generate(), as an async generator. Yields
+        ('model', name) once a provider starts answering, then ('delta', text)
+        chunks.
+
+        Falls back to the next model only while nothing has been yielded;
+        a failure mid-stream is raised because the client already has text.
+        Hedging does not apply: time-to-first-token is what the user sees.
+        The deadline bounds each model's wait for its first chunk.
+        """
+        errors = []
+        explicit = self._is_explicit(preferred_model)
+        if explicit:
+            self._check_quota(preferred_model, api_key)
+            chain = [preferred_model]
+        else:
+            chain = self._auto_chain(api_key, errors)
+
+        for model_name in chain:
+            stream = self._timed_stream(model_name, prompt, max_tokens, api_key, check_circuit=not explicit, deadline=deadline)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                errors.append(ProviderError("empty response", model=model_name))
+                continue
+            except ProviderError as e:
+                if explicit:
+                    raise e.rewrap(f"Selected model '{preferred_model}' failed: {str(e)}")
+                errors.append(e)
+                continue
+            yield ('model', model_name)
+            yield ('delta', first)
+            async for chunk in stream:
+                yield ('delta', chunk)
+            return
+
+        raise self._exhausted_error(errors, api_key)
+
+    async def _timed_call(self, model_name, prompt, max_tokens, api_key, check_circuit=True, deadline=None):
+        self._check_deadline(model_name, deadline)
+        if check_circuit and not self.health.acquire(model_name):
+            raise CircuitOpenError(f"circuit open for {model_name}", model=model_name)
+        started = time.perf_counter()
+        try:
+            with deadline_step(deadline, f'generate:{model_name}'), _attempt(deadline):
+                result = await self._call_model(model_name, prompt, max_tokens, api_key=api_key)
+        except Exception as e:
+            error = self._record_failure(model_name, api_key, started, e, deadline)
+            if error is e:
+                raise
+            raise error from e
+        self.health.record_success(model_name, time.perf_counter() - started)
+        return result
+
+    async def _timed_stream(self, model_name, prompt, max_tokens, api_key, check_circuit=True, deadline=None):
+        """_stream_model with the same bookkeeping as _timed_call."""
+        self._check_deadline(model_name, deadline)
+        if check_circuit and not self.health.acquire(model_name):
+            raise CircuitOpenError(f"circuit open for {model_name}", model=model_name)
+        started = time.perf_counter()
+        try:
+            chunks = self._stream_model(model_name, prompt, max_tokens, api_key=api_key).__aiter__()
+            # The request goes out on the first anext(); later reads keep its timeout
+            with deadline_step(deadline, f'generate:{model_name}'), _attempt(deadline):
+                first = await anext(chunks, None)
+            if first:
+                yield first
+            async for chunk in chunks:
+                if chunk:
+                    yield chunk
+        except Exception as e:
+            error = self._record_failure(model_name, api_key, started, e, deadline)
+            if error is e:
+                raise
+            raise error from e
+        self.health.record_success(model_name, time.perf_counter() - started)
+
+    async def _generate_hedged(self, chain, prompt, max_tokens, api_key, errors, deadline=None):
+        """
+        Same race as the threaded version, on tasks. Losing tasks are
+        cancelled outright, which also aborts their HTTP requests, so async
+        hedging leaves no abandoned calls behind.
+        """
+        queue = list(chain)
+        pending = {}
+        launched = []
+        last_launch = [0.0]
+
+        def launch():
+            name = queue.pop(0)
+            task = asyncio.ensure_future(self._timed_call(name, prompt, max_tokens, api_key, deadline=deadline))
+            pending[task] = name
+            launched.append(name)
+            last_launch[0] = time.perf_counter()
+
+        with self._stats_lock:
+            self.hedge_stats['requests'] += 1
+
+        launch()
+        while pending:
+            timeout = None
+            if queue and len(pending) < HEDGE_MAX_PARALLEL:
+                elapsed = time.perf_counter() - last_launch[0]
+                timeout = max(0.0, self._hedge_delay(launched[-1]) - elapsed)
+            if deadline is not None:
+                timeout = deadline.remaining() if timeout is None else min(timeout, deadline.remaining())
+            done, _ = await asyncio.wait(list(pending), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                if deadline is not None and deadline.expired:
+                    for task, name in pending.items():
+                        task.cancel()
+                        errors.append(DeadlineExceededError("request budget ran out", model=name, status=504))
+                    return None
+                if queue and len(pending) < HEDGE_MAX_PARALLEL:
+                    launch()
+                continue
+
+            for task in done:
+                name = pending.pop(task)
+                try:
+                    text = task.result()
+                except ProviderError as e:
+                    errors.append(e)
+                    continue
+                if not text:
+                    errors.append(ProviderError("empty response", model=name))
+                    continue
+                return {
+                    'text': text,
+                    'model': name,
+                    'success': True,
+                    'hedge': self._settle_hedge(name, launched, pending, prompt),
+                }
+
+            if queue and len(pending) < HEDGE_MAX_PARALLEL:
+                launch()
+        return None
+
+    async def _call_model(self, model_name, prompt, max_tokens, api_key=None):
+        if self.cassette is not None:
+            return await self.cassette.acall(
+                model_name, prompt, max_tokens,
+                lambda: self._call_provider(model_name, prompt, max_tokens, api_key),
+            )
+        return await self._call_provider(model_name, prompt, max_tokens, api_key)
+
+    def _stream_model(self, model_name, prompt, max_tokens, api_key=None):
+        """Async iterator of text chunks; same backend choice as _call_model."""
+        if self.cassette is not None:
+            return self.cassette.astream(
+                model_name, prompt, max_tokens,
+                lambda: self._stream_provider(model_name, prompt, max_tokens, api_key),
+            )
+        return self._stream_provider(model_name, prompt, max_tokens, api_key)
+
+    async def _call_provider(self, model_name, prompt, max_tokens, api_key=None):
+        if model_name in _GEMINI_MODEL_IDS:
+            return await self._call_gemini(prompt, model_name, max_tokens, api_key=api_key)
+        elif model_name == 'nvidia_minimax':
+            return await self._call_nvidia_minimax(prompt, max_tokens, api_key=api_key)
+        elif model_name == 'groq':
+            return await self._call_groq(prompt, max_tokens, api_key=api_key)
+
+    def _stream_provider(self, model_name, prompt, max_tokens, api_key=None):
+        """Async iterator of text chunks; same dispatch as _call_provider."""
+        if model_name in _GEMINI_MODEL_IDS:
+            return self._stream_gemini(prompt, model_name, max_tokens, api_key=api_key)
+        elif model_name == 'nvidia_minimax':
+            return self._stream_nvidia_minimax(prompt, max_tokens, api_key=api_key)
+        elif model_name == 'groq':
+            return self._stream_groq(prompt, max_tokens, api_key=api_key)
+        raise ProviderConfigError(f"Unknown model: {model_name}", model=model_name)
+
+    async def _gemini_request(self, prompt, model_name, max_tokens, api_key):
+        """Async AIModelFallback._gemini_request."""
+        client = self._provider_client('gemini', api_key)
+        name, prefix, rest = self.prefixes.split(prompt)
+        if name is None:
+            return client, self._gemini_kwargs(model_name, max_tokens, prompt), None
+
+        async def create(text):
+            args = self._gemini_cache_args(model_name, name, text)
+            return (await client.caches.create(**args)).name if args else None
+
+        handle = await self.prefixes.ahandle(
+            'gemini', _GEMINI_MODEL_IDS[model_name], self._effective_key(model_name, api_key), name, create,
+        )
+        return client, self._gemini_kwargs(model_name, max_tokens, rest, prefix, handle), name
+
+    async def _call_gemini(self, prompt, model_name='gemini_flash', max_tokens=2000, api_key=None):
+        client, kwargs, prefix_name = await self._gemini_request(prompt, model_name, max_tokens, api_key)
+        response = await client.models.generate_content(**kwargs)
+        self._record_gemini_usage(prefix_name, response.usage_metadata)
+        return response.text.strip()
+
+    async def _stream_gemini(self, prompt, model_name='gemini_flash', max_tokens=2000, api_key=None):
+        client, kwargs, prefix_name = await self._gemini_request(prompt, model_name, max_tokens, api_key)
+        usage = None
+        async for chunk in await client.models.generate_content_stream(**kwargs):
+            usage = chunk.usage_metadata or usage
+            if chunk.text:
+                yield chunk.text
+        self._record_gemini_usage(prefix_name, usage)
+
+    async def _call_groq(self, prompt, max_tokens, api_key=None):
+        client, body = self._groq_request(prompt, max_tokens, api_key)
+        response = await client.post(_GROQ_CHAT_URL, json=body, timeout=_provider_timeout())
+        response.raise_for_status()
+        data = response.json()
+        self._record_chat_usage('groq', prompt, data.get('usage'))
+        msg = data.get('choices', [{}])[0].get('message', {})
+        return str(msg.get('content', '')).strip()
+
+    async def _stream_groq(self, prompt, max_tokens, api_key=None):
+        client, body = self._groq_request(prompt, max_tokens, api_key)
+        async with client.stream('POST', _GROQ_CHAT_URL, json={**body, 'stream': True}, timeout=_provider_timeout()) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                done, text = _sse_delta(line)
+                if done:
+                    break
+                if text:
+                    yield text
+
+    async def _call_nvidia_minimax(self, prompt, max_tokens, api_key=None):
+        client, kwargs = self._nvidia_request(prompt, max_tokens, api_key)
+        try:
+            completion = await client.chat.completions.create(**kwargs, stream=False)
+            self._record_chat_usage('nvidia', prompt, completion.usage)
+            return completion.choices[0].message.content.strip()
+        except Exception as e:
+            raise self._nvidia_error(e) from e
+
+    async def _stream_nvidia_minimax(self, prompt, max_tokens, api_key=None):
+        client, kwargs = self._nvidia_request(prompt, max_tokens, api_key)
+        try:
+            async for chunk in await client.chat.completions.create(**kwargs, stream=True):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            raise self._nvidia_error(e) from e
+
+
+_async_fallback = AsyncAIModelFallback(shared=_fallback)
+
+
+@_generation_cache
+async def agenerate_with_fallback(prompt, max_tokens=2000, preferred_model=None, api_key=None, deadline=None):
+    """Async generate_with_fallback; shares its response cache."""
+    return await _async_fallback.generate(prompt, max_tokens, preferred_model=preferred_model, api_key=api_key, deadline=deadline)
+
+
+def astream_with_fallback(prompt, max_tokens=2000, preferred_model=None, api_key=None, deadline=None):
+    """Streaming generate_with_fallback: an async generator of ('model', name), then ('delta', text) chunks."""
+    return _async_fallback.generate_stream(prompt, max_tokens, preferred_model=preferred_model, api_key=api_key, deadline=deadline)
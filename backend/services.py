@@ -1,434 +1,161 @@
-"""  
-PromptX Services - Gemini + Groq fallback, web scraping, search
 """
-from google import genai
+PromptX Services - page summaries, intent detection, quality analysis, A/B testing
+
+The provider, cache and crawler layers live in providers.py, caches.py and crawler.py.
+"""
 import os
-import re
-import requests
 from dotenv import load_dotenv
 
 load_dotenv()
 
-import copy
-from functools import wraps
-from collections import OrderedDict
-
-class DeepCopyLRUCache:
-    """An LRU Cache wrapper that returns deep copies of cached values to prevent mutation side-effects."""
-    def __init__(self, capacity=500):
-        self.cache = OrderedDict()
-        self.capacity = capacity
-
-    def __call__(self, func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            key = (args, frozenset(kwargs.items()))
-            if key in self.cache:
-                self.cache.move_to_end(key)
-                return copy.deepcopy(self.cache[key])
-            result = func(*args, **kwargs)
-            self.cache[key] = copy.deepcopy(result)
-            if len(self.cache) > self.capacity:
-                self.cache.popitem(last=False)
-            return result
-        return wrapper
+import asyncio
+import hashlib
+
+from caches import FrozenLRUCache, _near_index, _response_store
+from providers import (
+    DeadlineExceededError, ProviderError, _async_fallback, _budget_stats, _budget_stats_lock,
+    _client_pool, _fallback, _generation_cache, agenerate_with_fallback, deadline_step,
+    run_on_worker_loop, trim_to_tokens,
+)
+from crawler import _crawl_cache, _search_cache
+
+# The single-module API this file used to hold, still importable from here
+from providers import AIModelFallback, get_client, generate_with_fallback
+from crawler import scrape_url, scrape_website_deep, web_search
+
 
 # ============================================================================
-# MULTI-MODEL FALLBACK SYSTEM
+# PROCESS METRICS
 # ============================================================================
 
-class AIModelFallback:
-    """Handles automatic fallback between Gemini and Groq"""
-    
-    def __init__(self):
-        self.models = [
-            {'name': 'gemini_flash', 'priority': 1},
-            {'name': 'gemini_flash_8b', 'priority': 2},
-            {'name': 'gemini_pro', 'priority': 3},
-            {'name': 'nvidia_minimax', 'priority': 4},
-            {'name': 'groq', 'priority': 5},
-        ]
-    
-    def generate(self, prompt, max_tokens=2000, preferred_model=None, api_key=None):
-        """Try models in order until one succeeds. If preferred_model is explicitly set, ONLY use that model."""
-        errors = []
-        
-        # If user explicitly chose a model, ONLY use that model (no fallback)
-        if preferred_model and preferred_model != 'auto' and preferred_model in [m['name'] for m in self.models]:
-            try:
-                result = self._call_model(preferred_model, prompt, max_tokens, api_key=api_key)
-                if result:
-                    return {'text': result, 'model': preferred_model, 'success': True}
-            except Exception as e:
-                # When user explicitly selects a model, don't fallback - just fail with clear error
-                raise Exception(f"Selected model '{preferred_model}' failed: {str(e)}")
-        
-        # Auto mode: Try all models in fallback order
-        for model in self.models:
-            try:
-                result = self._call_model(model['name'], prompt, max_tokens, api_key=api_key)
-                if result:
-                    return {'text': result, 'model': model['name'], 'success': True}
-            except Exception as e:
-                errors.append(f"{model['name']}: {str(e)}")
-                continue
-        
-        # Check if all errors are quota-related
-        if all('429' in str(e) or 'quota' in str(e).lower() or 'resource_exhausted' in str(e).lower() for e in errors):
-            raise Exception(
-                "⚠️ QUOTA EXCEEDED: All Gemini models have hit their daily free tier limit. "
-                "Solutions: (1) Wait until tomorrow for quota reset, (2) Get a new API key from https://aistudio.google.com/apikey, "
-                "(3) Add GROQ_API_KEY to .env for fallback. Current errors: " + '; '.join(errors[:2])
-            )
-        
-        raise Exception(f"All models failed. Errors: {'; '.join(errors)}")
-    
-    def _call_model(self, model_name, prompt, max_tokens, api_key=None):
-        if model_name == 'gemini_flash':
-            return self._call_gemini(prompt, 'gemini-2.0-flash', api_key=api_key)
-        elif model_name == 'gemini_flash_8b':
-            return self._call_gemini(prompt, 'gemini-2.0-flash-lite', api_key=api_key)
-        elif model_name == 'gemini_pro':
-            return self._call_gemini(prompt, 'gemini-2.5-pro', api_key=api_key)
-        elif model_name == 'nvidia_minimax':
-            return self._call_nvidia_minimax(prompt, max_tokens, api_key=api_key)
-        elif model_name == 'groq':
-            return self._call_groq(prompt, max_tokens, api_key=api_key)
-    
-    def _call_gemini(self, prompt, model='gemini-2.0-flash', api_key=None):
-        key = api_key or os.getenv('GEMINI_API_KEY')
-        if not key:
-            raise ValueError("GEMINI_API_KEY not found")
-        client = genai.Client(api_key=key)
-        response = client.models.generate_content(
-            model=model,
-            contents=prompt,
-            config={
-                'temperature': 0.3,
-                'top_p': 0.95,
-                'top_k': 40,
-                'max_output_tokens': 8192,
-            }
-        )
-        return response.text.strip()
-
-    def _call_groq(self, prompt, max_tokens, api_key=None):
-        key = api_key or os.getenv('GROQ_API_KEY')
-        if not key:
-            raise ValueError("GROQ_API_KEY not found")
-        
-        # Groq has strict limits - truncate aggressively
-        max_input_chars = 30000  # Much more conservative
-        if len(prompt) > max_input_chars:
-            prompt = prompt[:max_input_chars] + "\n\n[Content truncated to fit Groq limits]"
-        
-        messages = self._split_prompt(prompt)
-        
-        # Truncate individual messages
-        for msg in messages:
-            if len(msg.get('content', '')) > max_input_chars:
-                msg['content'] = msg['content'][:max_input_chars] + "\n\n[Truncated]"
-        
-        response = requests.post(
-            'https://api.groq.com/openai/v1/chat/completions',
-            headers={'Authorization': f'Bearer {key}'},
-            json={
-                'model': 'llama-3.3-70b-versatile',
-                'messages': messages,
-                'max_tokens': min(max_tokens, 4096),
-                'temperature': 0.7,
-            },
-            timeout=60
-        )
-        response.raise_for_status()
-        msg = response.json().get('choices', [{}])[0].get('message', {})
-        return str(msg.get('content', '')).strip()
-
-    def _call_nvidia_minimax(self, prompt, max_tokens, api_key=None):
-        key = api_key or os.getenv('NVIDIA_API_KEY')
-        if not key:
-            raise ValueError("NVIDIA_API_KEY not found")
-        
-        from openai import OpenAI
-        import httpx
-        
-        # Create client with longer timeout
-        client = OpenAI(
-            base_url="https://integrate.api.nvidia.com/v1",
-            api_key=key,
-            timeout=httpx.Timeout(60.0, connect=10.0)  # 60s total, 10s connect
-        )
-        
-        # Truncate prompt for faster response
-        max_input_chars = 6000
-        if len(prompt) > max_input_chars:
-            prompt = prompt[:max_input_chars] + "\n\n[Truncated for speed]"
-        
-        messages = self._split_prompt(prompt)
-        
-        try:
-            completion = client.chat.completions.create(
-                model="minimaxai/minimax-m2.7",
-                messages=messages,
-                temperature=0.7,
-                top_p=0.9,
-                max_tokens=min(max_tokens, 2048),
-                stream=False
-            )
-            return completion.choices[0].message.content.strip()
-        except Exception as e:
-            error_msg = str(e)
-            if "timeout" in error_msg.lower():
-                raise Exception(f"NVIDIA API timeout - the model is taking too long to respond. Try a simpler prompt or use a different model.")
-            raise Exception(f"NVIDIA API error: {error_msg}")
-
-    def _split_prompt(self, prompt):
-        """Separate system and user parts if combined."""
-        delimiter = "\n\nUser prompt to enhance:\n"
-        if delimiter in prompt:
-            parts = prompt.split(delimiter, 1)
-            return [
-                {'role': 'system', 'content': parts[0].strip()},
-                {'role': 'user',   'content': parts[1].strip()}
-            ]
-        if ":\n" in prompt and any(k in prompt for k in ["Make this prompt concise", "Rewrite this prompt", "Expand this prompt"]):
-            parts = prompt.split(":\n", 1)
-            return [
-                {'role': 'system', 'content': parts[0].strip()},
-                {'role': 'user',   'content': parts[1].strip()}
-            ]
-        return [{'role': 'user', 'content': prompt}]
-
-
-# Global fallback instance
-_fallback = AIModelFallback()
-
-def get_client():
-    """Legacy function - returns Gemini client"""
-    api_key = os.getenv('GEMINI_API_KEY')
-    if not api_key:
-        raise ValueError("GEMINI_API_KEY not found in environment")
-    return genai.Client(api_key=api_key)
-
-@DeepCopyLRUCache(capacity=500)
-def generate_with_fallback(prompt, max_tokens=2000, preferred_model=None, api_key=None):
-    """Generate text with automatic model fallback."""
-    return _fallback.generate(prompt, max_tokens, preferred_model=preferred_model, api_key=api_key)
+def provider_stats():
+    """Process-level provider metrics for the stats endpoint (never the public /health)."""
+    with _fallback._stats_lock:
+        hedge = dict(_fallback.hedge_stats)
+    with _budget_stats_lock:
+        budgets = dict(_budget_stats)
+    return {
+        'hedging': {'enabled': _fallback.hedge_enabled, **hedge},
+        'client_pool': _client_pool.stats(),
+        'health': _fallback.health.snapshot(),
+        'quota': _fallback.quota.snapshot(),
+        'budgets': budgets,
+        'response_store': {
+            'generate': _generation_cache.stats(),
+            'ab_variations': _ab_cache.stats(),
+            'web_search': _search_cache.stats(),
+            'page_summaries': _summary_cache.stats(),
+        },
+        'near_duplicates': _near_index.stats(),
+        'prefix_cache': _fallback.prefixes.snapshot(),
+        'cassette': _fallback.cassette.stats() if _fallback.cassette else None,
+        'crawl_cache': _crawl_cache.stats(),
+        'result_caches': {
+            'intent': _intent_cache.stats(),
+            'quality': _quality_cache.stats(),
+        },
+    }
 
 
 # ============================================================================
-# WEB SCRAPING & SEARCH
+# PAGE SUMMARIES (MAP STEP OF MAP-REDUCE SYNTHESIS)
 # ============================================================================
-
-_SCRAPE_HEADERS = {
-    'User-Agent': (
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-        'AppleWebKit/537.36 (KHTML, like Gecko) '
-        'Chrome/120.0.0.0 Safari/537.36'
-    ),
-    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-    'Accept-Language': 'en-US,en;q=0.5',
-}
-
-# Pages worth crawling on any website
-_VALUABLE_PATHS = [
-    '/', '/about', '/about-us', '/features', '/pricing', '/docs',
-    '/documentation', '/api', '/api-docs', '/developers', '/tech',
-    '/blog', '/careers', '/team', '/product', '/solutions',
-    '/how-it-works', '/integrations', '/security', '/enterprise',
+# A long crawl can be synthesised from per-page summaries instead of its
+# text: every page is summarised at once by the fastest model, then one
+# synthesis call runs over the summaries, well inside any model's context.
+
+SUMMARY_MODEL = os.getenv('PROMPTX_SUMMARY_MODEL', 'gemini_flash_8b')
+# Tried in order, cheapest first, when SUMMARY_MODEL has no key, no quota or fails
+SUMMARY_FALLBACK_MODELS = [
+    m.strip() for m in os.getenv('PROMPTX_SUMMARY_FALLBACK_MODELS', 'groq,gemini_flash,nvidia_minimax').split(',')
+    if m.strip()
 ]
+SUMMARY_MAX_TOKENS = int(os.getenv('PROMPTX_SUMMARY_MAX_TOKENS', 500))
+SUMMARY_CONCURRENCY = int(os.getenv('PROMPTX_SUMMARY_CONCURRENCY', 6))
+SUMMARY_CACHE_TTL = int(os.getenv('PROMPTX_SUMMARY_CACHE_TTL', 7 * 86400))
 
+_SUMMARY_PROMPT = """Summarise this web page for a technical and product analysis of its website.
+Keep every concrete fact: features, pricing and plans, technologies, APIs and endpoints, integrations, \
+limits, numbers and names, verbatim where you can. Terse markdown bullets, at most {words} words, no preamble.
 
-def _clean_html(html: str, max_chars: int = 8000) -> tuple:
-    """Strip HTML and return (title, clean_text)."""
-    title_match = re.search(r'<title[^>]*>(.*?)</title>', html, re.IGNORECASE | re.DOTALL)
-    title = re.sub(r'<[^>]+>', '', title_match.group(1)).strip() if title_match else ''
-
-    # Remove noise tags
-    html = re.sub(
-        r'<(script|style|noscript|nav|footer|header|aside|iframe|svg|'
-        r'form|button|input|select|textarea|meta|link)[^>]*>.*?</\1>',
-        '', html, flags=re.IGNORECASE | re.DOTALL
-    )
-    # Strip remaining tags
-    text = re.sub(r'<[^>]+>', ' ', html)
-
-    # Decode HTML entities
-    for ent, ch in [
-        ('&amp;','&'),('&lt;','<'),('&gt;','>'),('&quot;','"'),
-        ('&#39;',"'"),('&nbsp;',' '),('&mdash;','—'),('&ndash;','–'),
-        ('&hellip;','...'),('&copy;','©'),('&reg;','®'),
-    ]:
-        text = text.replace(ent, ch)
-
-    text = re.sub(r'[ \t]+', ' ', text)
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    text = '\n'.join(l.strip() for l in text.splitlines() if l.strip())
-
-    if len(text) > max_chars:
-        text = text[:max_chars] + f'\n[truncated at {max_chars} chars]'
-
-    return title, text
-
-
-def _extract_internal_links(html: str, base_url: str) -> list:
-    """Extract unique internal links from HTML."""
-    from urllib.parse import urljoin, urlparse
-    base = urlparse(base_url)
-    base_root = f"{base.scheme}://{base.netloc}"
-
-    hrefs = re.findall(r'<a[^>]+href=["\']([^"\'#?]+)["\']', html, re.IGNORECASE)
-    seen = set()
-    links = []
-    for href in hrefs:
-        full = urljoin(base_root, href)
-        parsed = urlparse(full)
-        # Only same-domain, no files
-        if (parsed.netloc == base.netloc and
-                not re.search(r'\.(pdf|jpg|png|gif|svg|zip|css|js|ico|woff)$', parsed.path, re.I) and
-                full not in seen):
-            seen.add(full)
-            links.append(full)
-    return links
-
-
-def scrape_url(url: str, max_chars: int = 8000) -> dict:
-    """Scrape a single URL. Returns { success, url, title, text, char_count, links, error }."""
-    try:
-        resp = requests.get(url, headers=_SCRAPE_HEADERS, timeout=12, allow_redirects=True)
-        resp.raise_for_status()
-        html = resp.text
-        title, text = _clean_html(html, max_chars)
-        links = _extract_internal_links(html, url)
-        return {
-            'success': True, 'url': url, 'title': title or url,
-            'text': text, 'char_count': len(text),
-            'links': links, 'error': None,
-        }
-    except requests.exceptions.Timeout:
-        return {'success': False, 'url': url, 'title': '', 'text': '',
-                'char_count': 0, 'links': [], 'error': 'Timed out after 12s'}
-    except requests.exceptions.HTTPError as e:
-        return {'success': False, 'url': url, 'title': '', 'text': '',
-                'char_count': 0, 'links': [], 'error': f'HTTP {e.response.status_code}'}
-    except Exception as e:
-        return {'success': False, 'url': url, 'title': '', 'text': '',
-                'char_count': 0, 'links': [], 'error': str(e)}
+PAGE: {title}
 
+{text}"""
 
-def scrape_website_deep(base_url: str, max_pages: int = 8, chars_per_page: int = 6000) -> dict:
-    """
-    Multi-page website crawler.
-    Scrapes the homepage + up to max_pages valuable sub-pages.
-    Returns aggregated content with per-page breakdown.
-    """
-    from urllib.parse import urlparse, urljoin
 
-    parsed = urlparse(base_url)
-    base_root = f"{parsed.scheme}://{parsed.netloc}"
+def _content_hash(page):
+    return hashlib.sha256(f"{page['title']}\n{page['text']}".encode('utf-8')).hexdigest()
 
-    # Step 1: Scrape homepage
-    home = scrape_url(base_url, chars_per_page)
-    if not home['success']:
-        return {
-            'success': False,
-            'base_url': base_url,
-            'pages_scraped': 0,
-            'pages': [],
-            'combined_text': '',
-            'total_chars': 0,
-            'error': home['error'],
-        }
 
-    pages = [{'url': base_url, 'title': home['title'], 'text': home['text']}]
+def _summary_prompt(title, text):
+    return _SUMMARY_PROMPT.format(words=SUMMARY_MAX_TOKENS * 2 // 3, title=title, text=text)
+
+
+def _summary_models():
+    return list(dict.fromkeys([SUMMARY_MODEL, *SUMMARY_FALLBACK_MODELS]))
+
 
-    # Step 2: Build candidate URLs — valuable paths + links found on homepage
-    candidates = []
-    for path in _VALUABLE_PATHS:
-        candidates.append(urljoin(base_root, path))
-    for link in home.get('links', [])[:30]:
-        if link not in candidates:
-            candidates.append(link)
+def _extractive_summary(text, error):
+    """The page's opening as its summary, when the model couldn't summarise it."""
+    print(f"Page summary failed, using the page's opening: {error}")
+    return {'summary': trim_to_tokens(text, SUMMARY_MAX_TOKENS), 'model': None}
 
-    # Step 3: Scrape candidates until we hit max_pages
-    scraped_urls = {base_url}
-    for candidate in candidates:
-        if len(pages) >= max_pages:
+
+# Shared across workers. Keyed by the page's content hash, so an unchanged
+# page is summarised once however it was reached; extractive fallbacks are
+# not kept.
+_summary_cache = _response_store(
+    'page_summaries', ttl=SUMMARY_CACHE_TTL, unkeyed=('title', 'text'),
+    cacheable=lambda result: result['model'] is not None,
+)
+
+
+@_summary_cache
+async def _asummarise_page(content_hash, title, text, api_key=None, deadline=None):
+    error = None
+    for model in _summary_models():
+        try:
+            result = await _async_fallback.generate(
+                _summary_prompt(title, text), SUMMARY_MAX_TOKENS, preferred_model=model, api_key=api_key, deadline=deadline,
+            )
+        except DeadlineExceededError as e:
+            error = e
             break
-        if candidate in scraped_urls:
+        except ProviderError as e:
+            error = e
             continue
-        scraped_urls.add(candidate)
-
-        result = scrape_url(candidate, chars_per_page)
-        if result['success'] and result['char_count'] > 200:
-            pages.append({
-                'url': candidate,
-                'title': result['title'],
-                'text': result['text'],
-            })
-
-    # Step 4: Combine all page text
-    combined_parts = []
-    for p in pages:
-        combined_parts.append(
-            f"=== PAGE: {p['title']} ===\n"
-            f"URL: {p['url']}\n\n"
-            f"{p['text']}"
-        )
-    combined_text = '\n\n' + ('\n\n' + '─'*60 + '\n\n').join(combined_parts)
-
-    return {
-        'success': True,
-        'base_url': base_url,
-        'site_title': home['title'],
-        'pages_scraped': len(pages),
-        'pages': pages,
-        'combined_text': combined_text,
-        'total_chars': sum(p['text'].__len__() for p in pages),
-        'error': None,
-    }
+        return {'summary': result['text'], 'model': result['model']}
+    return _extractive_summary(text, error)
 
 
-def web_search(query: str, max_results: int = 6) -> list:
+async def asummarise_pages(pages, api_key=None, deadline=None) -> list:
     """
-    Search the web using DuckDuckGo HTML (no API key required).
-    Returns list of { title, url, snippet }
+    [{url, title, summary, model}] for [{url, title, text}] pages, in page
+    order, SUMMARY_CONCURRENCY tasks at a time with SUMMARY_MODEL, then
+    SUMMARY_FALLBACK_MODELS in turn. A page every model fails on is
+    represented by its opening (model None) instead.
     """
-    try:
-        params = {'q': query, 'kl': 'us-en', 'kp': '-1'}
-        resp = requests.get(
-            'https://html.duckduckgo.com/html/',
-            params=params, headers=_SCRAPE_HEADERS, timeout=10
-        )
-        resp.raise_for_status()
-        html = resp.text
-        results = []
-
-        blocks = re.findall(
-            r'<a[^>]+class="result__a"[^>]*href="([^"]+)"[^>]*>(.*?)</a>.*?'
-            r'<a[^>]+class="result__snippet"[^>]*>(.*?)</a>',
-            html, re.DOTALL
-        )
-        for url, title_html, snippet_html in blocks[:max_results]:
-            title = re.sub(r'<[^>]+>', '', title_html).strip()
-            snippet = re.sub(r'<[^>]+>', '', snippet_html).strip()
-            real_url_match = re.search(r'uddg=([^&]+)', url)
-            if real_url_match:
-                from urllib.parse import unquote
-                url = unquote(real_url_match.group(1))
-            if title and url.startswith('http'):
-                results.append({'title': title, 'url': url, 'snippet': snippet})
-
-        return results
-    except Exception as e:
-        print(f"Web search error: {e}")
-        return []
+    slots = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+
+    async def summarise(page):
+        async with slots:
+            return await _asummarise_page(_content_hash(page), page['title'], page['text'], api_key=api_key, deadline=deadline)
+
+    with deadline_step(deadline, 'summaries'):
+        results = await asyncio.gather(*(summarise(page) for page in pages))
+    return [{'url': p['url'], 'title': p['title'], **r} for p, r in zip(pages, results)]
+
 
 # ============================================================================
 # INTENT DETECTION
 # ============================================================================
 
-@DeepCopyLRUCache(capacity=500)
+_RESULT_CACHE_BYTES = int(os.getenv('PROMPTX_RESULT_CACHE_MB', 8)) * 1024 * 1024
+_intent_cache = FrozenLRUCache(max_bytes=_RESULT_CACHE_BYTES)
+_quality_cache = FrozenLRUCache(max_bytes=_RESULT_CACHE_BYTES)
+
+
+@_intent_cache
 def detect_intent(prompt):
     """Detect prompt intent"""
     keywords = {
@@ -457,7 +184,7 @@ def apply_smart_template(prompt, intent_data):
 # QUALITY ANALYZER
 # ============================================================================
 
-@DeepCopyLRUCache(capacity=500)
+@_quality_cache
 def analyze_quality_heatmap(prompt):
     """Analyze prompt quality"""
     length = len(prompt)
@@ -507,27 +234,17 @@ def analyze_quality_heatmap(prompt):
 # A/B TESTING
 # ============================================================================
 
-@DeepCopyLRUCache(capacity=500)
-def generate_ab_variations(prompt, preferred_model=None, api_key=None):
-    """Generate 3 variations with fallback concurrently to prevent Vercel Application Timeouts"""
-    
-    def fetch_variation(style_prompt, max_tokens, preferred_model=None, api_key=None):
-        result = generate_with_fallback(style_prompt, max_tokens, preferred_model=preferred_model, api_key=api_key)
-        return {'text': result['text'], 'length': len(result['text']), 'model': result['model']}
-
-    try:
-        from concurrent.futures import ThreadPoolExecutor
-        
-        # Prepare prompts
-        c_prompt = f"Make this prompt concise and direct (max 150 words) focusing only on core deliverables:\n{prompt}"
-        d_prompt = f"""Expand this prompt into a comprehensive, highly-detailed technical specification.
+def _ab_variation_prompts(prompt):
+    """(concise, detailed, structured) rewrite instructions for prompt."""
+    c_prompt = f"Make this prompt concise and direct (max 150 words) focusing only on core deliverables:\n{prompt}"
+    d_prompt = f"""Expand this prompt into a comprehensive, highly-detailed technical specification.
 You MUST include:
 1. Deep technical requirements and functional constraints.
 2. A system architecture or data flow breakdown.
 3. How different components and integrations will work together.
 4. Edge cases, performance considerations, and scalability.
 Make it as detailed and exhaustive as possible:\n{prompt}"""
-        s_prompt = f"""Rewrite this prompt using the advanced CREATE Prompt Engineering Algorithm.
+    s_prompt = f"""Rewrite this prompt using the advanced CREATE Prompt Engineering Algorithm.
 Structure the final output as a comprehensive, highly-organized technical document. It MUST include:
 1. **Context & Role**: Set the precise persona and background information.
 2. **Request**: The core task defined with unambiguous clarity.
@@ -542,42 +259,60 @@ Structure the final output as a comprehensive, highly-organized technical docume
 5. **Tone & Constraints**: Explicit boundaries, technologies, and styling rules.
 6. **Extras/Examples**: Include edge cases or output format specifications.
 Ensure the final output is exceptionally professional and visually structured using Markdown headers and bullet points. Here is the original prompt to enhance:\n{prompt}"""
+    return c_prompt, d_prompt, s_prompt
 
-        p_model = preferred_model
-        v1_model = p_model or 'gemini_flash'
-        v2_model = p_model or 'gemini_flash_8b'
-        v3_model = p_model or 'gemini_pro'
-
-        # Execute all 3 variations CONCURRENTLY
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            future_c = executor.submit(fetch_variation, c_prompt, 800, v1_model, api_key)
-            future_d = executor.submit(fetch_variation, d_prompt, 2048, v2_model, api_key)
-            future_s = executor.submit(fetch_variation, s_prompt, 2048, v3_model, api_key)
-            
-            concise = future_c.result()
-            detailed = future_d.result()
-            structured = future_s.result()
-        
+
+def _ab_fallback_variations(prompt):
+    return {
+        'concise': {'text': prompt, 'length': len(prompt), 'model': 'fallback'},
+        'detailed': {'text': prompt, 'length': len(prompt), 'model': 'fallback'},
+        'structured': {'text': prompt, 'length': len(prompt), 'model': 'fallback'}
+    }
+
+
+# Shared across workers. The local fallback variations are not worth keeping.
+_ab_cache = _response_store(
+    'ab_variations',
+    cacheable=lambda result: all(v.get('model') != 'fallback' for v in result.values()),
+)
+
+
+@_ab_cache
+async def agenerate_ab_variations(prompt, preferred_model=None, api_key=None, deadline=None):
+    """Generate 3 variations with fallback concurrently, as tasks on the running loop."""
+
+    async def fetch_variation(style_prompt, max_tokens, model):
+        result = await agenerate_with_fallback(style_prompt, max_tokens, preferred_model=model, api_key=api_key, deadline=deadline)
+        return {'text': result['text'], 'length': len(result['text']), 'model': result['model']}
+
+    try:
+        c_prompt, d_prompt, s_prompt = _ab_variation_prompts(prompt)
+        concise, detailed, structured = await asyncio.gather(
+            fetch_variation(c_prompt, 800, preferred_model or 'gemini_flash'),
+            fetch_variation(d_prompt, 2048, preferred_model or 'gemini_flash_8b'),
+            fetch_variation(s_prompt, 2048, preferred_model or 'gemini_pro'),
+        )
         return {
             'concise': concise,
             'detailed': detailed,
             'structured': structured
         }
-            
     except Exception as e:
         print(f"Variation generation failed: {e}")
-        return {
-            'concise': {'text': prompt, 'length': len(prompt), 'model': 'fallback'},
-            'detailed': {'text': prompt, 'length': len(prompt), 'model': 'fallback'},
-            'structured': {'text': prompt, 'length': len(prompt), 'model': 'fallback'}
-        }
+        return _ab_fallback_variations(prompt)
+
+
+def generate_ab_variations(prompt, preferred_model=None, api_key=None, deadline=None):
+    """Blocking agenerate_ab_variations, for sync callers."""
+    return run_on_worker_loop(agenerate_ab_variations(prompt, preferred_model, api_key, deadline))
 
 def compare_variations(original, variations):
     """Compare variations and recommend best"""
-    # Score each variation
-    for key in variations:
-        quality = analyze_quality_heatmap(variations[key]['text'])
-        variations[key]['quality'] = quality
+    # Score each variation (on copies: the caller's dicts may be cached)
+    variations = {
+        key: {**variation, 'quality': analyze_quality_heatmap(variation['text'])}
+        for key, variation in variations.items()
+    }
     
     # Find best
     best = max(variations.keys(), key=lambda k: variations[k]['quality']['overall'])
@@ -16,6 +16,8 @@ let currentMode = 'enhance';
 let selectedModel = 'auto';
 let currentChatId = null;
 let chatSessions = [];
+// Domain of the last site analysed in this chat: asking about it again is a follow-up
+let analysedSite = null;
 
 // ===== INIT =====
 document.addEventListener('DOMContentLoaded', () => {
@@ -431,6 +433,7 @@ function loadSession(sessionId) {
   
   currentChatId = sessionId;
   currentMode = session.mode || 'enhance';
+  analysedSite = null;
   
   // Update mode UI
   document.querySelectorAll('.mode-item').forEach(m => {
@@ -453,6 +456,7 @@ function loadSession(sessionId) {
 
 function startNewChat() {
   currentChatId = null;
+  analysedSite = null;
   localStorage.removeItem('promptx_current_chat'); // Clear saved chat ID
   const container = document.getElementById('chat-messages');
   container.innerHTML = `
@@ -638,6 +642,53 @@ function activateThinkingStep(thinkingDiv, stepIndex, status = 'active', preview
 }
 
 // ===== ENHANCE =====
+// POST to /enhance/stream and dispatch its Server-Sent Events. Resolves with
+// the same result object /enhance returns (from the trailing `done` event).
+async function streamEnhance(body, headers, { onStatus, onModel, onToken } = {}) {
+  const res = await fetch(`${API_BASE}/enhance/stream`, {
+    method: 'POST', headers, body: JSON.stringify(body)
+  });
+
+  // Validation / rate-limit errors come back as plain JSON
+  if (!(res.headers.get('Content-Type') || '').includes('text/event-stream')) {
+    return await res.json();
+  }
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let result = null;
+
+  const dispatch = (block) => {
+    let event = 'message';
+    let data = '';
+    for (const line of block.split('\n')) {
+      if (line.startsWith('event:')) event = line.slice(6).trim();
+      else if (line.startsWith('data:')) data += line.slice(5).trim();
+    }
+    if (!data) return;
+    const payload = JSON.parse(data);
+    if (event === 'status' && onStatus) onStatus(payload);
+    else if (event === 'model' && onModel) onModel(payload.model);
+    else if (event === 'token' && onToken) onToken(payload.text);
+    else if (event === 'done') result = payload;
+    else if (event === 'error') result = { success: false, ...payload };
+  };
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      dispatch(buffer.slice(0, boundary));
+      buffer = buffer.slice(boundary + 2);
+    }
+  }
+  if (buffer.trim()) dispatch(buffer);
+  return result || { success: false, error: 'The stream ended before a result arrived' };
+}
+
 async function handleEnhance(prompt) {
   const urls = extractUrls(prompt);
   const isUrlRequest = urls.length > 0;
@@ -651,7 +702,7 @@ async function handleEnhance(prompt) {
       `Crawling pages (features, pricing, docs, API...)`,
       `Searching web for tech stack & documentation`,
       `Synthesising deep analysis with AI`,
-    ]);
+    ], 'Waiting for the model…');
     activateThinkingStep(loadingMsg, 0);
   } else {
     loadingMsg = addLoadingMessage();
@@ -660,39 +711,50 @@ async function handleEnhance(prompt) {
   try {
     const body = { prompt };
     if (selectedModel !== 'auto') body.model = selectedModel;
+    if (isUrlRequest && getDomain(urls[0]) === analysedSite) body.follow_up = true;
 
     const apiKey = document.getElementById('api-key-input')?.value || '';
     const headers = { 'Content-Type': 'application/json' };
     if (apiKey) headers['X-API-Key'] = apiKey;
 
-    // Simulate step progression for URL requests (backend is synchronous)
-    let stepTimer;
-    if (isUrlRequest) {
-      let step = 0;
-      stepTimer = setInterval(() => {
-        step = Math.min(step + 1, 3);
-        activateThinkingStep(loadingMsg, step);
-      }, 4000);
-    }
-
     console.log('=== MAKING API CALL ===');
-    console.log('URL:', `${API_BASE}/enhance`);
+    console.log('URL:', `${API_BASE}/enhance/stream`);
     console.log('Body:', body);
     console.log('Headers:', headers);
 
-    const res = await fetch(`${API_BASE}/enhance`, {
-      method: 'POST', headers, body: JSON.stringify(body)
+    // Real progress from the server: status events drive the steps, tokens
+    // are shown as they arrive, and the scored result comes last
+    let streamed = '';
+    let streamEl = null;
+    const result = await streamEnhance(body, headers, {
+      onStatus: (status) => {
+        if (isUrlRequest) {
+          activateThinkingStep(loadingMsg, status.step);
+        } else {
+          loadingMsg.querySelector('.message-content').innerHTML =
+            `<div class="typing-dots"><span></span><span></span><span></span></div> <small style="opacity:0.7">${escapeHtml(status.message)}</small>`;
+        }
+      },
+      onToken: (text) => {
+        streamed += text;
+        if (isUrlRequest) {
+          activateThinkingStep(loadingMsg, 3, 'active', streamed.slice(-600));
+          return;
+        }
+        if (!streamEl) {
+          const content = loadingMsg.querySelector('.message-content');
+          content.innerHTML = '<div class="streaming-text" style="white-space:pre-wrap;line-height:1.75;"></div>';
+          streamEl = content.firstChild;
+        }
+        streamEl.textContent = streamed;
+        const container = document.getElementById('chat-messages');
+        container.scrollTop = container.scrollHeight;
+      },
     });
-    
-    console.log('=== RESPONSE RECEIVED ===');
-    console.log('Status:', res.status);
-    console.log('OK:', res.ok);
-    
-    const result = await res.json();
+
     console.log('=== PARSED RESULT ===');
     console.log('Result:', result);
 
-    if (stepTimer) clearInterval(stepTimer);
     loadingMsg.remove();
 
     if (result.success) {
@@ -708,6 +770,7 @@ async function handleEnhance(prompt) {
       if (result.type === 'url_analysis') {
         const url = result.url;
         const domain = getDomain(url);
+        analysedSite = domain;
         const favicon = getFaviconUrl(url);
         const pagesScraped = result.pages_scraped || 0;
         const totalChars = result.total_chars || result.char_count || 0;
@@ -113,6 +113,8 @@ FORCE_REINSTALL=false
 WATCH_LOGS=false
 HEALTH_CHECK=true
 DETACH=false
+PRELOAD="${PROMPTX_PRELOAD:-false}"
+ASGI="${PROMPTX_ASGI:-false}"
 
 # Internal state tracking
 declare -A CHECK_RESULTS=()
@@ -1333,6 +1335,8 @@ display_config() {
     printf "  $(c "${CYAN}")%-16s$(c "${NC}") $(c "${WHITE}")%s$(c "${NC}")\n"       "Log Level"   "${LOG_LEVEL}"
     printf "  $(c "${CYAN}")%-16s$(c "${NC}") $(c "${WHITE}")%ss$(c "${NC}")\n"      "Timeout"     "${TIMEOUT}"
     printf "  $(c "${CYAN}")%-16s$(c "${NC}") $(c "${WHITE}")%ss$(c "${NC}")\n"      "Keep-Alive"  "${KEEP_ALIVE}"
+    printf "  $(c "${CYAN}")%-16s$(c "${NC}") $(c "${WHITE}")%s$(c "${NC}")\n"       "Preload"     "${PRELOAD}"
+    printf "  $(c "${CYAN}")%-16s$(c "${NC}") $(c "${WHITE}")%s$(c "${NC}")\n"       "ASGI"        "${ASGI}"
     printf "  $(c "${CYAN}")%-16s$(c "${NC}") $(c "${DIM}")%s$(c "${NC}")\n"         "Log File"    "${LOG_FILE}"
 
     print_divider "dashed"
@@ -1585,6 +1589,52 @@ start_server() {
             # Block until server exits
             wait "$SERVER_PID" || true
             ;;
+
+        # ── Production / staging / testing (Gunicorn) ────────────────────
+        *)
+            echo -e "  $(c "${BRIGHT_GREEN}")$(c "${BOLD}") $(icon 🚀 [PROD]) Gunicorn$(c "${NC}")"
+            if [[ "$PRELOAD" == true ]]; then
+                echo -e "  $(c "${DIM}")Preloading models in master — workers share memory copy-on-write$(c "${NC}")"
+            fi
+            local app_module="promptx_project.wsgi:application"
+            if [[ "$ASGI" == true ]]; then
+                app_module="promptx_project.asgi:application"
+                echo -e "  $(c "${DIM}")ASGI: uvicorn workers, async provider calls$(c "${NC}")"
+            fi
+            echo
+            print_divider
+
+            display_server_banner "$HOST" "$PORT" "$ENVIRONMENT" "$WORKERS" "$lan_ip"
+
+            log_info "Gunicorn starting on ${HOST}:${PORT} (workers=${WORKERS}, preload=${PRELOAD}, asgi=${ASGI})"
+
+            cd "${SCRIPT_DIR}/backend"
+            HOST="$HOST" PORT="$PORT" WORKERS="$WORKERS" TIMEOUT="$TIMEOUT" \
+            KEEP_ALIVE="$KEEP_ALIVE" GRACEFUL_TIMEOUT="$GRACEFUL_TIMEOUT" \
+            MAX_REQUESTS="$MAX_REQUESTS" MAX_REQUESTS_JITTER="$MAX_REQUESTS_JITTER" \
+            LOG_LEVEL="$LOG_LEVEL" PROMPTX_PRELOAD="$PRELOAD" PROMPTX_ASGI="$ASGI" \
+            gunicorn -c gunicorn.conf.py \
+                --pid "$SERVER_PID_FILE" \
+                --access-logfile "$ACCESS_LOG" \
+                --error-logfile "$ERROR_LOG" \
+                "$app_module" &
+            SERVER_PID=$!
+            log_info "Gunicorn PID: ${SERVER_PID}"
+
+            if ! wait_for_server "$HOST" "$PORT" "$SERVER_START_TIMEOUT"; then
+                log_warn "Server health check failed or timed out; continuing to wait on server process"
+            fi
+
+            info "Per-worker memory: python backend/memory_report.py"
+
+            if [[ "$DETACH" == true ]]; then
+                success "Server detached in background (PID ${SERVER_PID})"
+                info "Use 'tail -f ${ERROR_LOG}' to watch logs."
+                return 0
+            fi
+
+            wait "$SERVER_PID" || true
+            ;;
     esac
 }
 
@@ -1608,6 +1658,8 @@ show_help() {
     _help_row "-w, --workers N"         "Gunicorn workers [1–${MAX_WORKERS}] (default: 4)"
     _help_row "--host HOST"             "Bind address (default: 0.0.0.0)"
     _help_row "--timeout SECS"          "Worker timeout (default: 120)"
+    _help_row "--preload"               "Load models in the master before fork (shared memory)"
+    _help_row "--asgi"                  "Serve the ASGI app with uvicorn workers (async views)"
     _help_row "--log-level LEVEL"       "debug|info|warning|error|critical"
     _help_row "--environment ENV"       "production|development|staging|testing"
 
@@ -1632,6 +1684,8 @@ show_help() {
     _env_row "ENVIRONMENT"   "Runtime environment"
     _env_row "LOG_LEVEL"     "Logging verbosity"
     _env_row "TIMEOUT"       "Worker timeout seconds"
+    _env_row "PROMPTX_PRELOAD" "Preload models before fork (true|false)"
+    _env_row "PROMPTX_ASGI"    "Use uvicorn workers and the ASGI app (true|false)"
 
     echo -e "\n$(c "${CYAN}")$(c "${BOLD}")Examples:$(c "${NC}")"
     echo -e "  $(c "${DIM}")# Production (default)$(c "${NC}")"
@@ -1700,6 +1754,10 @@ parse_args() {
                 CHECK_ONLY=true; shift ;;
             --detach)
                 DETACH=true; shift ;;
+            --preload)
+                PRELOAD=true; shift ;;
+            --asgi)
+                ASGI=true; shift ;;
             --no-color)
                 NO_COLOR=true; shift ;;
             --no-animation)
@@ -0,0 +1,1384 @@
+import os
+import sys
+import json
+import asyncio
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Update path to import from the backend directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../backend')))
+
+import caches
+import crawler
+import providers
+import services
+
+
+def isolate_caches(test):
+    """Point the SQLite stores at a temporary directory for one test."""
+    tmp = tempfile.TemporaryDirectory()
+    test.addCleanup(tmp.cleanup)
+    patchers = [
+        mock.patch.object(caches, '_near_index', caches.NearDuplicateIndex(
+            path=os.path.join(tmp.name, 'near_duplicates.sqlite3'), ttl=caches._near_index.ttl)),
+        # Replaced, not repointed, so fetches an abandoned crawl lands later stay in tmp
+        mock.patch.object(crawler, '_crawl_cache', crawler.CrawlCache(
+            path=os.path.join(tmp.name, 'crawl.sqlite3'),
+            snapshot_ttl=crawler.CRAWL_SNAPSHOT_TTL, index_ttl=crawler.SITE_INDEX_TTL)),
+    ]
+    # The response stores are bound into decorators at import, so patch those instances in place
+    for store in (providers._generation_cache, services._ab_cache, crawler._search_cache, services._summary_cache):
+        patchers.append(mock.patch.object(store, 'path', os.path.join(tmp.name, 'responses.sqlite3')))
+        patchers.append(mock.patch.object(store, '_local', threading.local()))
+    for patcher in patchers:
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+class ProviderClientPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.built = []
+
+        def factory(key):
+            client = object()
+            self.built.append(client)
+            return client
+
+        self.pool = providers.ProviderClientPool(capacity=2, idle_ttl=60, user_ttl=60)
+        self.pool.FACTORIES = {'groq': factory, 'gemini': factory}
+
+    def test_same_key_reuses_client(self):
+        first = self.pool.get('groq', 'key-a')
+        second = self.pool.get('groq', 'key-a')
+        self.assertIs(first, second)
+        self.assertEqual(len(self.built), 1)
+        self.assertEqual(self.pool.stats()['hits'], 1)
+
+    def test_keys_and_providers_are_isolated(self):
+        self.assertIsNot(self.pool.get('groq', 'key-a'), self.pool.get('groq', 'key-b'))
+        self.assertIsNot(self.pool.get('groq', 'key-a'), self.pool.get('gemini', 'key-a'))
+
+    def test_lru_capacity(self):
+        self.pool.get('groq', 'key-a')
+        self.pool.get('groq', 'key-b')
+        self.pool.get('groq', 'key-a')
+        self.pool.get('groq', 'key-c')  # evicts key-b, the least recently used
+        self.assertEqual(self.pool.stats()['size'], 2)
+        self.pool.get('groq', 'key-a')
+        self.assertEqual(len(self.built), 3)
+
+    def test_user_keys_expire_sooner(self):
+        self.pool.user_ttl = 0
+        self.pool.get('groq', 'user-key', user_supplied=True)
+        time.sleep(0.01)
+        self.pool.get('groq', 'user-key', user_supplied=True)
+        self.assertEqual(len(self.built), 2)
+
+    def test_raw_key_not_stored(self):
+        self.pool.get('groq', 'secret-key-value')
+        self.assertFalse(any('secret-key-value' in part for k in self.pool._clients for part in k))
+
+
+class ScriptedFallback(providers.AIModelFallback):
+    """AIModelFallback whose providers sleep/fail according to a script."""
+
+    def __init__(self, script):
+        super().__init__()
+        self.script = script
+        self.health = providers.ProviderHealth()
+        self.quota = providers.QuotaLedger()
+        self.calls = []
+
+    def _call_model(self, model_name, prompt, max_tokens, api_key=None):
+        self.calls.append(model_name)
+        delay, outcome = self.script.get(model_name, (0, Exception('not scripted')))
+        time.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class HedgingTests(unittest.TestCase):
+    def setUp(self):
+        self._delay = providers.HEDGE_DEFAULT_DELAY
+        providers.HEDGE_DEFAULT_DELAY = 0.05
+
+    def tearDown(self):
+        providers.HEDGE_DEFAULT_DELAY = self._delay
+
+    def test_slow_primary_is_hedged(self):
+        fallback = ScriptedFallback({
+            'gemini_flash': (0.5, 'slow answer'),
+            'gemini_flash_8b': (0.01, 'fast answer'),
+        })
+        fallback.hedge_enabled = True
+        result = fallback.generate('prompt')
+        self.assertEqual(result['model'], 'gemini_flash_8b')
+        self.assertTrue(result['hedge']['hedged'])
+        self.assertEqual(result['hedge']['abandoned'], ['gemini_flash'])
+        self.assertEqual(fallback.hedge_stats['hedge_wins'], 1)
+
+    def test_fast_primary_not_hedged(self):
+        fallback = ScriptedFallback({'gemini_flash': (0, 'answer')})
+        fallback.hedge_enabled = True
+        result = fallback.generate('prompt')
+        self.assertEqual(result['model'], 'gemini_flash')
+        self.assertFalse(result['hedge']['hedged'])
+        self.assertEqual(fallback.calls, ['gemini_flash'])
+
+    def test_failures_fall_through(self):
+        fallback = ScriptedFallback({'groq': (0, 'last resort')})
+        fallback.hedge_enabled = True
+        result = fallback.generate('prompt')
+        self.assertEqual(result['model'], 'groq')
+
+    def test_all_failed_raises(self):
+        fallback = ScriptedFallback({})
+        fallback.hedge_enabled = True
+        with self.assertRaises(Exception):
+            fallback.generate('prompt')
+
+    def test_early_timer_does_not_over_launch(self):
+        # A wait that times out before the deadline with nothing done must not launch past the queue or the cap
+        real_wait, real_await = providers.wait, asyncio.wait
+
+        def early_once():
+            fired = []
+
+            def wait(futures, timeout=None, return_when=None):
+                if not fired:
+                    fired.append(timeout)
+                    return set(), set(futures)
+                return real_wait(futures, timeout=timeout, return_when=return_when)
+            return wait
+
+        def aearly_once():
+            fired = []
+
+            async def wait(futures, timeout=None, return_when=None):
+                if not fired:
+                    fired.append(timeout)
+                    return set(), set(futures)
+                return await real_await(futures, timeout=timeout, return_when=return_when)
+            return wait
+
+        for chain in (['gemini_flash'], ['gemini_flash', 'groq']):
+            fallback = ScriptedFallback({'gemini_flash': (0.05, 'answer')})
+            with mock.patch.object(providers, 'wait', side_effect=early_once()), \
+                    mock.patch.object(providers, 'HEDGE_MAX_PARALLEL', 1):
+                result = fallback._generate_hedged(chain, 'prompt', 100, None, [], deadline=providers.Deadline(5))
+            self.assertEqual(result['model'], 'gemini_flash')
+            self.assertEqual(fallback.calls, ['gemini_flash'])
+
+            fallback = AsyncScriptedFallback({'gemini_flash': (0.05, 'answer')})
+            with mock.patch.object(providers.asyncio, 'wait', side_effect=aearly_once()), \
+                    mock.patch.object(providers, 'HEDGE_MAX_PARALLEL', 1):
+                result = asyncio.run(fallback._generate_hedged(chain, 'prompt', 100, None, [], deadline=providers.Deadline(5)))
+            self.assertEqual(result['model'], 'gemini_flash')
+            self.assertEqual(fallback.calls, ['gemini_flash'])
+
+class DeadlineTests(unittest.TestCase):
+    def setUp(self):
+        self._min_attempt = providers.DEADLINE_MIN_ATTEMPT
+        self._delay = providers.HEDGE_DEFAULT_DELAY
+        providers.DEADLINE_MIN_ATTEMPT = 0.1
+        providers.HEDGE_DEFAULT_DELAY = 0.05
+        isolate_caches(self)
+
+    def tearDown(self):
+        providers.DEADLINE_MIN_ATTEMPT = self._min_attempt
+        providers.HEDGE_DEFAULT_DELAY = self._delay
+
+    def test_children_share_the_report(self):
+        deadline = providers.Deadline(10)
+        child = deadline.within(0.5)
+        self.assertLessEqual(child.remaining(), 0.5)
+        with child.step('crawl'):
+            pass
+        child.skip('search', 'not enough time left')
+        report = deadline.report()
+        self.assertEqual(report['budget_ms'], 10000)
+        self.assertEqual(report['steps']['crawl']['calls'], 1)
+        self.assertEqual(report['skipped'][0]['step'], 'search')
+        self.assertLessEqual(deadline.within(60).seconds, 10)
+
+    def test_attempt_timeout_follows_deadline(self):
+        self.assertEqual(providers._provider_timeout(), providers.PROVIDER_TIMEOUT)
+        with providers._attempt(providers.Deadline(3)):
+            self.assertLessEqual(providers._provider_timeout(), 3)
+        self.assertEqual(providers._provider_timeout(), providers.PROVIDER_TIMEOUT)
+
+    def test_remaining_models_skipped_when_time_runs_out(self):
+        fallback = ScriptedFallback({'gemini_flash': (0.25, Exception('boom')), 'groq': (0, 'late')})
+        fallback.hedge_enabled = False
+        deadline = providers.Deadline(0.3)
+        with self.assertRaises(providers.DeadlineExceededError):
+            fallback.generate('prompt', deadline=deadline)
+        self.assertEqual(fallback.calls, ['gemini_flash'])
+        self.assertIn('generate:gemini_flash', deadline.report()['steps'])
+        self.assertIn('generate:groq', [s['step'] for s in deadline.report()['skipped']])
+
+    def test_hedged_race_stops_at_deadline(self):
+        fallback = ScriptedFallback({'gemini_flash': (1.0, 'too slow')})
+        fallback.hedge_enabled = True
+        started = time.monotonic()
+        with self.assertRaises(providers.DeadlineExceededError):
+            fallback.generate('prompt', deadline=providers.Deadline(0.3))
+        self.assertLess(time.monotonic() - started, 0.8)
+
+    def test_deadline_not_in_cache_key(self):
+        store = caches.ResponseStore('deadline-test', path=':memory:')
+        key = lambda d: store.make_key(providers.generate_with_fallback.__wrapped__, ('prompt',), {'deadline': d})
+        self.assertEqual(key(providers.Deadline(1)), key(None))
+
+    def test_scrape_skipped_without_time(self):
+        result = crawler.scrape_url('http://127.0.0.1:9/', deadline=providers.Deadline(0))
+        self.assertFalse(result['success'])
+        self.assertIn('budget', result['error'])
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.health = providers.ProviderHealth(failure_threshold=3, cooldown=0.05)
+
+    def _fail(self, name, times):
+        for _ in range(times):
+            self.health.record_failure(name, 1.0)
+
+    def test_opens_after_consecutive_failures(self):
+        self._fail('groq', 3)
+        self.assertFalse(self.health.acquire('groq'))
+        self.assertNotIn('groq', self.health.ordered(['gemini_flash', 'groq']))
+
+    def test_half_open_allows_single_probe(self):
+        self._fail('groq', 3)
+        time.sleep(0.06)
+        self.assertTrue(self.health.acquire('groq'))
+        self.assertFalse(self.health.acquire('groq'))
+        self.health.record_success('groq', 0.2)
+        self.assertEqual(self.health.snapshot()['groq']['state'], 'closed')
+        self.assertTrue(self.health.acquire('groq'))
+
+    def test_failed_probe_reopens(self):
+        self._fail('groq', 3)
+        time.sleep(0.06)
+        self.assertTrue(self.health.acquire('groq'))
+        self._fail('groq', 1)
+        self.assertFalse(self.health.acquire('groq'))
+
+    def test_unhealthy_provider_demoted(self):
+        for _ in range(5):
+            self.health.record_success('gemini_flash', 1.0)
+        self.health.record_failure('gemini_flash', 1.0)
+        self.health.record_failure('gemini_flash', 1.0)
+        order = self.health.ordered(['gemini_flash', 'gemini_flash_8b'])
+        self.assertEqual(order, ['gemini_flash_8b', 'gemini_flash'])
+
+    def test_open_circuit_skipped_in_generate(self):
+        fallback = ScriptedFallback({'gemini_flash': (0, 'answer'), 'gemini_flash_8b': (0, 'backup')})
+        fallback.health = self.health
+        self._fail('gemini_flash', 3)
+        result = fallback.generate('prompt')
+        self.assertEqual(result['model'], 'gemini_flash_8b')
+        self.assertNotIn('gemini_flash', fallback.calls)
+
+
+class QuotaTests(unittest.TestCase):
+    def test_classifies_429_with_retry_delay(self):
+        error = providers._classify_provider_error(
+            'gemini_flash', Exception("429 RESOURCE_EXHAUSTED {'retryDelay': '37s'}"))
+        self.assertIsInstance(error, providers.QuotaExceededError)
+        self.assertEqual(error.retry_after, 37.0)
+
+    def test_classifies_http_status(self):
+        response = requests.Response()
+        response.status_code = 503
+        error = providers._classify_provider_error('groq', requests.exceptions.HTTPError(response=response))
+        self.assertIsInstance(error, providers.ProviderUnavailableError)
+        response.status_code = 429
+        response.headers['Retry-After'] = '12'
+        error = providers._classify_provider_error('groq', requests.exceptions.HTTPError(response=response))
+        self.assertIsInstance(error, providers.QuotaExceededError)
+        self.assertEqual(error.retry_after, 12.0)
+
+    def test_ledger_expires(self):
+        ledger = providers.QuotaLedger()
+        ledger.mark_exhausted('groq', 'key-a', retry_after=0.05)
+        self.assertIsNotNone(ledger.exhausted_until('groq', 'key-a'))
+        self.assertIsNone(ledger.exhausted_until('groq', 'key-b'))
+        time.sleep(0.06)
+        self.assertIsNone(ledger.exhausted_until('groq', 'key-a'))
+
+    def test_daily_boundary_only_for_daily_quotas(self):
+        reset_at = providers.QuotaLedger().mark_exhausted('groq', 'key-a')
+        self.assertAlmostEqual(reset_at - time.time(), providers.QUOTA_RETRY_DEFAULT, delta=1)
+        error = providers._classify_provider_error('gemini_flash', Exception(
+            "429 RESOURCE_EXHAUSTED {'quotaId': 'GenerateRequestsPerDayPerProjectPerModel-FreeTier'}"))
+        self.assertTrue(providers.QUOTA_RETRY_DEFAULT < error.retry_after <= 86400)
+        error = providers._classify_provider_error('gemini_flash', Exception(
+            "429 RESOURCE_EXHAUSTED {'quotaId': 'GenerateRequestsPerMinutePerProjectPerModel-FreeTier'}"))
+        self.assertIsNone(error.retry_after)
+
+    def test_exhausted_message_follows_the_ledger(self):
+        models = [m['name'] for m in providers.AIModelFallback().models]
+        per_minute = ScriptedFallback({name: (0, Exception('429 rate limit exceeded')) for name in models})
+        with self.assertRaises(providers.QuotaExceededError) as ctx:
+            per_minute.generate('prompt')
+        self.assertIn('RATE LIMITED', str(ctx.exception))
+        self.assertNotIn('tomorrow', str(ctx.exception))
+        self.assertAlmostEqual(ctx.exception.retry_after, providers.QUOTA_RETRY_DEFAULT, delta=2)
+
+        daily = Exception("429 RESOURCE_EXHAUSTED {'quotaId': 'GenerateRequestsPerDayPerProjectPerModel-FreeTier'}")
+        per_day = ScriptedFallback({name: (0, daily) for name in models})
+        with self.assertRaises(providers.QuotaExceededError) as ctx:
+            per_day.generate('prompt')
+        if ctx.exception.retry_after >= providers.QUOTA_SHORT_WAIT:  # not within an hour of the reset
+            self.assertIn('out of quota until', str(ctx.exception))
+        # The ledger now answers without calling anyone, with the same reset
+        with self.assertRaises(providers.QuotaExceededError) as again:
+            per_day.generate('prompt')
+        self.assertEqual(len(per_day.calls), len(models))
+        self.assertAlmostEqual(again.exception.retry_after, ctx.exception.retry_after, delta=2)
+
+    def test_only_real_quota_and_config_errors_are_classified_as_such(self):
+        classify = providers._classify_provider_error
+        self.assertNotIsInstance(classify('groq', json.JSONDecodeError('Expecting value', '<html>', 0)),
+                                 providers.ProviderConfigError)
+        self.assertNotIsInstance(classify('groq', ValueError('bad response')), providers.ProviderConfigError)
+        self.assertNotIsInstance(classify('groq', Exception('500 error while checking quota usage')),
+                                 providers.QuotaExceededError)
+        self.assertIsInstance(classify('groq', Exception('Rate limit exceeded')), providers.QuotaExceededError)
+        with mock.patch.dict(os.environ, {'GROQ_API_KEY': ''}):
+            with self.assertRaises(providers.ProviderConfigError):
+                providers.AIModelFallback()._provider_client('groq', None)
+
+    def test_exhausted_provider_skipped_until_reset(self):
+        fallback = ScriptedFallback({
+            'gemini_flash': (0, Exception('429 quota exceeded')),
+            'gemini_flash_8b': (0, 'backup'),
+        })
+        self.assertEqual(fallback.generate('prompt')['model'], 'gemini_flash_8b')
+        self.assertEqual(fallback.generate('prompt')['model'], 'gemini_flash_8b')
+        self.assertEqual(fallback.calls.count('gemini_flash'), 1)
+        # Quota is not a health failure
+        self.assertEqual(fallback.health.snapshot()['gemini_flash']['consecutive_failures'], 0)
+
+    def test_all_exhausted_raises_quota_error(self):
+        quota = Exception('429 RESOURCE_EXHAUSTED')
+        fallback = ScriptedFallback({name: (0, quota) for name in
+                                     ('gemini_flash', 'gemini_flash_8b', 'gemini_pro', 'nvidia_minimax', 'groq')})
+        with self.assertRaises(providers.QuotaExceededError):
+            fallback.generate('prompt')
+        with self.assertRaises(providers.QuotaExceededError):
+            fallback.generate('prompt', preferred_model='groq')
+        self.assertEqual(len(fallback.calls), 5)
+
+
+class LocalGeminiPool(providers.ProviderClientPool):
+    FACTORIES = {'gemini': lambda key: providers.LocalGeminiClient()}
+
+
+class AsyncLocalGeminiPool(providers.ProviderClientPool):
+    FACTORIES = {'gemini': lambda key: providers.LocalGeminiClient().aio}
+
+
+class PrefixCacheTests(unittest.TestCase):
+    PREFIX = 'You are an elite prompt engineer. ' * 40
+
+    def setUp(self):
+        self.min_tokens = providers.GEMINI_CACHE_MIN_TOKENS
+        providers.GEMINI_CACHE_MIN_TOKENS = 50
+        self.fallback = providers.AIModelFallback()
+        self.fallback.prefixes = providers.PrefixCache()
+        self.fallback.prefixes.register('master', self.PREFIX)
+        pool = LocalGeminiPool()
+        self.fallback._pool = lambda: pool
+
+    def tearDown(self):
+        providers.GEMINI_CACHE_MIN_TOKENS = self.min_tokens
+
+    def test_chat_messages_keep_prefix_byte_stable(self):
+        messages = self.fallback._split_prompt(self.PREFIX + '\n\nCategory detected: CODE\n\nUser prompt to enhance:\nsort a list')
+        self.assertEqual(messages[0], {'role': 'system', 'content': self.PREFIX})
+        self.assertTrue(messages[1]['content'].startswith('Category detected'))
+        fitted = providers.fit_messages('nvidia_minimax', [messages[0], {'role': 'user', 'content': 'x ' * 5000}], 500)
+        self.assertEqual(fitted[0]['content'], self.PREFIX)
+
+    def test_gemini_handle_created_once_and_tokens_saved(self):
+        for question in ('first question', 'second question'):
+            text = self.fallback._call_gemini(self.PREFIX + '\n\n' + question, 'gemini_flash', 500, api_key='k')
+            self.assertIn(question, text)
+        stats = self.fallback.prefixes.snapshot()['providers']['gemini']
+        self.assertEqual(stats['handles_created'], 1)
+        self.assertEqual(stats['prefixed_requests'], 2)
+        self.assertEqual(stats['input_tokens_saved'], 2 * providers.count_tokens(self.PREFIX))
+
+    def test_small_prefix_falls_back_to_system_instruction(self):
+        providers.GEMINI_CACHE_MIN_TOKENS = 10_000
+        client, kwargs, name = self.fallback._gemini_request(self.PREFIX + '\n\nq', 'gemini_flash', 500, 'k')
+        self.assertEqual(name, 'master')
+        self.assertEqual(kwargs['config']['system_instruction'], self.PREFIX)
+        self.assertEqual(kwargs['contents'], 'q')
+        self.assertEqual(self.fallback.prefixes.snapshot()['providers']['gemini']['handles_unavailable'], 1)
+
+    def test_unprefixed_prompt_untouched(self):
+        client, kwargs, name = self.fallback._gemini_request('plain prompt', 'gemini_flash', 500, 'k')
+        self.assertIsNone(name)
+        self.assertEqual(kwargs['contents'], 'plain prompt')
+        self.assertNotIn('system_instruction', kwargs['config'])
+
+
+class CrawlerTests(unittest.TestCase):
+    """scrape_website_deep against a local site with robots.txt, a sitemap index and slow pages."""
+
+    PAGES = {
+        '/': '<title>Home</title><a href="/a">a</a><a href="/b">b</a><a href="/c">c</a><p>home</p>',
+        '/a': '<title>A</title><p>{words}</p>',
+        '/b': '<title>B</title><link rel="canonical" href="/a"><p>{words}</p>',
+        '/c': '<title>C</title><p>{words}</p>',
+        '/pricing': '<title>Pricing</title><p>{words}</p>',
+        '/docs/api': '<title>API</title><p>{words}</p>',
+        '/features': '<title>Features</title><p>{words}</p>',
+        '/blog/2019/old-post': '<title>Post</title><p>{words}</p>',
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        requested = cls.requested = []
+        not_modified = cls.not_modified = []
+        pages = cls.PAGES
+
+        class Site(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, body, content_type='text/html', etag=None):
+                data = body if isinstance(body, bytes) else body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                if etag:
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                requested.append(self.path)
+                root = f'http://{self.headers["Host"]}'
+                if self.path == '/robots.txt':
+                    return self.reply(f'User-agent: *\nDisallow: /c\nSitemap: {root}/sitemap_index.xml\n', 'text/plain')
+                if self.path == '/sitemap_index.xml':
+                    return self.reply(
+                        '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+                        f'<sitemap><loc>{root}/post-sitemap.xml</loc></sitemap>'
+                        f'<sitemap><loc>{root}/page-sitemap.xml.gz</loc></sitemap></sitemapindex>', 'application/xml')
+                if self.path == '/page-sitemap.xml.gz':
+                    import gzip
+                    urls = ''.join(f'<url><loc>{root}{p}</loc></url>' for p in ('/pricing', '/docs/api', '/features', '/login'))
+                    return self.reply(gzip.compress(
+                        f'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{urls}</urlset>'.encode()),
+                        'application/x-gzip')
+                if self.path == '/post-sitemap.xml':
+                    return self.reply(
+                        f'<urlset><url><loc>{root}/blog/2019/old-post</loc></url></urlset>', 'application/xml')
+                if self.path == '/big':
+                    # An endless page, for the early stop
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/html; charset=utf-8')
+                    self.end_headers()
+                    try:
+                        for _ in range(200):
+                            self.wfile.write(b'<p>' + b'caf\xc3\xa9 ' * 4000 + b'</p>')
+                            time.sleep(0.05)
+                    except OSError:
+                        pass
+                    return
+                if self.path == '/report.pdf':
+                    return self.reply(b'%PDF-1.4', 'application/pdf')
+                if self.path in pages:
+                    etag = f'"{len(self.path)}"'
+                    if self.headers.get('If-None-Match') == etag:
+                        not_modified.append(self.path)
+                        self.send_response(304)
+                        self.end_headers()
+                        return
+                    if self.path != '/':
+                        time.sleep(0.2)
+                    words = ' '.join(f'{self.path} word{i}' for i in range(60))
+                    return self.reply(pages[self.path].format(words=words), etag=etag)
+                self.send_error(404)
+
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Site)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f'http://127.0.0.1:{cls.server.server_port}/'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        del self.requested[:]
+        del self.not_modified[:]
+        isolate_caches(self)
+
+    def test_frontier_from_sitemap_and_robots(self):
+        started = time.monotonic()
+        crawl = crawler.scrape_website_deep(self.base, max_pages=5)
+        # Four 0.2s pages one at a time would take 0.8s
+        self.assertLess(time.monotonic() - started, 0.7)
+        self.assertEqual(
+            [p['url'].replace(self.base, '/') for p in crawl['pages']],
+            ['/', '/docs/api', '/pricing', '/features', '/a'],
+        )
+        self.assertEqual(crawl['frontier']['source'], 'sitemap')
+        self.assertEqual(crawl['frontier']['robots_blocked'], 1)
+        self.assertNotIn('/c', self.requested)
+        self.assertNotIn('/login', self.requested)
+        self.assertNotIn('/about', self.requested)  # no blind probing
+
+    def test_canonical_duplicates_dropped(self):
+        crawl = crawler.scrape_website_deep(self.base, max_pages=8)
+        urls = [p['url'].replace(self.base, '/') for p in crawl['pages']]
+        self.assertIn('/a', urls)
+        self.assertNotIn('/b', urls)
+
+    def test_sync_wrapper_shares_the_snapshot(self):
+        crawl = asyncio.run(crawler.ascrape_website_deep(self.base, max_pages=4))
+        again = crawler.scrape_website_deep(self.base, max_pages=4)
+        self.assertEqual(again['cache']['snapshot'], 'hit')
+        self.assertEqual(again['pages'], crawl['pages'])
+
+    def test_site_snapshot_and_conditional_revalidation(self):
+        first = crawler.scrape_website_deep(self.base, max_pages=3)
+        self.assertEqual(first['cache']['snapshot'], 'miss')
+        self.assertGreaterEqual(first['cache']['fetched'], 3)
+
+        with mock.patch.object(crawler, '_ascrape_website_deep', side_effect=AssertionError('crawled')):
+            snapshot = crawler.scrape_website_deep(self.base, max_pages=3)
+        self.assertEqual(snapshot['cache']['snapshot'], 'hit')
+        self.assertEqual(snapshot['pages'], first['pages'])
+
+        refreshed = crawler.scrape_website_deep(self.base, max_pages=3, force_refresh=True)
+        self.assertEqual(refreshed['cache']['snapshot'], 'refresh')
+        self.assertEqual(refreshed['cache']['fetched'], 0)
+        self.assertGreaterEqual(refreshed['cache']['revalidated'], 3)
+        self.assertIn('/', self.not_modified)
+        self.assertEqual(refreshed['pages'], first['pages'])
+        self.assertEqual(crawler._crawl_cache.stats()['snapshot_hits'], 1)
+
+    def test_partial_crawl_not_snapshotted(self):
+        crawler.scrape_website_deep(self.base, max_pages=8, deadline=providers.Deadline(1.15))
+        crawl = crawler.scrape_website_deep(self.base, max_pages=8)
+        self.assertEqual(crawl['cache']['snapshot'], 'miss')
+
+    def test_follow_up_served_from_site_index(self):
+        self.assertIsNone(crawler.site_index(self.base))
+        first = crawler.scrape_website_deep(self.base, max_pages=3)
+
+        with mock.patch.object(crawler, 'ascrape_url', side_effect=AssertionError('fetched')):
+            site = crawler.site_index(self.base)
+        self.assertEqual(site['cache']['snapshot'], 'index')
+        self.assertNotIn('combined_text', site)
+        self.assertEqual(site['pages'], [{'url': p['url'], 'title': p['title']} for p in first['pages']])
+        self.assertEqual(site['index'], first['index'])
+
+        index = crawler.SiteIndex(site['index'])
+        best = index.chunks[index.ranked('pricing plans')[0]]
+        self.assertEqual(index.pages[best['page']]['title'], 'Pricing')
+        packed = index.pack('pricing plans', 120)
+        self.assertIn('=== PAGE: Pricing ===', packed)
+        self.assertLessEqual(providers.count_tokens(packed), 120)
+
+    def test_crawl_budget_cuts_the_crawl_short(self):
+        deadline = providers.Deadline(1.15)
+        crawl = crawler.scrape_website_deep(self.base, max_pages=8, deadline=deadline)
+        self.assertTrue(crawl['success'])
+        self.assertLess(crawl['pages_scraped'], 7)
+        self.assertEqual(deadline.report()['skipped'][-1]['step'], 'crawl')
+
+    def test_streaming_fetch_stops_early(self):
+        started = time.monotonic()
+        page = crawler.scrape_url(self.base + 'big', max_chars=4000)
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertTrue(page['text'].startswith('café café'))
+        self.assertTrue(page['text'].endswith('[truncated at 4000 chars]'))
+        page = asyncio.run(crawler.ascrape_url(self.base + 'big', max_chars=4000))
+        self.assertTrue(page['text'].endswith('[truncated at 4000 chars]'))
+
+    def test_non_html_rejected(self):
+        page = crawler.scrape_url(self.base + 'report.pdf')
+        self.assertFalse(page['success'])
+        self.assertEqual(page['error'], 'Not an HTML page (application/pdf)')
+
+    def test_text_extractor_fed_in_pieces(self):
+        html = ('<html><head><title>Caf&eacute; &amp; Co</title><style>p{}</style>'
+                '<link href="/menu/" rel="Canonical"></head><body>'
+                '<nav><a href="/x">Menu</a></nav><h1>Fish&nbsp;&#38;   chips</h1>'
+                '<script>var a = "<p>no</p>";</script><p>Open <b>daily</b> <a href="hours#today">hours</a></p>'
+                '<a href="https://other.com/"></a><a href="/x?utm=1"></a><a href="/menu.pdf"></a>'
+                '<footer><a href=/x>(c)</a></footer></body></html>')
+        extractor = crawler._TextExtractor()
+        for i in range(0, len(html), 5):
+            extractor.feed(html[i:i + 5])
+        extractor.close()
+        self.assertEqual(extractor.title(), 'Café & Co')
+        self.assertEqual(extractor.text(), 'Fish & chips\nOpen daily hours')
+        self.assertEqual(extractor.links('https://fish.com/menu/'), ['https://fish.com/x', 'https://fish.com/menu/hours'])
+        self.assertEqual(extractor.canonical('https://fish.com/menu/?a=1'), 'https://fish.com/menu/')
+        self.assertEqual(crawler._clean_html(html, 10), ('Café & Co', 'Fish & chi\n[truncated at 10 chars]'))
+
+    def test_tokeniser_matches_html_parser(self):
+        pages = [
+            '<p>a < b</p><p>after</p>', '<p title="x>y">quoted</p><p>after &amp; more</p>',
+            "<img alt=don't>text<p>after</p>", '<!-- <p>hidden</p> --><p>shown</p><!-- unclosed',
+            '<![CDATA[ x ]]><p>cdata</p>', '<SCRIPT>if (a<b) {}</SCRIPT ><P>Upper</P>', '<script>open <p>x</p>',
+            '<br/><p>x<br/>y</p><A HREF=/u>u</A><link rel=canonical href="/c?a=1&amp;b=2">',
+            '<?xml version="1.0"?><!DOCTYPE html><title>T &amp; t</title><nav>n<main>m &copy</main>',
+        ]
+
+        def extract(html, piece, tokenise=True):
+            extractor = crawler._TextExtractor()
+            if not tokenise:
+                extractor._pending = None
+            for i in range(0, len(html), piece):
+                extractor.feed(html[i:i + piece])
+            extractor.close()
+            url = 'https://acme.test/p/'
+            return extractor.title(), extractor.text(), extractor.links(url), extractor.canonical(url)
+
+        for html in pages:
+            for piece in (3, 7, len(html)):
+                self.assertEqual(extract(html, piece), extract(html, len(html), tokenise=False), (html, piece))
+
+    def test_unclosed_noise_tags_keep_the_page(self):
+        html = "<title>T</title><nav><a href='/x'>Home</a><main><h1>Pricing</h1><p>Pro plan $29</p></main>"
+        self.assertEqual(crawler._clean_html(html), ('T', 'Home\nPricing\nPro plan $29'))
+        html = ('<body><header>Brand<nav>Menu</header><p>Intro</p><header><h1>Docs</h1>'
+                '<script>var a = 1;</script><p>Install with pip.</p></body>')
+        self.assertEqual(crawler._clean_html(html), ('', 'Intro\nDocs\nInstall with pip.'))
+
+    def test_dedupe_boilerplate_and_duplicate_pages(self):
+        banner, footer = 'We use cookies to improve your experience.', '© 2024 Acme Inc. All rights reserved.'
+        pages = [
+            {'url': f'https://acme.test/{name}', 'title': name,
+             'text': '\n'.join([banner, *body, footer.replace('2024', year)])}
+            for name, year, body in [
+                ('', '2024', ['Acme builds rockets.', 'Plans start at $10.']),
+                ('pricing', '2025', ['Plans start at $10.', 'Enterprise plans are custom.']),
+                ('docs', '2024', ['The REST API uses JSON.', 'Authenticate with a bearer token.']),
+                ('docs/v2', '2024', ['The REST API uses JSON.', 'Authenticate with a bearer token!']),
+            ]
+        ]
+        deduped, report = crawler._dedupe_pages(pages)
+        self.assertEqual([p['text'] for p in deduped], [
+            'Acme builds rockets.\nPlans start at $10.',
+            'Enterprise plans are custom.',
+            'The REST API uses JSON.\nAuthenticate with a bearer token.',
+        ])
+        self.assertEqual(report['duplicate_pages'], [{'url': 'https://acme.test/docs/v2', 'duplicate_of': 'https://acme.test/docs'}])
+        self.assertEqual((report['boilerplate_blocks'], report['repeated_blocks']), (6, 1))
+        self.assertGreater(report['chars_removed'], 200)
+        self.assertGreater(report['tokens_removed'], 0)
+
+    def test_dedupe_keeps_repeats_within_a_page(self):
+        pricing = '\n'.join(['Pricing', 'Starter', '$10 a month', 'Projects', '3',
+                              'Support is included on every plan.', 'Team', '$30 a month', 'Projects', 'Unlimited',
+                              'Support is included on every plan.'])
+        pages = [
+            {'url': 'https://acme.test/pricing', 'title': 'Pricing', 'text': pricing},
+            {'url': 'https://acme.test/enterprise', 'title': 'Enterprise',
+             'text': 'Enterprise\nProjects\nUnlimited\nSupport is included on every plan.\nSSO and audit logs.'},
+            {'url': 'https://acme.test/about', 'title': 'About', 'text': 'Acme builds rockets for small teams.'},
+        ]
+        deduped, report = crawler._dedupe_pages(pages)
+        self.assertEqual(deduped[0]['text'], pricing)
+        self.assertEqual(deduped[1]['text'], 'Enterprise\nProjects\nUnlimited\nSSO and audit logs.')
+        self.assertEqual((report['boilerplate_blocks'], report['repeated_blocks']), (0, 1))
+
+    def test_site_index_ranks_and_packs_chunks(self):
+        pages = [
+            {'url': 'https://acme.test/', 'title': 'Acme', 'text': 'Acme builds rockets for small teams.\n' * 40},
+            {'url': 'https://acme.test/pricing', 'title': 'Pricing',
+             'text': 'Plans start at $10 a month.\nEnterprise plans include SSO and an SLA.'},
+            {'url': 'https://acme.test/docs', 'title': 'Docs',
+             'text': 'The REST API uses JSON.\nAuthenticate with a bearer token.'},
+        ]
+        index = crawler.SiteIndex.build(pages)
+        self.assertGreater(len(index.chunks), 2)  # the long homepage is split
+        self.assertTrue(all(len(c['text']) <= 2 * crawler.SITE_INDEX_CHUNK_CHARS for c in index.chunks))
+
+        ranked = index.ranked('How do I authenticate with the API?')
+        self.assertEqual(index.pages[index.chunks[ranked[0]]['page']]['title'], 'Docs')
+        # Unmatched chunks follow in coverage order: every page's first chunk before any second one
+        vague = [index.chunks[i]['page'] for i in index.ranked('tell me everything')[:3]]
+        self.assertEqual(sorted(vague), [0, 1, 2])
+
+        packed = index.pack('enterprise SSO', 60)
+        self.assertLessEqual(providers.count_tokens(packed), 60)
+        self.assertIn('Enterprise plans include SSO', packed)
+        self.assertNotIn('rockets', packed)
+        everything = index.pack('enterprise SSO', 10000)
+        self.assertLess(everything.index('Acme builds'), everything.index('Plans start'))  # page order kept
+
+    def test_canonical_url_and_scores(self):
+        canonical = crawler._canonical_url
+        self.assertEqual(canonical('HTTPS://www.Example.com:443/Docs/?utm_source=x&b=2&a=1#top'),
+                         'https://example.com/Docs?a=1&b=2')
+        self.assertEqual(canonical('https://example.com/index.html'), canonical('https://example.com'))
+        score = crawler._frontier_score
+        self.assertGreater(score(canonical('https://x.com/pricing'), False), score(canonical('https://x.com/blog'), False))
+        self.assertLess(score(canonical('https://x.com/login'), True), 0)
+        self.assertLess(score(canonical('https://x.com/fr/pricing'), True), 0)
+
+    def test_sitemap_reader_streams_gzip(self):
+        import gzip
+        body = gzip.compress(b'<urlset>' + b''.join(b'<url><loc>https://x.com/%d</loc></url>' % i for i in range(100)) + b'</urlset>')
+        reader = crawler._SitemapReader()
+        for i in range(0, len(body), 7):
+            reader.feed(body[i:i + 7])
+        self.assertEqual(len(reader.locs), 100)
+        self.assertFalse(reader.is_index)
+
+
+class SearchTests(unittest.TestCase):
+    """web_search against a local DuckDuckGo-shaped results page."""
+
+    @classmethod
+    def setUpClass(cls):
+        from urllib.parse import urlparse, parse_qs
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        queries = cls.queries = []
+
+        class Results(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)['q'][0]
+                queries.append(query)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.end_headers()
+                time.sleep(0.3)
+                try:
+                    for i in range(3):
+                        self.wfile.write((
+                            f'<div class="result"><h2><a rel="nofollow" class="result__a" '
+                            f'href="//duckduckgo.com/l/?uddg=https%3A%2F%2Fsite{i}.test%2F&amp;rut=x">Site <b>{i}</b> &amp; co</a></h2>'
+                            f'<a class="result__snippet" href="#">About {query}, <b>part</b> {i}</a></div>'
+                        ).encode())
+                    self.wfile.flush()
+                    time.sleep(2)  # the rest of the page, never needed
+                    self.wfile.write(b'<div class="result">late</div>')
+                except OSError:
+                    pass
+
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Results)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.patcher = mock.patch.object(crawler, 'SEARCH_URL', f'http://127.0.0.1:{cls.server.server_port}/html/')
+        cls.patcher.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.patcher.stop()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        del self.queries[:]
+        isolate_caches(self)
+
+    def test_streamed_results_stop_early_and_are_cached(self):
+        started = time.monotonic()
+        results = crawler.web_search('Acme', max_results=2)
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(results, [
+            {'title': 'Site 0 & co', 'url': 'https://site0.test/', 'snippet': 'About acme, part 0'},
+            {'title': 'Site 1 & co', 'url': 'https://site1.test/', 'snippet': 'About acme, part 1'},
+        ])
+        again = asyncio.run(crawler.aweb_search('  ACME    ', max_results=2))
+        self.assertEqual(again, results)
+        self.assertEqual(self.queries, ['acme'])
+
+    def test_fan_out_runs_concurrently(self):
+        queries = ['a', 'b', 'c']
+        started = time.monotonic()
+        results = asyncio.run(crawler.aweb_search_many(queries, max_results=1))
+        # Three 0.3s searches one after another would take 0.9s
+        self.assertLess(time.monotonic() - started, 0.8)
+        self.assertEqual([r[0]['snippet'] for r in results], [f'About {q}, part 0' for q in queries])
+
+
+class PageSummaryTests(unittest.TestCase):
+    """asummarise_pages, the map step of map-reduce synthesis, with the provider calls faked."""
+
+    def setUp(self):
+        isolate_caches(self)
+        self.calls = []
+        self.fail = False
+        self.unconfigured = set()
+
+        async def generate(prompt, max_tokens, preferred_model=None, api_key=None, deadline=None):
+            self.calls.append(preferred_model)
+            if preferred_model in self.unconfigured:
+                raise providers.ProviderConfigError('GEMINI_API_KEY not found', model=preferred_model)
+            await asyncio.sleep(0.2)
+            if self.fail:
+                raise providers.ProviderUnavailableError('down', model=preferred_model)
+            return {'text': '- ' + prompt.rsplit('\n', 1)[-1][:20], 'model': preferred_model, 'success': True}
+
+        patcher = mock.patch.object(providers._async_fallback, 'generate', generate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pages(self, prefix='https://acme.test'):
+        return [{'url': f'{prefix}/{i}', 'title': f'Page {i}', 'text': f'Page {i} text'} for i in range(3)]
+
+    def test_pages_summarised_concurrently_and_cached_by_content(self):
+        started = time.monotonic()
+        summaries = asyncio.run(services.asummarise_pages(self.pages()))
+        # Three 0.2s summaries one after another would take 0.6s
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual([s['summary'] for s in summaries], [f'- Page {i} text' for i in range(3)])
+        self.assertEqual(self.calls, [services.SUMMARY_MODEL] * 3)
+
+        # Same content at other URLs: no new model calls
+        again = asyncio.run(services.asummarise_pages(self.pages('https://mirror.test')))
+        self.assertEqual([s['summary'] for s in again], [s['summary'] for s in summaries])
+        self.assertEqual(again[0]['url'], 'https://mirror.test/0')
+        self.assertEqual(len(self.calls), 3)
+
+    def test_failed_summary_falls_back_to_page_text_uncached(self):
+        self.fail = True
+        summaries = asyncio.run(services.asummarise_pages(self.pages()[:1]))
+        self.assertEqual(summaries[0], {'url': 'https://acme.test/0', 'title': 'Page 0',
+                                        'summary': 'Page 0 text', 'model': None})
+        self.assertEqual(self.calls, services._summary_models())
+        self.fail = False
+        self.assertIsNotNone(asyncio.run(services.asummarise_pages(self.pages()[:1]))[0]['model'])
+        self.assertEqual(len(self.calls), len(services._summary_models()) + 1)
+
+    def test_summary_model_without_key_falls_back_cheapest_first(self):
+        self.unconfigured = {services.SUMMARY_MODEL}
+        summaries = asyncio.run(services.asummarise_pages(self.pages()[:1]))
+        self.assertEqual(summaries[0]['model'], services.SUMMARY_FALLBACK_MODELS[0])
+        self.assertEqual(self.calls, [services.SUMMARY_MODEL, services.SUMMARY_FALLBACK_MODELS[0]])
+
+
+class SimulatorTests(unittest.TestCase):
+    """AIModelFallback against provider_simulator.py over real HTTP."""
+
+    @classmethod
+    def setUpClass(cls):
+        from provider_simulator import make_server
+        cls.server = make_server('127.0.0.1', 0)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        base = f'http://127.0.0.1:{cls.server.server_port}'
+        cls.patches = [
+            mock.patch.object(providers, '_GROQ_CHAT_URL', f'{base}/groq/openai/v1/chat/completions'),
+            mock.patch.object(providers, '_GEMINI_BASE_URL', f'{base}/gemini'),
+            mock.patch.object(providers, 'PROVIDER_TIMEOUT', 0.5),
+            mock.patch.dict(os.environ, {'PROMPTX_GEMINI_BACKEND': 'google'}),
+        ]
+        for patch in cls.patches:
+            patch.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        for patch in cls.patches:
+            patch.stop()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.fallback = providers.AIModelFallback()
+        self.fallback.health = providers.ProviderHealth()
+        self.fallback.quota = providers.QuotaLedger()
+        self.key = f'sim-{self.id()}'
+
+    def scenario(self, **faults):
+        fast = {'latency': {'dist': 'fixed', 'ms': 0}, 'drip_ms': 0, 'words': 5}
+        self.server.RequestHandlerClass.sim.set_scenario({'default': {**fast, **faults}})
+
+    def test_chat_and_stream(self):
+        self.scenario()
+        result = self.fallback.generate('simulate me', 100, preferred_model='groq', api_key=self.key)
+        self.assertTrue(result['text'].startswith('[groq simulator]'))
+        fallback = providers.AsyncAIModelFallback()
+        fallback.health, fallback.quota = self.fallback.health, self.fallback.quota
+
+        async def stream():
+            return [c async for c in fallback.generate_stream('stream me', 100, preferred_model='groq', api_key=self.key)]
+        chunks = asyncio.run(stream())
+        self.assertEqual(chunks[0], ('model', 'groq'))
+        self.assertEqual(''.join(c[1] for c in chunks[1:]), '[groq simulator] stream me stream me stream')
+
+    def test_gemini_generate(self):
+        self.scenario()
+        result = self.fallback.generate('simulate gemini', 100, preferred_model='gemini_flash', api_key=self.key)
+        self.assertTrue(result['text'].startswith('[gemini simulator]'))
+
+    def test_429_sets_retry_after(self):
+        self.scenario(rate_429=1.0, retry_after=42)
+        with self.assertRaises(providers.QuotaExceededError) as ctx:
+            self.fallback.generate('rate limited', 100, preferred_model='groq', api_key=self.key)
+        self.assertEqual(ctx.exception.retry_after, 42)
+
+    def test_hung_connection_times_out(self):
+        self.scenario(hang_rate=1.0, hang_s=5)
+        started = time.monotonic()
+        with self.assertRaises(providers.ProviderTimeoutError):
+            self.fallback.generate('hang up', 100, preferred_model='groq', api_key=self.key)
+        self.assertLess(time.monotonic() - started, 2)
+
+
+class CassetteTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'cassette.jsonl')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _stream(self, cassette, prompt, live):
+        async def read():
+            return [c async for c in cassette.astream('groq', prompt, 100, live)]
+        return asyncio.run(read())
+
+    def _record(self):
+        recorder = providers.ProviderCassette(self.path, mode='record')
+        self.assertEqual(recorder.call('groq', 'prompt one', 100, lambda: 'answer one'), 'answer one')
+
+        async def chunks():
+            yield 'a'
+            yield 'b'
+        self.assertEqual(self._stream(recorder, 'prompt two', chunks), ['a', 'b'])
+
+        def quota():
+            raise providers.QuotaExceededError('429 quota', status=429, retry_after=30)
+        with self.assertRaises(providers.QuotaExceededError):
+            recorder.call('gemini_flash', 'prompt one', 100, quota)
+
+    def test_record_then_replay(self):
+        self._record()
+        player = providers.ProviderCassette(self.path, mode='replay', latency_scale=0)
+        live = lambda: self.fail('replay must not call the provider')
+        self.assertEqual(player.call('groq', 'prompt  one', 100, live), 'answer one')
+        self.assertEqual(self._stream(player, 'prompt two', live), ['a', 'b'])
+        self.assertEqual(self._stream(player, 'prompt one', live), ['answer one'])
+        with self.assertRaises(providers.QuotaExceededError) as ctx:
+            player.call('gemini_flash', 'prompt one', 100, live)
+        self.assertEqual(ctx.exception.retry_after, 30)
+        self.assertIn(player.call('groq', 'never recorded', 100, live), ('answer one', 'ab'))
+        self.assertEqual(player.stats()['substituted'], 1)
+
+        strict = providers.ProviderCassette(self.path, mode='replay', latency_scale=0, on_miss='error')
+        with self.assertRaises(providers.ProviderUnavailableError):
+            strict.call('groq', 'never recorded', 100, live)
+
+    def test_fallback_replays_without_keys(self):
+        self._record()
+        fallback = providers.AIModelFallback()
+        fallback.cassette = providers.ProviderCassette(self.path, mode='replay', latency_scale=0)
+        fallback.health = providers.ProviderHealth()
+        fallback.quota = providers.QuotaLedger()
+        result = fallback.generate('prompt one', 100, preferred_model='groq')
+        self.assertEqual(result, {'text': 'answer one', 'model': 'groq', 'success': True})
+
+    def test_async_replay(self):
+        self._record()
+        player = providers.ProviderCassette(self.path, mode='replay', latency_scale=0)
+
+        async def replay():
+            text = await player.acall('groq', 'prompt one', 100, None)
+            chunks = [c async for c in player.astream('groq', 'prompt two', 100, None)]
+            return text, chunks
+        self.assertEqual(asyncio.run(replay()), ('answer one', ['a', 'b']))
+
+
+class FrozenLRUCacheTests(unittest.TestCase):
+    def test_hits_are_shared_and_read_only(self):
+        cache = caches.FrozenLRUCache()
+
+        @cache
+        def analyse(x):
+            return {'x': x, 'tags': ['a', 'b']}
+
+        first = analyse(1)
+        self.assertIs(analyse(1), first)
+        self.assertEqual(first['tags'], ('a', 'b'))
+        with self.assertRaises(TypeError):
+            first['x'] = 2
+        self.assertEqual(json.loads(json.dumps(first)), {'x': 1, 'tags': ['a', 'b']})
+        thawed = caches.thaw(first)
+        thawed['tags'].append('c')
+        self.assertEqual(analyse(1)['tags'], ('a', 'b'))
+
+    def test_concurrent_misses_coalesce(self):
+        cache = caches.FrozenLRUCache()
+        calls = []
+
+        @cache
+        def slow(x):
+            calls.append(x)
+            time.sleep(0.1)
+            return {'x': x}
+
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            results = list(pool.map(slow, [7] * 5))
+        self.assertEqual(calls, [7])
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(cache.stats()['coalesced'], 4)
+
+    def test_leader_error_reaches_followers_and_is_not_cached(self):
+        cache = caches.FrozenLRUCache()
+        calls = []
+
+        @cache
+        def flaky(x):
+            calls.append(x)
+            time.sleep(0.05)
+            raise RuntimeError('boom')
+
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            futures = [pool.submit(flaky, 1) for _ in range(3)]
+        for future in futures:
+            self.assertIsInstance(future.exception(), RuntimeError)
+        with self.assertRaises(RuntimeError):
+            flaky(1)
+        self.assertEqual(len(calls), 2)
+
+    def test_cancelled_leader_hands_over_to_a_follower(self):
+        flight = caches._SingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'page'
+
+        async def main():
+            leader = asyncio.ensure_future(flight.arun('k', fetch))
+            await asyncio.sleep(0.01)
+            follower = asyncio.ensure_future(flight.arun('k', fetch))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await leader
+            return await follower
+
+        self.assertEqual(asyncio.run(main()), ('page', True))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(flight.run('k', lambda: 'again'), ('again', True))
+
+    def test_byte_bound(self):
+        cache = caches.FrozenLRUCache(max_bytes=2000)
+
+        @cache
+        def blob(x):
+            return {'data': str(x) * 300}
+
+        for i in range(10):
+            blob(i)
+        stats = cache.stats()
+        self.assertLessEqual(stats['bytes'], 2000)
+        self.assertLess(stats['entries'], 10)
+
+    def test_compare_variations_does_not_mutate_input(self):
+        variations = {'concise': {'text': 'Short prompt.', 'length': 13, 'model': 'groq'}}
+        comparison = services.compare_variations('original', variations)
+        self.assertNotIn('quality', variations['concise'])
+        self.assertIn('quality', comparison['variations']['concise'])
+
+
+class NearDuplicateTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.index = caches.NearDuplicateIndex(
+            path=os.path.join(self.tmp.name, 'near.sqlite3'), max_entries=3,
+            thresholds={'enhancement': 0.85, 'greeting': 0.5},
+        )
+        self.scope = self.index.scope()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_canonicalise(self):
+        self.assertEqual(caches.canonicalise_prompt('  Write a Poem, PLEASE!! '), 'write a poem')
+
+    def test_near_hit_and_miss(self):
+        self.index.add('enhancement', 'Write a blog post about the history of coffee in Ethiopia', self.scope, {'enhanced': 'x'})
+        payload, similarity = self.index.lookup(
+            'enhancement', 'write a blog post about the history of coffee in ethiopia, please', self.scope)
+        self.assertEqual(payload, {'enhanced': 'x'})
+        self.assertEqual(similarity, 1.0)
+        self.assertIsNone(self.index.lookup('enhancement', 'Write a blog post about the history of tea in China', self.scope))
+        self.assertIsNone(self.index.lookup('greeting', 'Write a blog post about the history of coffee in Ethiopia', self.scope))
+        self.assertIsNone(self.index.lookup(
+            'enhancement', 'Write a blog post about the history of coffee in Ethiopia', self.index.scope(api_key='other')))
+
+    def test_one_changed_content_word_is_a_miss(self):
+        question = ('Explain how a {} rate limiter works in a distributed API gateway, how it handles bursts '
+                    'of traffic from many clients, what state it keeps in Redis, and how to tune its refill '
+                    'rate and capacity for an endpoint that serves about two thousand requests per second')
+        self.index.add('enhancement', question.format('token bucket'), self.scope, {'enhanced': 'x'})
+        self.assertIsNone(self.index.lookup('enhancement', question.format('leaky bucket'), self.scope))
+        signatures = [self.index.hasher.signature(caches.canonicalise_prompt(question.format(kind)))
+                      for kind in ('token bucket', 'leaky bucket')]
+        self.assertGreater(caches.MinHasher.similarity(*signatures), 0.85)
+        self.assertLess(caches.MinHasher.similarity(*signatures), caches.NEAR_DUPLICATE_THRESHOLDS['enhancement'])
+
+    def test_bounded(self):
+        for i in range(6):
+            self.index.add('greeting', f'hello number {i}', self.scope, {'i': i})
+        self.assertEqual(self.index.stats()['entries'], 3)
+        self.assertIsNone(self.index.lookup('greeting', 'hello number 0', self.scope))
+        self.assertEqual(self.index.lookup('greeting', 'hello number 5', self.scope)[0], {'i': 5})
+
+
+class ResponseStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'responses.sqlite3')
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _generate(self, store):
+        @store
+        def generate(prompt, max_tokens=2000, preferred_model=None, api_key=None):
+            self.calls.append(prompt)
+            return {'text': prompt.upper(), 'model': 'gemini_flash', 'success': True}
+        return generate
+
+    def test_shared_between_instances(self):
+        first = self._generate(caches.ResponseStore('generate', path=self.path))
+        second_store = caches.ResponseStore('generate', path=self.path)
+        second = self._generate(second_store)
+        first('hello  world', api_key='key-1')
+        self.assertEqual(second('hello world', 2000, api_key='key-1')['text'], 'HELLO  WORLD')
+        self.assertEqual(len(self.calls), 1)
+        second('hello world', api_key='key-2')
+        second('hello world', max_tokens=100, api_key='key-1')
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual((second_store.hits, second_store.misses), (1, 2))
+
+    def test_key_keeps_line_structure(self):
+        generate = self._generate(caches.ResponseStore('generate', path=self.path))
+        generate('fix this:\n\nif x:\n    return  1 \n')
+        generate('\nfix  this:\n\nif x:\n    return 1')
+        self.assertEqual(len(self.calls), 1)
+        generate('fix this:\n\nif x:\nreturn 1')
+        generate('fix this: if x: return 1')
+        self.assertEqual(len(self.calls), 3)
+
+    def test_raw_key_never_stored(self):
+        generate = self._generate(caches.ResponseStore('generate', path=self.path))
+        generate('prompt', api_key='secret-key-value')
+        with open(self.path, 'rb') as f:
+            self.assertNotIn(b'secret-key-value', f.read())
+
+    def test_ttl_failures_and_eviction(self):
+        store = caches.ResponseStore('generate', path=self.path, ttl=-1)
+        generate = self._generate(store)
+        generate('a')
+        generate('a')
+        self.assertEqual(len(self.calls), 2)
+
+        store = caches.ResponseStore('generate', path=self.path, max_bytes=0)
+        store.prune()
+        store.set('k', {'success': False})
+        store.set('k2', {'text': 'x' * 1000})
+        self.assertEqual(store.stats()['entries'], 1)
+        store.prune()
+        self.assertEqual(store.stats()['entries'], 0)
+
+    def test_async_shares_with_sync(self):
+        store = caches.ResponseStore('generate', path=self.path)
+        generate = self._generate(store)
+
+        @store
+        async def agenerate(prompt, max_tokens=2000, preferred_model=None, api_key=None):
+            self.calls.append(prompt)
+            return {}
+
+        generate('shared')
+        self.assertEqual(asyncio.run(agenerate('shared'))['text'], 'SHARED')
+        self.assertEqual(len(self.calls), 1)
+
+
+class TokenBudgetTests(unittest.TestCase):
+    def test_only_static_fragment_counts_are_cached(self):
+        providers._count_static_fragment.cache_clear()
+        providers.register_static_text('Shared instructions.\n\nAnswer briefly.')
+        text = 'Shared instructions.\n\nUser question here.'
+        first = providers.count_tokens(text)
+        providers.count_tokens(text)
+        self.assertEqual(providers.count_tokens(text), first)
+        info = providers._count_static_fragment.cache_info()
+        self.assertEqual((info.currsize, info.hits), (1, 2))
+
+    def test_trim_fits_budget_on_sentence_boundary(self):
+        text = ' '.join(f'Sentence number {i} is here.' for i in range(500))
+        trimmed = providers.trim_to_tokens(text, 200)
+        self.assertLessEqual(providers.count_tokens(trimmed), 200)
+        body = trimmed[:-len(providers._TRIM_MARKER)]
+        self.assertTrue(body.endswith('here.'))
+        self.assertEqual(providers.trim_to_tokens('short.', 200), 'short.')
+
+    def test_output_budget_honours_caller(self):
+        self.assertEqual(providers.output_budget('gemini_flash', 500), 500)
+        self.assertEqual(providers.output_budget('gemini_flash', 50_000), 8192)
+        self.assertEqual(providers.output_budget('groq', 8000), 4096)
+
+    def test_fit_messages_trims_longest(self):
+        system = 'Follow these rules.'
+        messages = [
+            {'role': 'system', 'content': system},
+            {'role': 'user', 'content': 'Context sentence. ' * 5000},
+        ]
+        fitted = providers.fit_messages('groq', messages, 1000)
+        self.assertEqual(fitted[0]['content'], system)
+        total = sum(providers.count_tokens(m['content']) for m in fitted)
+        self.assertLessEqual(total, providers.input_budget('groq', 1000))
+        self.assertEqual(len(messages[1]['content']), len('Context sentence. ') * 5000)
+
+
+class AsyncScriptedFallback(providers.AsyncAIModelFallback):
+    """AsyncAIModelFallback whose providers await/fail according to a script."""
+
+    def __init__(self, script):
+        super().__init__()
+        self.script = script
+        self.health = providers.ProviderHealth()
+        self.quota = providers.QuotaLedger()
+        self.calls = []
+
+    async def _call_model(self, model_name, prompt, max_tokens, api_key=None):
+        self.calls.append(model_name)
+        delay, outcome = self.script.get(model_name, (0, Exception('not scripted')))
+        await asyncio.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def _stream_model(self, model_name, prompt, max_tokens, api_key=None):
+        self.calls.append(model_name)
+        delay, outcome = self.script.get(model_name, (0, Exception('not scripted')))
+        await asyncio.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        for word in outcome.split(' '):
+            yield word
+
+
+class StreamingTests(unittest.IsolatedAsyncioTestCase):
+    async def test_streams_chunks_from_first_working_model(self):
+        fallback = AsyncScriptedFallback({
+            'gemini_flash': (0, providers.ProviderUnavailableError('503')),
+            'gemini_flash_8b': (0, 'streamed answer'),
+        })
+        events = [event async for event in fallback.generate_stream('prompt')]
+        self.assertEqual(events[0], ('model', 'gemini_flash_8b'))
+        self.assertEqual([v for k, v in events if k == 'delta'], ['streamed', 'answer'])
+
+    async def test_explicit_model_does_not_fall_back(self):
+        fallback = AsyncScriptedFallback({
+            'groq': (0, Exception('boom')),
+            'gemini_flash': (0, 'answer'),
+        })
+        with self.assertRaises(providers.ProviderError):
+            [event async for event in fallback.generate_stream('prompt', preferred_model='groq')]
+        self.assertEqual(fallback.calls, ['groq'])
+
+    async def test_all_failed_raises(self):
+        with self.assertRaises(providers.ProviderError):
+            [event async for event in AsyncScriptedFallback({}).generate_stream('prompt')]
+
+
+class AsyncFallbackTests(unittest.IsolatedAsyncioTestCase):
+    async def test_falls_through_to_next_model(self):
+        fallback = AsyncScriptedFallback({
+            'gemini_flash': (0, Exception('503 Service Unavailable')),
+            'gemini_flash_8b': (0, 'answer'),
+        })
+        result = await fallback.generate('prompt')
+        self.assertEqual(result['model'], 'gemini_flash_8b')
+        self.assertEqual(fallback.health.snapshot()['gemini_flash']['consecutive_failures'], 1)
+
+    async def test_many_calls_in_flight_on_one_loop(self):
+        fallback = AsyncScriptedFallback({'gemini_flash': (0.2, 'answer')})
+        started = time.perf_counter()
+        results = await asyncio.gather(*(fallback.generate('prompt') for _ in range(200)))
+        self.assertEqual(len(results), 200)
+        self.assertLess(time.perf_counter() - started, 2.0)
+
+    async def test_hedge_cancels_loser(self):
+        delay = providers.HEDGE_DEFAULT_DELAY
+        providers.HEDGE_DEFAULT_DELAY = 0.05
+        try:
+            fallback = AsyncScriptedFallback({
+                'gemini_flash': (1.0, 'slow answer'),
+                'gemini_flash_8b': (0.01, 'fast answer'),
+            })
+            fallback.hedge_enabled = True
+            result = await fallback.generate('prompt')
+        finally:
+            providers.HEDGE_DEFAULT_DELAY = delay
+        self.assertEqual(result['model'], 'gemini_flash_8b')
+        self.assertEqual(result['hedge']['abandoned'], [])
+
+    async def test_stream(self):
+        fallback = AsyncScriptedFallback({'gemini_flash': (0, 'streamed answer')})
+        events = [event async for event in fallback.generate_stream('prompt')]
+        self.assertEqual(events, [('model', 'gemini_flash'), ('delta', 'streamed'), ('delta', 'answer')])
+
+    async def test_async_prefix_cache(self):
+        min_tokens = providers.GEMINI_CACHE_MIN_TOKENS
+        providers.GEMINI_CACHE_MIN_TOKENS = 50
+        try:
+            fallback = providers.AsyncAIModelFallback()
+            fallback.prefixes = providers.PrefixCache()
+            fallback.prefixes.register('master', PrefixCacheTests.PREFIX)
+            pool = AsyncLocalGeminiPool()
+            fallback._pool = lambda: pool
+            prompt = PrefixCacheTests.PREFIX + '\n\nstream me'
+            chunks = [c async for c in fallback._stream_gemini(prompt, 'gemini_flash', 500, api_key='k')]
+            self.assertIn('stream me', ''.join(chunks))
+            await fallback._call_gemini(prompt, 'gemini_flash', 500, api_key='k')
+        finally:
+            providers.GEMINI_CACHE_MIN_TOKENS = min_tokens
+        stats = fallback.prefixes.snapshot()['providers']['gemini']
+        self.assertEqual((stats['handles_created'], stats['prefixed_requests']), (1, 2))
+        self.assertEqual(stats['input_tokens_saved'], 2 * providers.count_tokens(PrefixCacheTests.PREFIX))
+
+    async def test_async_cache_shared_with_sync(self):
+        cache = caches.FrozenLRUCache()
+        calls = []
+
+        @cache
+        def sync_fn(x):
+            calls.append(x)
+            return {'x': x}
+
+        @cache
+        async def async_fn(x):
+            calls.append(x)
+            return {'x': x}
+
+        sync_fn(1)
+        self.assertEqual(await async_fn(1), {'x': 1})
+        self.assertEqual(calls, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import asyncio
+import tempfile
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../backend')))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'promptx_project.settings')
+
+import django
+django.setup()
+
+from django.test import AsyncClient, Client, SimpleTestCase, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from asgiref.sync import async_to_sync
+
+import crawler
+import providers
+import test_services
+from api import views
+
+
+def setUpModule():
+    setup_test_environment()
+
+
+def tearDownModule():
+    teardown_test_environment()
+
+
+def parse_sse(body):
+    """[(event, data)] from a text/event-stream body, comment lines skipped."""
+    events = []
+    for block in body.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n') if line and not line.startswith(':'))
+        if fields:
+            events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+@override_settings(RATELIMIT_ENABLE=False)
+class EnhanceStreamTests(SimpleTestCase):
+    """/api/enhance/stream through the Django test client, providers scripted."""
+
+    def setUp(self):
+        test_services.isolate_caches(self)
+        # A deep-research prompt, so the stream has status events
+        self.prompt = 'explain how to build a todo app with offline sync'
+        self.fallback = test_services.AsyncScriptedFallback({'gemini_flash': (0, 'the streamed answer')})
+        patcher = mock.patch.object(providers, '_async_fallback', self.fallback)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, **body):
+        response = Client().post('/api/enhance/stream', json.dumps({'prompt': self.prompt, **body}),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return parse_sse(b''.join(response.streaming_content).decode())
+
+    def test_event_order_over_wsgi(self):
+        events = self.post()
+        kinds = [kind for kind, _ in events]
+        self.assertEqual(kinds, ['status', 'status', 'model', 'token', 'token', 'token', 'done'])
+        self.assertEqual([data['step'] for kind, data in events if kind == 'status'], [0, 1])
+        self.assertEqual(events[2][1], {'model': 'gemini_flash'})
+        self.assertEqual(''.join(data['text'] for kind, data in events if kind == 'token'), 'thestreamedanswer')
+        done = events[-1][1]
+        self.assertTrue(done['success'])
+        self.assertEqual(done['model'], 'gemini_flash')
+        self.assertEqual(done['original'], self.prompt)
+        self.assertIn('total', done['enhanced_score'])
+        self.assertEqual(done['stream']['chunks'], 3)
+        self.assertIn('budget', done)
+
+    def test_event_order_over_asgi(self):
+        async def stream():
+            response = await AsyncClient().post('/api/enhance/stream', json.dumps({'prompt': self.prompt}),
+                                                content_type='application/json')
+            return b''.join([chunk async for chunk in response.streaming_content]).decode()
+        events = parse_sse(asyncio.run(stream()))
+        self.assertEqual([kind for kind, _ in events], ['status', 'status', 'model', 'token', 'token', 'token', 'done'])
+
+    def test_quota_error_event(self):
+        self.fallback.script = {'groq': (0, Exception('429 RESOURCE_EXHAUSTED'))}
+        events = self.post(model='groq')
+        kind, data = events[-1]
+        self.assertEqual(kind, 'error')
+        self.assertEqual(data['status'], 429)
+        self.assertFalse(data['success'])
+        self.assertNotIn('done', [kind for kind, _ in events])
+
+    def test_deadline_error_event(self):
+        with mock.patch.dict(providers.REQUEST_BUDGETS, {'enhance': 0.0}):
+            events = self.post(model='gemini_flash')
+        kind, data = events[-1]
+        self.assertEqual(kind, 'error')
+        self.assertEqual(data['status'], 504)
+        self.assertEqual(data['budget']['skipped'][0]['step'], 'analysis')
+        self.assertEqual(self.fallback.calls, [])
+
+    def test_invalid_payload_is_a_plain_400(self):
+        response = Client().post('/api/enhance/stream', '{"nope": 1}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class LoopRecordingFallback(test_services.AsyncScriptedFallback):
+    """Scripted fallback that notes which pooled clients each call saw."""
+
+    def __init__(self, script):
+        super().__init__(script)
+        self.clients = []
+
+    async def _stream_model(self, *args, **kw):
+        self.clients.append((providers._get_async_pool(), crawler._get_async_http()))
+        async for chunk in super()._stream_model(*args, **kw):
+            yield chunk
+
+
+@override_settings(RATELIMIT_ENABLE=False)
+class WorkerLoopTests(SimpleTestCase):
+    """Async views under WSGI share one loop, and so one set of clients, per worker."""
+
+    def setUp(self):
+        test_services.isolate_caches(self)
+
+    def test_wsgi_requests_reuse_one_client(self):
+        fallback = LoopRecordingFallback({'gemini_flash': (0, 'an answer')})
+        with mock.patch.object(providers, '_async_fallback', fallback):
+            for platform in ('web', 'mobile'):
+                prompt = f'explain how to build a {platform} todo app with offline sync'
+                response = Client().post('/api/enhance/stream', json.dumps({'prompt': prompt}),
+                                         content_type='application/json')
+                parse_sse(b''.join(response.streaming_content).decode())
+        self.assertEqual(len(fallback.clients), 2)
+        (pool, http), (pool_again, http_again) = fallback.clients
+        self.assertIs(pool, pool_again)
+        self.assertIs(http, http_again)
+        self.assertFalse(http.is_closed)
+
+    def test_clients_close_with_their_loop(self):
+        async def grab():
+            return crawler._get_async_http()
+        for run in (lambda: asyncio.run(grab()), async_to_sync(grab)):
+            client = run()
+            self.assertTrue(client.is_closed)
+
+    def test_pool_clients_close_with_their_loop(self):
+        async def grab():
+            pool = providers._get_async_pool()
+            return pool, pool.get('groq', 'gsk-test')
+        pool, client = asyncio.run(grab())
+        self.assertTrue(client.is_closed)
+        self.assertEqual(len(pool._clients), 0)
+
+
+@override_settings(RATELIMIT_ENABLE=False)
+class FollowUpTests(SimpleTestCase):
+    """Only questions the client marks follow_up are answered from a site's index."""
+
+    def setUp(self):
+        test_services.isolate_caches(self)
+        failed = {'success': False, 'error': 'unreachable'}
+        self.index = mock.AsyncMock(return_value=None)
+        self.crawl = mock.AsyncMock(return_value=failed)
+        for patcher in (mock.patch.object(views, 'asite_index', self.index),
+                        mock.patch.object(views, 'ascrape_website_deep', self.crawl),
+                        mock.patch.object(views, 'aweb_search_many', mock.AsyncMock(return_value=[]))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def analyse(self, **body):
+        return Client().post('/api/analyze-url', json.dumps({'url': 'https://acme.test', **body}),
+                             content_type='application/json')
+
+    def test_first_question_crawls_without_the_index(self):
+        self.assertEqual(self.analyse().status_code, 422)
+        self.index.assert_not_called()
+        self.crawl.assert_awaited_once()
+
+    def test_follow_up_consults_the_index(self):
+        self.analyse(follow_up=True)
+        self.index.assert_awaited_once_with('https://acme.test')
+        self.analyse(follow_up=True, force_refresh=True)
+        self.assertEqual(self.index.await_count, 1)
+
+
+class HealthTests(SimpleTestCase):
+    """/health is public and minimal; the detail is on /api/stats, behind a token or staff session."""
+
+    def setUp(self):
+        test_services.isolate_caches(self)
+
+    def test_health_has_no_internals(self):
+        response = Client().get('/health')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'healthy')
+        self.assertNotIn('providers', response.json())
+
+    @override_settings(STATS_TOKEN='')
+    def test_stats_closed_without_a_token(self):
+        self.assertEqual(Client().get('/api/stats').status_code, 403)
+        self.assertEqual(Client().get('/api/stats', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+    @override_settings(STATS_TOKEN='s3cret')
+    def test_stats_with_token(self):
+        self.assertEqual(Client().get('/api/stats', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = Client().get('/api/stats', HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, 200)
+        providers = response.json()['providers']
+        self.assertIn('quota', providers)
+        self.assertNotIn(tempfile.gettempdir(), json.dumps(providers))